@@ -0,0 +1,190 @@
+"""
+Benchmark: per-turn cost of the LangGraph agent's history, full vs. HistoryManager.
+
+Replays a scripted booking-agent session offline: every turn searches a
+route (a large flight-list tool result) and every few turns books a flight
+and generates its invoice. For each turn it records the tokens sent to the
+model, the time spent preparing the history and a modeled model latency
+(fixed overhead plus a per-token prefill cost), with and without the
+history manager. The managed session must keep its per-turn tokens flat
+and must still know the IDs of every booking it has not deliberately
+collapsed into a count; otherwise the benchmark exits with status 1.
+
+    python benchmarks/bench_chat_history.py --turns 400 --output history.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.messages.utils import count_tokens_approximately
+
+from chat_history import HistoryManager, message_text
+from setup_flight_db import airlines, cities
+
+SYSTEM_PROMPT = "You are a helpful assistant with access to flight search, booking and invoice tools. " * 20
+
+
+def flight_list(rng: random.Random, origin: str, destination: str, day: str, count: int) -> Dict:
+    flights = []
+    for _ in range(count):
+        airline = rng.choice(airlines)
+        hour = rng.randint(6, 22)
+        flights.append({
+            "flight_number": f"{airline[:2].upper()}{rng.randint(1000, 9999)}",
+            "airline": airline,
+            "departure_location": origin,
+            "arrival_location": destination,
+            "departure_date": day,
+            "departure_time": f"{hour:02d}:{rng.randint(0, 59):02d}",
+            "arrival_time": f"{(hour + rng.randint(1, 10)) % 24:02d}:{rng.randint(0, 59):02d}",
+            "price": round(rng.uniform(150, 2000), 2),
+            "seats_available": rng.randint(1, 200),
+            "flight_id": rng.randint(1, 10 ** 6),
+        })
+    flights.sort(key=lambda flight: flight["price"])
+    return {"flights": flights}
+
+
+def scripted_turn(rng: random.Random, turn: int, flights_per_search: int, book_every: int) -> List:
+    """Messages produced by one user turn, as the graph would append them."""
+    origin, destination = rng.sample(cities, 2)
+    day = f"2025-07-{turn % 28 + 1:02d}"
+    result = flight_list(rng, origin, destination, day, flights_per_search)
+    call = {"name": "search_flights", "args": {"departure_location": origin, "arrival_location": destination,
+                                                "departure_date": day}, "id": f"call-{turn}-search"}
+    messages = [
+        HumanMessage(f"Find flights from {origin} to {destination} on {day}."),
+        AIMessage("", tool_calls=[call]),
+        ToolMessage(json.dumps(result), tool_call_id=call["id"], name="search_flights"),
+        AIMessage(f"I found {len(result['flights'])} flights; the cheapest is "
+                  f"{result['flights'][0]['flight_number']} at ${result['flights'][0]['price']}."),
+    ]
+    if book_every and turn % book_every == book_every - 1:
+        flight = result["flights"][0]
+        booking_id = 1000 + turn
+        book = {"name": "book_flight", "args": {"customer_id": "CUST42", "flight_id": flight["flight_id"]},
+                "id": f"call-{turn}-book"}
+        invoice = {"name": "generate_invoice", "args": {"booking_id": booking_id}, "id": f"call-{turn}-invoice"}
+        messages += [
+            HumanMessage(f"Book {flight['flight_number']} for customer CUST42."),
+            AIMessage("", tool_calls=[book]),
+            ToolMessage(json.dumps({
+                "success": True, "booking_id": booking_id,
+                "message": f"Flight booked successfully! Booking ID: {booking_id}",
+                "details": {"flight_number": flight["flight_number"], "airline": flight["airline"],
+                            "departure": origin, "destination": destination, "date": day,
+                            "departure_time": flight["departure_time"], "payment_amount": flight["price"],
+                            "payment_status": "Completed"},
+            }), tool_call_id=book["id"], name="book_flight"),
+            AIMessage("", tool_calls=[invoice]),
+            ToolMessage(json.dumps({
+                "success": True, "invoice_number": f"INV-{booking_id:08X}", "booking_id": booking_id,
+                "filename": f"invoice_{booking_id}_INV-{booking_id:08X}.pdf",
+            }), tool_call_id=invoice["id"], name="generate_invoice"),
+            AIMessage(f"Booked! Your booking ID is {booking_id}."),
+        ]
+    return messages
+
+
+def run_session(managed: bool, args) -> Dict:
+    rng = random.Random(args.seed)
+    history = HistoryManager(max_tokens=args.max_tokens)
+    state: List = [SystemMessage(SYSTEM_PROMPT)]
+    booking_ids = []
+    per_turn = []
+    for turn in range(args.turns):
+        new_messages = scripted_turn(rng, turn, args.flights, args.book_every)
+        booking_ids += [json.loads(message.content)["booking_id"] for message in new_messages
+                        if isinstance(message, ToolMessage) and message.name == "book_flight"]
+        state = state + new_messages
+
+        started = time.perf_counter()
+        sent = history.prepare(state) if managed else state
+        prepare_ms = (time.perf_counter() - started) * 1000
+        tokens = count_tokens_approximately(sent)
+        if managed:
+            # The reference chat loop stores the trimmed history back
+            state = sent
+        per_turn.append({
+            "turn": turn + 1,
+            "messages_sent": len(sent),
+            "tokens_sent": tokens,
+            "prepare_ms": round(prepare_ms, 3),
+            "modeled_latency_ms": round(args.base_ms + tokens * args.ms_per_1k_tokens / 1000 + prepare_ms, 1),
+        })
+
+    context = "\n".join(message_text(message) for message in state)
+    # Bookings beyond the summary's ID list are only counted by design
+    kept = booking_ids[-(history.max_booking_facts + history.max_earlier_bookings):] if managed else booking_ids
+    missing = [booking_id for booking_id in kept if str(booking_id) not in context]
+    return {"managed": managed, "bookings": len(booking_ids), "bookings_kept": len(kept),
+            "bookings_missing_from_context": missing, "turns": per_turn}
+
+
+def check_flat(session: Dict, max_tokens: int) -> List[str]:
+    """Problems with a managed session: tokens over budget or still growing, or recent context dropped."""
+    turns = session["turns"]
+    problems = []
+    over = [turn["turn"] for turn in turns if turn["tokens_sent"] > max_tokens]
+    if over:
+        problems.append(f"over the {max_tokens} token budget at turns {over[:5]}")
+    if len(turns) >= 8:
+        quarter = len(turns) // 4
+
+        def mean(key: str, part: List[Dict]) -> float:
+            return sum(turn[key] for turn in part) / len(part)
+
+        # Compare the steady state after warm-up with the end of the session
+        second, last = turns[quarter:2 * quarter], turns[-quarter:]
+        if mean("tokens_sent", last) > mean("tokens_sent", second) * 1.1:
+            problems.append(f"tokens still growing: {mean('tokens_sent', second):.0f} per turn in the second "
+                            f"quarter, {mean('tokens_sent', last):.0f} in the last")
+        if mean("messages_sent", last) < mean("messages_sent", second) * 0.9:
+            problems.append(f"recent context shrinking: {mean('messages_sent', second):.1f} messages per turn in "
+                            f"the second quarter, {mean('messages_sent', last):.1f} in the last")
+    if session["bookings_missing_from_context"]:
+        problems.append(f"bookings missing from context: {session['bookings_missing_from_context']}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--turns", type=int, default=200, help="user turns in the session")
+    parser.add_argument("--flights", type=int, default=40, help="flights in every search result")
+    parser.add_argument("--book-every", type=int, default=5, help="book and invoice every N turns (0: never)")
+    parser.add_argument("--max-tokens", type=int, default=6000, help="HistoryManager token budget")
+    parser.add_argument("--base-ms", type=float, default=300.0, help="modeled fixed latency per model call")
+    parser.add_argument("--ms-per-1k-tokens", type=float, default=25.0, help="modeled prefill cost")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default=None, help="write per-turn results as JSON to this file")
+    args = parser.parse_args()
+
+    sessions = [run_session(False, args), run_session(True, args)]
+
+    step = max(1, args.turns // 10)
+    print(f"{'turn':>6}{'full tokens':>14}{'full ms':>10}{'managed tokens':>17}{'managed ms':>12}{'prepare ms':>12}")
+    for full, managed in list(zip(sessions[0]["turns"], sessions[1]["turns"]))[step - 1::step]:
+        print(f"{full['turn']:>6}{full['tokens_sent']:>14}{full['modeled_latency_ms']:>10}"
+              f"{managed['tokens_sent']:>17}{managed['modeled_latency_ms']:>12}{managed['prepare_ms']:>12}")
+    managed = sessions[1]
+    print(f"bookings: {managed['bookings']}, IDs kept: {managed['bookings_kept']}, "
+          f"missing from managed context: {managed['bookings_missing_from_context']}")
+    problems = check_flat(managed, args.max_tokens)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"benchmark": "chat_history", "config": vars(args), "sessions": sessions,
+                       "problems": problems}, f, indent=2)
+    if problems:
+        sys.exit("FAIL: " + "; ".join(problems))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Benchmark: cold start and memory of mcp_host.py vs. the two separate stdio servers.
+
+Each run starts the services the way reference_langgraph.py does (stdio
+subprocesses with an MCP ClientSession each), waits until every session is
+initialized, makes a first search_flights and generate_invoice call, and
+reads each process's peak RSS from get_server_metrics. Runs are repeated and
+the median is reported.
+
+    python benchmarks/bench_host_startup.py --runs 5 --output startup.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import AsyncExitStack
+from typing import Dict, List
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+
+from setup_flight_db import generate_database
+
+SETUPS = {
+    "two_process": {"flight": "flight_mcp_server.py", "invoice": "invoice_server.py"},
+    "single_host": {"flight": "mcp_host.py", "invoice": "mcp_host.py"},
+}
+
+
+async def call(session: ClientSession, tool: str, arguments: Dict) -> Dict:
+    result = await session.call_tool(tool, arguments)
+    return json.loads(result.content[0].text)
+
+
+async def measure(setup: str, workdir: str, errlog, booking: tuple, route: tuple) -> Dict:
+    started = time.perf_counter()
+    async with AsyncExitStack() as stack:
+        sessions = {}
+        for service, script in SETUPS[setup].items():
+            if script in sessions:
+                # The host serves every service over one session
+                sessions[service] = sessions[script]
+                continue
+            params = StdioServerParameters(command=sys.executable, args=[os.path.join(REPO_ROOT, script)],
+                                           cwd=workdir)
+            read, write = await stack.enter_async_context(stdio_client(params, errlog=errlog))
+            session = await stack.enter_async_context(ClientSession(read, write))
+            await session.initialize()
+            sessions[service] = sessions[script] = session
+        ready = time.perf_counter() - started
+
+        search = await call(sessions["flight"], "search_flights", dict(zip(
+            ("departure_location", "arrival_location", "departure_date"), route)))
+        first_search = time.perf_counter() - started
+        invoice = await call(sessions["invoice"], "generate_invoice", dict(zip(
+            ("booking_id", "customer_id", "flight_id", "payment_amount", "card_last_four"), booking)))
+        first_invoice = time.perf_counter() - started
+
+        processes = {}
+        for script in dict.fromkeys(SETUPS[setup].values()):
+            process = (await call(sessions[script], "get_server_metrics", {}))["process"]
+            processes[process["pid"]] = process["peak_rss_mb"]
+
+    return {
+        "ready_seconds": ready,
+        "first_search_seconds": first_search,
+        "first_invoice_seconds": first_invoice,
+        "processes": len(processes),
+        "peak_rss_mb": sum(processes.values()),
+        "errors": [result["error"] for result in (search, invoice) if "error" in result],
+    }
+
+
+async def run(args, workdir: str) -> Dict[str, List[Dict]]:
+    conn = sqlite3.connect(os.path.join(workdir, "data", "flights.db"))
+    route = conn.execute("SELECT departure_location, arrival_location, departure_date FROM fare_summary").fetchone()
+    bookings = conn.execute(
+        "SELECT rowid, customer_id, flight_id, payment_amount, card_last_four FROM bookings ORDER BY rowid"
+    ).fetchall()
+    conn.close()
+
+    runs: Dict[str, List[Dict]] = {setup: [] for setup in SETUPS}
+    with open(os.path.join(workdir, "servers.log"), "w") as errlog:
+        for index in range(args.runs):
+            # Alternate the order so disk cache warm-up favors neither setup
+            order = list(SETUPS) if index % 2 == 0 else list(reversed(SETUPS))
+            for setup in order:
+                # A fresh booking every run, so each first invoice is rendered
+                booking = bookings[len(runs["two_process"]) + len(runs["single_host"])]
+                runs[setup].append(await measure(setup, workdir, errlog, booking, route))
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="cold starts per setup")
+    parser.add_argument("--output", default=None, help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_host_")
+    try:
+        generate_database(os.path.join(workdir, "data", "flights.db"), seed=1, bookings=2 * args.runs,
+                          fresh=True, verbose=False)
+        runs = asyncio.run(run(args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = {}
+    for setup, results in runs.items():
+        summary[setup] = {
+            key: round(statistics.median(result[key] for result in results), 3)
+            for key in ("ready_seconds", "first_search_seconds", "first_invoice_seconds", "peak_rss_mb")
+        }
+        summary[setup]["processes"] = results[0]["processes"]
+        summary[setup]["errors"] = sum(len(result["errors"]) for result in results)
+
+    print(f"{'setup':<13}{'procs':>6}{'ready s':>9}{'1st search s':>14}{'1st invoice s':>15}{'peak RSS MB':>13}")
+    for setup, row in summary.items():
+        print(f"{setup:<13}{row['processes']:>6}{row['ready_seconds']:>9}{row['first_search_seconds']:>14}"
+              f"{row['first_invoice_seconds']:>15}{row['peak_rss_mb']:>13}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"benchmark": "host_startup", "runs": args.runs, "summary": summary, "results": runs},
+                      f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Micro-benchmark: template-cached InvoiceRenderer vs drawing every invoice with FPDF.
+
+Each path runs in its own child process so peak RSS is measured per path.
+
+    python benchmarks/bench_invoice_renderer.py --count 2000
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from invoice_renderer import InvoiceRenderer, format_invoice_values, render_invoice_direct
+
+
+def sample_values(i: int):
+    return format_invoice_values(
+        f"INV-{i:08X}", "2025-05-14", i, f"CUST{i % 977}",
+        f"DL{1000 + i % 9000}", "Delta Air Lines", "New York", "London",
+        "2025-06-01", "18:45", 150.0 + (i % 1850), f"{i % 10000:04d}",
+    )
+
+
+def run_path(path: str, count: int, to_disk: bool) -> dict:
+    renderer = InvoiceRenderer()
+    with tempfile.TemporaryDirectory() as out_dir:
+        start = time.perf_counter()
+        total_bytes = 0
+        for i in range(count):
+            values = sample_values(i)
+            if path == "direct":
+                data = render_invoice_direct(values)
+            else:
+                data = renderer.render(values)
+            total_bytes += len(data)
+            if to_disk:
+                with open(os.path.join(out_dir, f"invoice_{i}.pdf"), "wb") as f:
+                    f.write(data)
+        elapsed = time.perf_counter() - start
+    return {
+        "path": path,
+        "invoices": count,
+        "to_disk": to_disk,
+        "seconds": round(elapsed, 4),
+        "invoices_per_second": round(count / elapsed, 1),
+        "avg_pdf_bytes": total_bytes // count,
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+                             (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=2000, help="invoices rendered per path")
+    parser.add_argument("--to-disk", action="store_true", help="also write every PDF to a temp directory")
+    parser.add_argument("--child", choices=["direct", "template"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_path(args.child, args.count, args.to_disk)))
+        return
+
+    results = []
+    for path in ("direct", "template"):
+        command = [sys.executable, os.path.abspath(__file__), "--child", path, "--count", str(args.count)]
+        if args.to_disk:
+            command.append("--to-disk")
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output))
+
+    print(f"{'path':<10}{'invoices/s':>12}{'seconds':>10}{'peak RSS MB':>13}{'avg bytes':>11}")
+    for result in results:
+        print(f"{result['path']:<10}{result['invoices_per_second']:>12}{result['seconds']:>10}"
+              f"{result['peak_rss_mb']:>13}{result['avg_pdf_bytes']:>11}")
+    speedup = results[1]["invoices_per_second"] / results[0]["invoices_per_second"]
+    print(f"speedup: {speedup:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
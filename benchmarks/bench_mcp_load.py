@@ -0,0 +1,284 @@
+"""
+End-to-end load benchmark: drives flight_mcp_server.py and invoice_server.py over MCP stdio.
+
+Both servers are started as real MCP servers in a scratch directory holding
+a freshly generated database, so the run is fully offline. Each concurrency
+level keeps that many requests in flight, picking tools from a weighted mix,
+and reports throughput, latency percentiles and error rates per tool.
+
+    python benchmarks/bench_mcp_load.py --concurrency 1,4,16 --duration 20 \\
+        --mix search_flights=70,book_flight=20,generate_invoice=10 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+
+from setup_flight_db import generate_database
+
+TOOLS = ("search_flights", "book_flight", "generate_invoice")
+DEFAULT_MIX = "search_flights=70,book_flight=20,generate_invoice=10"
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """Parse "tool=weight,..." into a weight per tool."""
+    weights = {}
+    for part in mix.split(","):
+        tool, _, weight = part.partition("=")
+        tool = tool.strip()
+        if tool not in TOOLS:
+            raise SystemExit(f"Unknown tool in --mix: {tool!r} (choose from {', '.join(TOOLS)})")
+        weights[tool] = float(weight or 1)
+    return weights
+
+
+def percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float], errors: int, seconds: float) -> Dict:
+    ordered = sorted(latencies)
+    requests = len(ordered)
+    to_ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        "requests": requests,
+        "errors": errors,
+        "error_rate": round(errors / requests, 4) if requests else 0.0,
+        "throughput_rps": round(requests / seconds, 2) if seconds else 0.0,
+        "latency_ms": {
+            "mean": to_ms(sum(ordered) / requests) if requests else None,
+            "p50": to_ms(percentile(ordered, 0.50)),
+            "p95": to_ms(percentile(ordered, 0.95)),
+            "p99": to_ms(percentile(ordered, 0.99)),
+            "max": to_ms(ordered[-1]) if ordered else None,
+        },
+    }
+
+
+class Workload:
+    """
+    Argument generator for each tool, drawn from the generated database.
+
+    Searches hit routes that exist, bookings target flights with seats,
+    and invoices are issued for the synthetic booking history first and
+    then for bookings made during the run.
+    """
+
+    def __init__(self, db_path: str, seed: int):
+        self.rng = random.Random(seed)
+        conn = sqlite3.connect(db_path)
+        self.routes = conn.execute(
+            "SELECT departure_location, arrival_location, departure_date FROM fare_summary"
+        ).fetchall()
+        self.flight_ids = [row[0] for row in conn.execute(
+            "SELECT id FROM flight_info WHERE seats_available > 0"
+        )]
+        self.pending_invoices = conn.execute(
+            "SELECT rowid, customer_id, flight_id, payment_amount, card_last_four FROM bookings ORDER BY rowid"
+        ).fetchall()
+        conn.close()
+        self.pending_invoices.reverse()
+
+    def search_flights(self) -> Dict:
+        departure, arrival, day = self.rng.choice(self.routes)
+        return {"departure_location": departure, "arrival_location": arrival, "departure_date": day}
+
+    def book_flight(self) -> Dict:
+        return {
+            "customer_id": f"BENCH{self.rng.randrange(100000):05d}",
+            "flight_id": self.rng.choice(self.flight_ids),
+            "credit_card_number": "4111111111111111",
+            "credit_card_expiry": "12/99",
+            "credit_card_cvv": "123",
+        }
+
+    def record_booking(self, arguments: Dict, response: Dict) -> None:
+        self.pending_invoices.append((
+            response["booking_id"], arguments["customer_id"], arguments["flight_id"],
+            response["details"]["payment_amount"], arguments["credit_card_number"][-4:],
+        ))
+
+    def generate_invoice(self) -> Optional[Dict]:
+        if not self.pending_invoices:
+            return None
+        booking_id, customer_id, flight_id, amount, card = self.pending_invoices.pop()
+        return {
+            "customer_id": customer_id, "flight_id": flight_id, "booking_id": booking_id,
+            "payment_amount": amount, "card_last_four": card,
+        }
+
+
+def decode(result) -> Dict:
+    """Turn a CallToolResult into the tool's returned dictionary."""
+    if result.isError:
+        text = result.content[0].text if result.content else "tool error"
+        return {"error": text}
+    return json.loads(result.content[0].text)
+
+
+async def run_level(sessions: Dict[str, ClientSession], workload: Workload, weights: Dict[str, float],
+                    concurrency: int, duration: float, max_requests: Optional[int]) -> Dict:
+    """Keep `concurrency` requests in flight for `duration` seconds (or max_requests calls)."""
+    tools = list(weights)
+    tool_weights = [weights[tool] for tool in tools]
+    latencies: Dict[str, List[float]] = {tool: [] for tool in tools}
+    errors: Dict[str, int] = {tool: 0 for tool in tools}
+    error_samples: Dict[str, str] = {}
+    issued = 0
+    deadline = time.perf_counter() + duration
+
+    async def client() -> None:
+        nonlocal issued
+        while time.perf_counter() < deadline and (max_requests is None or issued < max_requests):
+            issued += 1
+            tool = workload.rng.choices(tools, tool_weights)[0]
+            arguments = getattr(workload, tool)()
+            if arguments is None:
+                # Nothing left to invoice; fall back to a search
+                tool, arguments = "search_flights", workload.search_flights()
+                latencies.setdefault(tool, [])
+                errors.setdefault(tool, 0)
+            session = sessions["invoice" if tool == "generate_invoice" else "flight"]
+            started = time.perf_counter()
+            try:
+                response = decode(await session.call_tool(tool, arguments))
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            latencies[tool].append(time.perf_counter() - started)
+            if "error" in response:
+                errors[tool] += 1
+                error_samples.setdefault(tool, str(response["error"])[:200])
+            elif tool == "book_flight":
+                workload.record_booking(arguments, response)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        **summarize(all_latencies, sum(errors.values()), elapsed),
+        "tools": {tool: summarize(latencies[tool], errors[tool], elapsed) for tool in latencies if latencies[tool]},
+        "error_samples": error_samples,
+    }
+
+
+async def run_benchmark(workdir: str, args) -> List[Dict]:
+    weights = parse_mix(args.mix)
+    workload = Workload(os.path.join(workdir, "data", "flights.db"), args.seed)
+
+    def server(script: str) -> StdioServerParameters:
+        return StdioServerParameters(command=sys.executable, args=[os.path.join(REPO_ROOT, script)], cwd=workdir)
+
+    with open(os.path.join(workdir, "servers.log"), "w") as errlog:
+        async with stdio_client(server("flight_mcp_server.py"), errlog=errlog) as (flight_read, flight_write), \
+                stdio_client(server("invoice_server.py"), errlog=errlog) as (invoice_read, invoice_write), \
+                ClientSession(flight_read, flight_write) as flight_session, \
+                ClientSession(invoice_read, invoice_write) as invoice_session:
+            await flight_session.initialize()
+            await invoice_session.initialize()
+            sessions = {"flight": flight_session, "invoice": invoice_session}
+
+            if args.warmup > 0:
+                await run_level(sessions, workload, weights, 1, args.warmup, None)
+
+            levels = []
+            for concurrency in args.concurrency:
+                level = await run_level(sessions, workload, weights, concurrency, args.duration, args.requests)
+                levels.append(level)
+                print(f"concurrency {concurrency:>4}: {level['throughput_rps']:>9} req/s  "
+                      f"p50 {level['latency_ms']['p50']} ms  p95 {level['latency_ms']['p95']} ms  "
+                      f"p99 {level['latency_ms']['p99']} ms  errors {level['error_rate']:.2%}", file=sys.stderr)
+            return levels
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted tool mix, e.g. " + DEFAULT_MIX)
+    parser.add_argument("--concurrency", default="1,4,16",
+                        type=lambda value: [int(level) for level in value.split(",")],
+                        help="comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per concurrency level")
+    parser.add_argument("--requests", type=int, default=None, help="stop each level after this many requests")
+    parser.add_argument("--warmup", type=float, default=2.0, help="warm-up seconds before measuring")
+    parser.add_argument("--cities", type=int, default=50, help="cities in the generated schedule")
+    parser.add_argument("--days", type=int, default=30, help="days in the generated schedule")
+    parser.add_argument("--density", type=float, default=0.3, help="city-pair density of the schedule")
+    parser.add_argument("--bookings", type=int, default=5000, help="booking history available to invoice")
+    parser.add_argument("--seed", type=int, default=42, help="seed for the schedule and the request mix")
+    parser.add_argument("--workdir", default=None, help="keep the database, invoices and server log here")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="replace a flight database already in --workdir (its bookings are lost)")
+    parser.add_argument("--output", default=None, help="write results as JSON to this file")
+    args = parser.parse_args()
+    # The schedule is regenerated from scratch, so never do that to a real
+    # deployment by accident
+    if args.workdir and os.path.exists(os.path.join(args.workdir, "data", "flights.db")) and not args.overwrite:
+        parser.error(f"{args.workdir} already holds data/flights.db; pass --overwrite to replace it")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_mcp_")
+    try:
+        database = generate_database(
+            os.path.join(workdir, "data", "flights.db"), args.cities, days=args.days, density=args.density,
+            seed=args.seed, bookings=args.bookings, fresh=True, verbose=False,
+        )
+        levels = asyncio.run(run_benchmark(workdir, args))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "benchmark": "mcp_load",
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": {
+            "mix": parse_mix(args.mix),
+            "duration": args.duration,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "seed": args.seed,
+        },
+        "database": {key: database[key] for key in ("flights", "bookings", "cities", "airlines")},
+        "levels": levels,
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import json
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.messages.utils import count_tokens_approximately
+
+# Id of the system message that carries trimmed context forward
+SUMMARY_ID = "history-summary"
+
+# Fields of book_flight / generate_invoice results kept as booking facts
+FACT_FIELDS = (
+    "booking_id", "customer_id", "flight_id", "invoice_number", "payment_amount", "status",
+    "flight_number", "airline", "departure", "destination", "date", "departure_time", "filename",
+)
+
+# Flights kept when a search result is compacted
+FLIGHT_PREVIEW = 3
+FLIGHT_PREVIEW_FIELDS = ("flight_id", "flight_number", "airline", "departure_time", "arrival_time", "price",
+                         "seats_available")
+
+
+def message_text(message: BaseMessage) -> str:
+    """Plain text of a message, joining content blocks."""
+    content = message.content
+    if isinstance(content, str):
+        return content
+    parts = []
+    for block in content:
+        if isinstance(block, str):
+            parts.append(block)
+        elif isinstance(block, dict) and block.get("type") == "text":
+            parts.append(block.get("text", ""))
+    return "".join(parts)
+
+
+def _tool_result(message: ToolMessage) -> Optional[Dict]:
+    try:
+        result = json.loads(message_text(message))
+    except ValueError:
+        return None
+    return result if isinstance(result, dict) else None
+
+
+def _fact(result: Dict) -> Optional[Dict]:
+    """Booking facts in a tool result: its top-level and "details" fields."""
+    if "booking_id" not in result and "invoice_number" not in result:
+        return None
+    fields = dict(result.get("details") or {})
+    fields.update({key: value for key, value in result.items() if key != "details"})
+    fact = {key: fields[key] for key in FACT_FIELDS if fields.get(key) is not None}
+    return fact or None
+
+
+class EarlierBookings:
+    """IDs of bookings and invoices whose facts were trimmed, oldest first, plus a count of older ones."""
+
+    def __init__(self, ids: Sequence[str] = (), count: int = 0):
+        self.ids = list(ids)
+        self.count = count
+
+    def __bool__(self) -> bool:
+        return bool(self.ids or self.count)
+
+    def add(self, key: str) -> None:
+        """Record a trimmed ID as the newest."""
+        if key in self.ids:
+            self.ids.remove(key)
+        self.ids.append(key)
+
+    def discard(self, keys: Iterable[str]) -> None:
+        """Drop IDs that are listed in full again."""
+        self.ids = [key for key in self.ids if key not in keys]
+
+    def trim(self, limit: int) -> None:
+        """Keep the newest limit IDs and count the rest."""
+        if len(self.ids) > limit:
+            self.count += len(self.ids) - limit
+            self.ids = self.ids[len(self.ids) - limit:]
+
+
+class HistoryManager:
+    """
+    Keeps the messages sent to the model within a token budget.
+
+    The leading system prompt is always sent. Large tool results from
+    earlier turns, such as full flight lists, are compacted to a short
+    preview. If the history is still over budget, the oldest turns are
+    dropped whole, so tool calls stay paired with their results. What
+    they contained is carried forward in one summary system message:
+    the user's earlier requests, the full facts of the most recent
+    bookings and invoices, and the IDs of older ones. The summary is
+    capped at a fixed share of the budget and gives up detail, oldest
+    first, to stay within it, so it never crowds out the recent turns.
+    Trimming is deterministic and makes no model calls. prepare() is
+    idempotent, so its output can be stored back as the conversation
+    state and the per-turn cost stays flat as sessions get longer.
+    """
+
+    def __init__(self, max_tokens: int = 6000, max_tool_result_tokens: int = 400, keep_full_turns: int = 2,
+                 max_earlier_requests: int = 20, max_booking_facts: int = 10, max_earlier_bookings: int = 50,
+                 summary_share: float = 0.25,
+                 token_counter: Callable[[Sequence[BaseMessage]], int] = count_tokens_approximately):
+        """
+        Args:
+            max_tokens: Token budget for the messages sent to the model
+            max_tool_result_tokens: Tool results larger than this are
+                compacted once they are older than keep_full_turns turns
+            keep_full_turns: Number of most recent turns whose tool results
+                are sent in full (the model may refer back to them)
+            max_earlier_requests: Number of trimmed user requests listed in
+                the summary
+            max_booking_facts: Number of most recent bookings and invoices
+                whose facts are listed in full in the summary
+            max_earlier_bookings: Number of older booking and invoice IDs
+                listed in the summary; older ones are only counted
+            summary_share: Largest share of max_tokens the summary may use
+            token_counter: Counts the tokens of a list of messages
+        """
+        self.max_tokens = max_tokens
+        self.max_tool_result_tokens = max_tool_result_tokens
+        self.keep_full_turns = keep_full_turns
+        self.max_earlier_requests = max_earlier_requests
+        self.max_booking_facts = max_booking_facts
+        self.max_earlier_bookings = max_earlier_bookings
+        self.summary_share = summary_share
+        self.token_counter = token_counter
+
+    def prepare(self, messages: Sequence[BaseMessage]) -> List[BaseMessage]:
+        """
+        Return the messages to send to the model.
+
+        Args:
+            messages: The conversation so far, starting with the system prompt
+
+        Returns:
+            System prompt, an optional summary message and the most recent
+            turns, within the token budget where possible
+        """
+        system: List[BaseMessage] = []
+        facts: Dict[str, Dict] = {}
+        earlier: List[str] = []
+        bookings = EarlierBookings()
+        body: List[BaseMessage] = []
+        for message in messages:
+            if message.id == SUMMARY_ID:
+                facts.update(message.additional_kwargs.get("booking_facts", {}))
+                earlier = list(message.additional_kwargs.get("earlier_requests", []))
+                bookings = EarlierBookings(message.additional_kwargs.get("earlier_bookings", []),
+                                    message.additional_kwargs.get("earlier_booking_count", 0))
+            elif isinstance(message, SystemMessage) and not body:
+                system.append(message)
+            else:
+                body.append(message)
+
+        # A turn starts at each user message
+        turns: List[List[BaseMessage]] = []
+        for message in body:
+            if isinstance(message, HumanMessage) or not turns:
+                turns.append([])
+            turns[-1].append(message)
+
+        for message in body:
+            if isinstance(message, ToolMessage):
+                result = _tool_result(message)
+                fact = _fact(result) if result else None
+                if fact:
+                    key = str(fact.get("booking_id", fact.get("invoice_number")))
+                    # Re-insert so the most recently seen facts come last
+                    facts[key] = {**facts.pop(key, {}), **fact}
+
+        # Only the most recent facts are kept in full; older ones keep their ID
+        while len(facts) > self.max_booking_facts:
+            oldest = next(iter(facts))
+            bookings.add(oldest)
+            del facts[oldest]
+        bookings.discard(facts)
+        bookings.trim(self.max_earlier_bookings)
+
+        cutoff = max(0, len(turns) - self.keep_full_turns)
+        turns = [[self._compact(m) for m in turn] if index < cutoff else turn for index, turn in enumerate(turns)]
+
+        fixed = self.token_counter(system)
+        turn_tokens = [self.token_counter(turn) for turn in turns]
+
+        def total() -> int:
+            return fixed + self.token_counter([self._summary(facts, earlier, bookings)]) + sum(turn_tokens)
+
+        # Drop the oldest turns, always keeping the current one
+        while len(turns) > 1 and total() > self.max_tokens:
+            dropped = turns.pop(0)
+            turn_tokens.pop(0)
+            if isinstance(dropped[0], HumanMessage):
+                earlier.append(message_text(dropped[0])[:200])
+                earlier = earlier[-self.max_earlier_requests:]
+
+        if total() > self.max_tokens:
+            # A single turn over budget: compact its tool results as well
+            turns = [[self._compact(m) for m in turn] for turn in turns]
+
+        prepared = list(system)
+        if facts or earlier or bookings:
+            prepared.append(self._summary(facts, earlier, bookings))
+        for turn in turns:
+            prepared.extend(turn)
+        return prepared
+
+    def _compact(self, message: BaseMessage) -> BaseMessage:
+        if not isinstance(message, ToolMessage) or message.additional_kwargs.get("compacted"):
+            return message
+        if self.token_counter([message]) <= self.max_tool_result_tokens:
+            return message
+
+        result = _tool_result(message)
+        if result is not None and isinstance(result.get("flights"), list):
+            flights = result["flights"]
+            preview = [{key: flight[key] for key in FLIGHT_PREVIEW_FIELDS if key in flight}
+                       for flight in flights[:FLIGHT_PREVIEW]]
+            content = json.dumps({
+                "flights": preview,
+                "omitted": len(flights) - len(preview) + (result.get("truncated") or 0),
+                "note": "Older result compacted; search again for the full list.",
+            })
+        else:
+            limit = self.max_tool_result_tokens * 4
+            content = message_text(message)[:limit] + " ... [truncated]"
+        return ToolMessage(
+            content=content, tool_call_id=message.tool_call_id, name=message.name, id=message.id,
+            additional_kwargs={"compacted": True},
+        )
+
+    def _summary(self, facts: Dict[str, Dict], earlier: List[str], bookings: EarlierBookings) -> SystemMessage:
+        """
+        Build the summary message within summary_share of the budget.
+
+        Over budget, detail goes oldest first: earlier requests, then the
+        older booking IDs (they are still counted), then full facts, which
+        are reduced to their IDs.
+        """
+        budget = int(self.max_tokens * self.summary_share)
+        facts = dict(facts)
+        bookings = EarlierBookings(bookings.ids, bookings.count)
+        while True:
+            summary = self._render(facts, earlier, bookings)
+            if self.token_counter([summary]) <= budget:
+                return summary
+            if earlier:
+                earlier = earlier[1:]
+            elif bookings.ids:
+                bookings.trim(len(bookings.ids) - 1)
+            elif facts:
+                oldest = next(iter(facts))
+                bookings.add(oldest)
+                del facts[oldest]
+            else:
+                return summary
+
+    @staticmethod
+    def _render(facts: Dict[str, Dict], earlier: List[str], bookings: EarlierBookings) -> SystemMessage:
+        lines = ["Summary of earlier conversation (older turns were trimmed to save context)."]
+        if earlier:
+            lines.append("Earlier user requests:")
+            lines.extend(f"- {request}" for request in earlier)
+        if bookings:
+            line = "Earlier bookings and invoices (details trimmed):"
+            if bookings.ids:
+                line += " " + ", ".join(bookings.ids)
+            if bookings.count:
+                line += f" and {bookings.count} older"
+            lines.append(line)
+        if facts:
+            lines.append("Booking facts (authoritative, use these IDs and amounts):")
+            for fact in facts.values():
+                lines.append("- " + ", ".join(f"{key}={value}" for key, value in fact.items()))
+        return SystemMessage(
+            content="\n".join(lines), id=SUMMARY_ID,
+            additional_kwargs={"booking_facts": facts, "earlier_requests": earlier,
+                               "earlier_bookings": bookings.ids, "earlier_booking_count": bookings.count},
+        )
+
@@ -0,0 +1,302 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import Dict, Iterable, List, Mapping, Optional
+from urllib.request import pathname2url
+
+from flight_db import FlightDatabase
+
+# Columns of flight_info, in table order
+FLIGHT_COLUMNS = (
+    "id", "flight_number", "airline", "departure_location", "arrival_location", "departure_date",
+    "departure_time", "arrival_time", "price", "seats_available",
+)
+
+# Flight columns a booking row carries once joined with its flight
+BOOKING_FLIGHT_COLUMNS = (
+    "flight_number", "airline", "departure_location", "arrival_location", "departure_date",
+    "departure_time", "arrival_time",
+)
+
+# One archive database per departure month holds that month's past flights
+# with their original ids. The catalog maps every archived flight id to its
+# month, so a lookup attaches only the archive it needs.
+ARCHIVE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS flight_info (
+    id INTEGER PRIMARY KEY,
+    flight_number TEXT NOT NULL,
+    airline TEXT NOT NULL,
+    departure_location TEXT NOT NULL,
+    arrival_location TEXT NOT NULL,
+    departure_date TEXT NOT NULL,
+    departure_time TEXT NOT NULL,
+    arrival_time TEXT NOT NULL,
+    price REAL NOT NULL,
+    seats_available INTEGER NOT NULL
+)
+'''
+
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS archived_flights (
+    flight_id INTEGER PRIMARY KEY,
+    month TEXT NOT NULL
+)
+'''
+
+CATALOG_FILENAME = "catalog.db"
+
+# SQLite allows 10 attached databases by default; stay below that
+MAX_ATTACHED = 8
+
+
+def archive_dir(db_path: str) -> str:
+    """Directory holding the archives of a flight database."""
+    return os.path.join(os.path.dirname(db_path), "archive")
+
+
+def archive_filename(month: str) -> str:
+    """Archive file of a YYYY-MM departure month."""
+    return f"flights_{month.replace('-', '_')}.db"
+
+
+class FlightArchive:
+    """
+    Read access to flights moved out of flight_info by archive_flights().
+
+    Lookups by flight id go to the catalog first, then to the monthly
+    archives holding those flights, which are attached on demand to one
+    private connection. The most recently used archives stay attached,
+    up to MAX_ATTACHED. Callers query flight_info first and only ask the
+    archive for the flights it did not have; archive_flights() copies a
+    flight to its archive before deleting it, so every flight is always
+    found in one of the two. Thread-safe.
+    """
+
+    def __init__(self, db_path: str, max_attached: int = MAX_ATTACHED):
+        self.directory = archive_dir(db_path)
+        self.max_attached = max_attached
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._attached: "OrderedDict[str, str]" = OrderedDict()
+        self.lookups = 0
+        self.attaches = 0
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        if self._conn is None:
+            path = os.path.join(self.directory, CATALOG_FILENAME)
+            if not os.path.exists(path):
+                return None
+            uri = f"file:{pathname2url(os.path.abspath(path))}?mode=ro"
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+        return self._conn
+
+    def _attach(self, conn: sqlite3.Connection, month: str) -> str:
+        schema = self._attached.get(month)
+        if schema is not None:
+            self._attached.move_to_end(month)
+            return schema
+        if len(self._attached) >= self.max_attached:
+            _, oldest = self._attached.popitem(last=False)
+            conn.execute(f"DETACH DATABASE {oldest}")
+        schema = f"archive_{month.replace('-', '_')}"
+        path = os.path.abspath(os.path.join(self.directory, archive_filename(month)))
+        conn.execute(f"ATTACH DATABASE ? AS {schema}", (f"file:{pathname2url(path)}?mode=ro",))
+        self._attached[month] = schema
+        self.attaches += 1
+        return schema
+
+    def find_flights(self, flight_ids: Iterable[int]) -> Dict[int, sqlite3.Row]:
+        """Return the archived flights among flight_ids, keyed by id."""
+        flight_ids = sorted(set(flight_ids))
+        if not flight_ids:
+            return {}
+        flights = {}
+        with self._lock:
+            conn = self._connection()
+            if conn is None:
+                return {}
+            self.lookups += 1
+            months: Dict[str, List[int]] = {}
+            # Stay well below SQLite's bound parameter limit
+            for start in range(0, len(flight_ids), 500):
+                chunk = flight_ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                for flight_id, month in conn.execute(
+                    f"SELECT flight_id, month FROM archived_flights WHERE flight_id IN ({placeholders})", chunk
+                ):
+                    months.setdefault(month, []).append(flight_id)
+            for month, ids in sorted(months.items()):
+                schema = self._attach(conn, month)
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    for row in conn.execute(
+                        f"SELECT * FROM {schema}.flight_info WHERE id IN ({placeholders})", chunk
+                    ):
+                        flights[row["id"]] = row
+        return flights
+
+    def with_flights(self, bookings: List[Mapping]) -> List[Dict]:
+        """
+        Fill in the flight columns of bookings whose flight has been archived.
+
+        Args:
+            bookings: Booking rows left-joined with flight_info; a NULL
+                flight_number marks a flight that was not found there
+
+        Returns:
+            The bookings as dicts, with the archived flights' columns set
+        """
+        items = [dict(booking) for booking in bookings]
+        missing = [item["flight_id"] for item in items if item.get("flight_number") is None and item.get("flight_id")]
+        if not missing:
+            return items
+        flights = self.find_flights(missing)
+        for item in items:
+            flight = flights.get(item["flight_id"]) if item.get("flight_number") is None else None
+            if flight is not None:
+                for column in BOOKING_FLIGHT_COLUMNS:
+                    if column in item:
+                        item[column] = flight[column]
+        return items
+
+    def stats(self) -> Dict:
+        """Return attached archives and lookup counters."""
+        with self._lock:
+            return {
+                "attached_months": list(self._attached),
+                "lookups": self.lookups,
+                "attaches": self.attaches,
+            }
+
+
+_shared: Dict[str, FlightArchive] = {}
+_shared_lock = threading.Lock()
+
+
+def shared_archive(db_path: str) -> FlightArchive:
+    """Return the process-wide FlightArchive for a database path, creating it on first use."""
+    key = os.path.abspath(db_path)
+    with _shared_lock:
+        archive = _shared.get(key)
+        if archive is None:
+            archive = _shared[key] = FlightArchive(db_path)
+        return archive
+
+
+def _open_archive(path: str, schema: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(schema)
+    return conn
+
+
+def archive_flights(db: FlightDatabase, before: str, batch_size: int = 5000, verbose: bool = True) -> Dict:
+    """
+    Move flights departing before a date from flight_info to monthly archives.
+
+    Runs incrementally: each batch is copied to its archives and the catalog,
+    which are committed before the same flights are deleted from flight_info
+    in one short write transaction. Interrupting the job loses nothing, and
+    running it again picks up where it stopped. Bookings and invoices stay in
+    the main database and keep referring to the archived flights by id.
+
+    Args:
+        db: The flight database
+        before: First departure date to keep, YYYY-MM-DD
+        batch_size: Flights moved per write transaction
+        verbose: Print progress after every batch
+
+    Returns:
+        Dictionary with the number of flights archived per month and timings
+    """
+    started = time.perf_counter()
+    with db.reader() as conn:
+        flight_ids = [row[0] for row in conn.execute(
+            "SELECT id FROM flight_info WHERE departure_date < ? ORDER BY id", (before,)
+        )]
+
+    directory = archive_dir(db.path)
+    os.makedirs(directory, exist_ok=True)
+    catalog = _open_archive(os.path.join(directory, CATALOG_FILENAME), CATALOG_SCHEMA)
+    archives: Dict[str, sqlite3.Connection] = {}
+    archived: Dict[str, int] = {}
+    columns = ", ".join(FLIGHT_COLUMNS)
+    insert = f"INSERT OR REPLACE INTO flight_info ({columns}) VALUES ({', '.join('?' * len(FLIGHT_COLUMNS))})"
+
+    def move(conn: sqlite3.Connection, chunk: List[int]) -> Dict[str, int]:
+        placeholders = ",".join("?" * len(chunk))
+        # Re-read inside the write transaction so seat changes made since
+        # the id scan are archived too
+        rows = conn.execute(
+            f"SELECT {columns} FROM flight_info WHERE id IN ({placeholders}) AND departure_date < ?",
+            chunk + [before]
+        ).fetchall()
+        by_month: Dict[str, List[tuple]] = {}
+        for row in rows:
+            by_month.setdefault(row["departure_date"][:7], []).append(tuple(row))
+        for month, month_rows in by_month.items():
+            archive = archives.get(month)
+            if archive is None:
+                archive = archives[month] = _open_archive(
+                    os.path.join(directory, archive_filename(month)), ARCHIVE_SCHEMA
+                )
+            with archive:
+                archive.executemany(insert, month_rows)
+        with catalog:
+            catalog.executemany(
+                "INSERT OR REPLACE INTO archived_flights (flight_id, month) VALUES (?, ?)",
+                [(row[0], month) for month, month_rows in by_month.items() for row in month_rows]
+            )
+        moved = [row["id"] for row in rows]
+        conn.executemany("DELETE FROM flight_info WHERE id = ?", [(flight_id,) for flight_id in moved])
+        return {month: len(month_rows) for month, month_rows in by_month.items()}
+
+    try:
+        for start in range(0, len(flight_ids), batch_size):
+            chunk = flight_ids[start:start + batch_size]
+            for month, count in db.transaction(lambda conn: move(conn, chunk)).items():
+                archived[month] = archived.get(month, 0) + count
+            if verbose:
+                print(f"  {min(start + batch_size, len(flight_ids)):,} of {len(flight_ids):,} flights archived")
+    finally:
+        for archive in archives.values():
+            archive.close()
+        catalog.close()
+
+    return {
+        "before": before,
+        "flights": sum(archived.values()),
+        "months": dict(sorted(archived.items())),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Move past flights into monthly archive databases.")
+    parser.add_argument("--db-path", default=os.path.join('data', 'flights.db'), help="database file")
+    parser.add_argument("--before", default=None, help="archive flights departing before this date, YYYY-MM-DD "
+                                                      "(default: today)")
+    parser.add_argument("--batch-size", type=int, default=5000, help="flights moved per write transaction")
+    args = parser.parse_args()
+
+    before = args.before or date.today().isoformat()
+    db = FlightDatabase(args.db_path)
+    try:
+        stats = archive_flights(db, before, args.batch_size)
+    finally:
+        db.close()
+
+    print(f"Archived {stats['flights']:,} flights departing before {before} in {stats['seconds']}s")
+    for month, count in stats["months"].items():
+        print(f"  {month}: {count:,} flights -> {os.path.join(archive_dir(args.db_path), archive_filename(month))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+
+from metrics import metrics
+
+
+class SearchCache:
+    """
+    Bounded LRU cache with a TTL for search results.
+
+    Entries are invalidated explicitly by the write path. Commits made
+    elsewhere are detected through PRAGMA data_version and applied per key
+    with apply_changes(). Thread-safe.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 120.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every invalidation; a result computed before an
+        # invalidation must not be stored after it.
+        self._generation = 0
+        self._data_version: Optional[int] = None
+        # Flight change log position the cache has caught up to
+        self.log_position: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Tuple[Optional[Any], int]:
+        """
+        Look up a key.
+
+        Returns:
+            The cached value (or None on a miss) and a generation token to
+            pass to put() when storing a freshly computed value
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value, self._generation
+                del self._entries[key]
+            self.misses += 1
+            return None, self._generation
+
+    def put(self, key: Hashable, value: Any, generation: int) -> None:
+        """Store a value unless the cache was invalidated since generation was issued."""
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *keys: Hashable) -> None:
+        """Drop the given keys."""
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self) -> None:
+        """Drop every entry."""
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def data_version_changed(self, data_version: int) -> bool:
+        """
+        Whether the database's PRAGMA data_version differs from the one
+        recorded by the last apply_changes(), i.e. whether someone committed
+        since, or no value was recorded yet.
+        """
+        with self._lock:
+            return self._data_version != data_version
+
+    def apply_changes(self, position: int, keys: Optional[Iterable[Hashable]],
+                      data_version: Optional[int] = None) -> None:
+        """
+        Drop the keys affected by change log entries up to position.
+
+        Args:
+            position: Change log position the keys were read at; older
+                positions than the one already applied are ignored
+            keys: Keys to drop, or None to drop every entry
+            data_version: PRAGMA data_version read before the change log,
+                recorded as caught up to
+        """
+        with self._lock:
+            if data_version is not None:
+                self._data_version = data_version
+            if self.log_position is not None and position <= self.log_position:
+                return
+            first = self.log_position is None
+            self.log_position = position
+        if first:
+            return
+        if keys is None:
+            self.clear()
+        else:
+            self.invalidate(*keys)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,342 @@
+import threading
+from datetime import date
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+
+from flight_db import FlightDatabase, SORT_KEYS, read_flight_changes, change_log_position
+
+if TYPE_CHECKING:
+    import numpy as np
+
+MINUTES_PER_DAY = 24 * 60
+
+# Dates as proleptic Gregorian ordinals (date.toordinal()) and clock times as
+# minutes after midnight, computed by SQLite while the rows are read.
+COLUMNS_SQL = '''
+    SELECT id, flight_number, airline, departure_location, arrival_location,
+           CAST(julianday(departure_date) - 1721424.5 AS INTEGER),
+           CAST(substr(departure_time, 1, 2) AS INTEGER) * 60 + CAST(substr(departure_time, 4, 2) AS INTEGER),
+           CAST(substr(arrival_time, 1, 2) AS INTEGER) * 60 + CAST(substr(arrival_time, 4, 2) AS INTEGER),
+           price, seats_available
+    FROM flight_info
+'''
+
+# NumPy dtype names, so the module can be imported without NumPy
+COLUMN_TYPES = {
+    "id": "int64",
+    "flight_number": "object",
+    "airline": "int32",
+    "origin": "int32",
+    "destination": "int32",
+    "day": "int32",
+    "departs": "int16",
+    "arrives": "int16",
+    "duration": "int16",
+    "price": "float64",
+    "seats": "int32",
+    "alive": "bool",
+}
+
+# Deleted rows are only marked dead; the columns are compacted once this
+# share of the rows is dead.
+MAX_DEAD_FRACTION = 0.25
+
+
+class Categories:
+    """Dense integer codes for a set of names, such as cities or airlines."""
+
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+        self.names: List[str] = []
+
+    def encode(self, name: str) -> int:
+        code = self.codes.get(name)
+        if code is None:
+            code = self.codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def lookup(self, names: Sequence[str], kind: str) -> "np.ndarray":
+        """
+        Codes of known names.
+
+        Raises:
+            ValueError: If a name has never been seen
+        """
+        unknown = [name for name in names if name not in self.codes]
+        if unknown:
+            raise ValueError(f"Unknown {kind}: {', '.join(unknown)}")
+        import numpy as np
+        return np.array([self.codes[name] for name in names], dtype=np.int32)
+
+
+class FlightColumns:
+    """
+    Columnar in-memory snapshot of flight_info for ad-hoc filtering.
+
+    Every flight is a row position in a set of NumPy arrays. Cities and
+    airlines are stored as integer category codes, dates as ordinals and
+    clock times as minutes after midnight, so a filter over the whole
+    schedule is a handful of vectorized comparisons and the best k matches
+    are picked with a partial sort instead of sorting every match. Like
+    RouteGraph, the snapshot is built from flight_info on first use and
+    afterwards kept current from the flight_changes log: changed flights
+    are overwritten in place, new ones appended and deleted ones marked
+    dead until the next compaction. NumPy is imported when the snapshot is
+    first built, so servers that never filter flights do not load it.
+    """
+
+    def __init__(self, db: FlightDatabase):
+        self.db = db
+        self._lock = threading.Lock()
+        self._columns: Dict[str, "np.ndarray"] = {}
+        self._size = 0
+        self._dead = 0
+        self._row_of: Dict[int, int] = {}
+        self.cities = Categories()
+        self.airlines = Categories()
+        self._position: Optional[int] = None
+        self.rebuilds = 0
+        self.incremental_refreshes = 0
+        self.compactions = 0
+
+    def refresh(self) -> None:
+        """Bring the snapshot up to date with the database."""
+        with self._lock:
+            with self.db.reader() as conn:
+                # One read transaction so the change log position and the
+                # flights read match the same snapshot.
+                conn.execute("BEGIN")
+                if self._position is None:
+                    self._rebuild(conn)
+                    return
+                position, changed = read_flight_changes(conn, self._position)
+                if changed is None:
+                    self._rebuild(conn)
+                    return
+                if changed:
+                    self._apply_changes(conn, changed)
+                    self.incremental_refreshes += 1
+                self._position = position
+
+    def _allocate(self, capacity: int) -> None:
+        import numpy as np
+        columns = {}
+        for name, dtype in COLUMN_TYPES.items():
+            column = np.zeros(capacity, dtype=dtype)
+            old = self._columns.get(name)
+            if old is not None:
+                column[:self._size] = old[:self._size]
+            columns[name] = column
+        self._columns = columns
+
+    def _encode(self, rows: List[Tuple]) -> Dict[str, "np.ndarray"]:
+        """Convert flight rows read with COLUMNS_SQL into column values."""
+        import numpy as np
+        (ids, flight_numbers, airlines, origins, destinations,
+         days, departs, arrives, prices, seats) = zip(*rows)
+        count = len(rows)
+        values = {
+            "id": np.fromiter(ids, np.int64, count),
+            "flight_number": np.array(flight_numbers, dtype=object),
+            "airline": np.fromiter(map(self.airlines.encode, airlines), np.int32, count),
+            "origin": np.fromiter(map(self.cities.encode, origins), np.int32, count),
+            "destination": np.fromiter(map(self.cities.encode, destinations), np.int32, count),
+            "day": np.fromiter(days, np.int32, count),
+            "departs": np.fromiter(departs, np.int16, count),
+            "arrives": np.fromiter(arrives, np.int16, count),
+            "price": np.fromiter(prices, np.float64, count),
+            "seats": np.fromiter(seats, np.int32, count),
+            "alive": np.ones(count, dtype=np.bool_),
+        }
+        # The schedule only stores clock times; an arrival earlier than the
+        # departure lands the next day.
+        duration = values["arrives"] - values["departs"]
+        duration[duration <= 0] += MINUTES_PER_DAY
+        values["duration"] = duration
+        return values
+
+    def _rebuild(self, conn) -> None:
+        self._position = change_log_position(conn)
+        self.cities = Categories()
+        self.airlines = Categories()
+        self._columns = {}
+        self._size = self._dead = 0
+        rows = conn.execute(COLUMNS_SQL + " ORDER BY id").fetchall()
+        self._allocate(len(rows))
+        if rows:
+            for name, values in self._encode(rows).items():
+                self._columns[name][:] = values
+        self._size = len(rows)
+        self._row_of = dict(zip(self._columns["id"].tolist(), range(self._size)))
+        self.rebuilds += 1
+
+    def _apply_changes(self, conn, flight_ids: List[int]) -> None:
+        import numpy as np
+        rows = []
+        # Stay well below SQLite's bound parameter limit
+        for start in range(0, len(flight_ids), 500):
+            chunk = flight_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows += conn.execute(f"{COLUMNS_SQL} WHERE id IN ({placeholders})", chunk).fetchall()
+
+        # Deleted flights: mark their rows dead
+        present = {row[0] for row in rows}
+        for flight_id in flight_ids:
+            if flight_id not in present:
+                position = self._row_of.pop(flight_id, None)
+                if position is not None:
+                    self._columns["alive"][position] = False
+                    self._dead += 1
+
+        if rows:
+            # Changed flights are overwritten in place, new ones appended
+            positions = []
+            size = self._size
+            for row in rows:
+                position = self._row_of.get(row[0])
+                if position is None:
+                    position = self._row_of[row[0]] = size
+                    size += 1
+                positions.append(position)
+            capacity = len(self._columns["id"])
+            if size > capacity:
+                self._allocate(max(size, 2 * capacity))
+            self._size = size
+            positions = np.array(positions, dtype=np.int64)
+            for name, values in self._encode(rows).items():
+                self._columns[name][positions] = values
+
+        if self._dead > MAX_DEAD_FRACTION * self._size:
+            self._compact()
+
+    def _compact(self) -> None:
+        keep = self._columns["alive"][:self._size]
+        self._columns = {name: column[:self._size][keep] for name, column in self._columns.items()}
+        self._size = len(self._columns["id"])
+        self._dead = 0
+        self._row_of = dict(zip(self._columns["id"].tolist(), range(self._size)))
+        self.compactions += 1
+
+    def filter(self, origins: Optional[Sequence[str]] = None, destinations: Optional[Sequence[str]] = None,
+               first_day: Optional[date] = None, last_day: Optional[date] = None,
+               min_price: Optional[float] = None, max_price: Optional[float] = None,
+               departs_after: Optional[int] = None, departs_before: Optional[int] = None,
+               max_duration: Optional[int] = None, airlines: Optional[Sequence[str]] = None,
+               exclude_airlines: Optional[Sequence[str]] = None, min_seats: int = 1,
+               sort_by: str = "price", limit: int = 20) -> Tuple[int, List[Dict]]:
+        """
+        Find the best flights matching every given condition.
+
+        Args:
+            origins: Departure cities, any of which matches
+            destinations: Destination cities, any of which matches
+            first_day: Earliest departure date
+            last_day: Latest departure date
+            min_price: Lowest fare
+            max_price: Highest fare
+            departs_after: Earliest departure, in minutes after midnight
+            departs_before: Latest departure, in minutes after midnight; a
+                window with departs_after > departs_before spans midnight
+            max_duration: Longest flight time in minutes
+            airlines: Airlines, any of which matches
+            exclude_airlines: Airlines that never match; unknown names are ignored
+            min_seats: Fewest seats that must still be available
+            sort_by: "price", "duration" or "departure"
+            limit: Number of flights to return
+
+        Returns:
+            The number of matching flights and the best `limit` of them,
+            ordered best first with ties broken by flight id
+
+        Raises:
+            ValueError: If an origin, destination or airline is unknown
+        """
+        if sort_by not in SORT_KEYS:
+            raise ValueError(f"sort_by must be one of {', '.join(SORT_KEYS)}")
+        import numpy as np
+        with self._lock:
+            size = self._size
+            columns = {name: column[:size] for name, column in self._columns.items()}
+
+            mask = columns["alive"] & (columns["seats"] >= min_seats)
+            if origins:
+                mask &= np.isin(columns["origin"], self.cities.lookup(origins, "departure location"))
+            if destinations:
+                mask &= np.isin(columns["destination"], self.cities.lookup(destinations, "arrival location"))
+            if airlines:
+                mask &= np.isin(columns["airline"], self.airlines.lookup(airlines, "airline"))
+            if exclude_airlines:
+                excluded = [self.airlines.codes[name] for name in exclude_airlines if name in self.airlines.codes]
+                mask &= ~np.isin(columns["airline"], excluded)
+            if first_day is not None:
+                mask &= columns["day"] >= first_day.toordinal()
+            if last_day is not None:
+                mask &= columns["day"] <= last_day.toordinal()
+            if min_price is not None:
+                mask &= columns["price"] >= min_price
+            if max_price is not None:
+                mask &= columns["price"] <= max_price
+            if departs_after is not None and departs_before is not None and departs_after > departs_before:
+                mask &= (columns["departs"] >= departs_after) | (columns["departs"] <= departs_before)
+            else:
+                if departs_after is not None:
+                    mask &= columns["departs"] >= departs_after
+                if departs_before is not None:
+                    mask &= columns["departs"] <= departs_before
+            if max_duration is not None:
+                mask &= columns["duration"] <= max_duration
+
+            matches = np.flatnonzero(mask)
+            if sort_by == "price":
+                keys = columns["price"][matches]
+            elif sort_by == "duration":
+                keys = columns["duration"][matches]
+            else:
+                keys = columns["day"][matches].astype(np.int64) * MINUTES_PER_DAY + columns["departs"][matches]
+
+            best = matches
+            if len(matches) > limit:
+                # Keep everything up to the limit-th smallest key, so ties at
+                # the cut are still broken by flight id below.
+                threshold = np.partition(keys, limit - 1)[limit - 1]
+                within = keys <= threshold
+                best, keys = matches[within], keys[within]
+            order = np.lexsort((columns["id"][best], keys))[:limit]
+            flights = [self._to_dict(columns, position) for position in best[order]]
+        return len(matches), flights
+
+    def _to_dict(self, columns: Dict[str, "np.ndarray"], position: int) -> Dict:
+        day = int(columns["day"][position])
+        departs = int(columns["departs"][position])
+        arrives = int(columns["arrives"][position])
+        arrival_day = day + (departs + int(columns["duration"][position])) // MINUTES_PER_DAY
+        return {
+            "flight_number": columns["flight_number"][position],
+            "airline": self.airlines.names[columns["airline"][position]],
+            "departure_location": self.cities.names[columns["origin"][position]],
+            "arrival_location": self.cities.names[columns["destination"][position]],
+            "departure_date": date.fromordinal(day).isoformat(),
+            "departure_time": f"{departs // 60:02d}:{departs % 60:02d}",
+            "arrival_date": date.fromordinal(arrival_day).isoformat(),
+            "arrival_time": f"{arrives // 60:02d}:{arrives % 60:02d}",
+            "duration_minutes": int(columns["duration"][position]),
+            "price": float(columns["price"][position]),
+            "seats_available": int(columns["seats"][position]),
+            "flight_id": int(columns["id"][position]),
+        }
+
+    def stats(self) -> Dict:
+        """Return snapshot size, memory use and refresh counters."""
+        with self._lock:
+            return {
+                "flights": self._size - self._dead,
+                "dead_rows": self._dead,
+                "capacity": len(self._columns["id"]) if self._columns else 0,
+                "cities": len(self.cities.names),
+                "airlines": len(self.airlines.names),
+                "column_bytes": sum(column.nbytes for column in self._columns.values()),
+                "change_log_position": self._position,
+                "rebuilds": self.rebuilds,
+                "incremental_refreshes": self.incremental_refreshes,
+                "compactions": self.compactions,
+            }
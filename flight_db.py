@@ -0,0 +1,803 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+import random
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple, TypeVar
+from urllib.request import pathname2url
+
+from metrics import metrics
+
+T = TypeVar("T")
+
+def _refresh_fare_summary(row: str) -> str:
+    """Trigger statement recomputing the fare_summary entry of the OLD or NEW row."""
+    return f'''
+            INSERT OR REPLACE INTO fare_summary
+            SELECT {row}.departure_location, {row}.arrival_location, {row}.departure_date,
+                   MIN(price), COUNT(*)
+            FROM flight_info
+            WHERE departure_location = {row}.departure_location
+            AND arrival_location = {row}.arrival_location
+            AND departure_date = {row}.departure_date
+            AND seats_available > 0'''
+
+
+# Number of flight_changes entries kept for incremental index refreshes
+CHANGE_LOG_RETAIN = 10000
+
+# Orderings offered by filter_flights
+SORT_KEYS = ("price", "duration", "departure")
+
+
+# Schema version is stored in SQLite's PRAGMA user_version. Each entry below
+# upgrades the database from the previous version to the listed one; entries
+# must only ever be appended so existing databases can be migrated in place.
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, "base tables", [
+        '''
+        CREATE TABLE IF NOT EXISTS flight_info (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            flight_number TEXT NOT NULL,
+            airline TEXT NOT NULL,
+            departure_location TEXT NOT NULL,
+            arrival_location TEXT NOT NULL,
+            departure_date TEXT NOT NULL,
+            departure_time TEXT NOT NULL,
+            arrival_time TEXT NOT NULL,
+            price REAL NOT NULL,
+            seats_available INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS bookings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            customer_id TEXT NOT NULL,
+            flight_id INTEGER NOT NULL,
+            booking_date TEXT NOT NULL,
+            payment_amount REAL NOT NULL,
+            payment_status TEXT NOT NULL,
+            card_last_four TEXT NOT NULL,
+            FOREIGN KEY (flight_id) REFERENCES flight_info (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS invoices (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            booking_id INTEGER NOT NULL,
+            invoice_number TEXT NOT NULL,
+            invoice_date TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            FOREIGN KEY (booking_id) REFERENCES bookings (id)
+        )
+        ''',
+    ]),
+    (2, "covering index for route/date/price search", [
+        # Every column search_flights returns is part of the index (id is the
+        # rowid and comes for free), so the search never touches the table.
+        # The index can also yield a route's flights in price order, but when
+        # ANALYZE sees only a few flights per route and day the planner sorts
+        # them in a temporary b-tree instead.
+        '''
+        CREATE INDEX IF NOT EXISTS idx_flight_route_date_price ON flight_info (
+            departure_location, arrival_location, departure_date, price,
+            seats_available, flight_number, airline, departure_time, arrival_time
+        )
+        ''',
+    ]),
+    (3, "per-route/day fare summary maintained by triggers", [
+        '''
+        CREATE TABLE IF NOT EXISTS fare_summary (
+            departure_location TEXT NOT NULL,
+            arrival_location TEXT NOT NULL,
+            departure_date TEXT NOT NULL,
+            min_price REAL,
+            flights_available INTEGER NOT NULL,
+            PRIMARY KEY (departure_location, arrival_location, departure_date)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        INSERT OR REPLACE INTO fare_summary
+        SELECT departure_location, arrival_location, departure_date, MIN(price), COUNT(*)
+        FROM flight_info
+        WHERE seats_available > 0
+        GROUP BY departure_location, arrival_location, departure_date
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS fare_summary_after_insert
+        AFTER INSERT ON flight_info
+        BEGIN
+            {_refresh_fare_summary("NEW")};
+        END
+        ''',
+        # Most bookings only decrement a seat count that stays positive,
+        # which cannot change the summary, so the trigger skips them.
+        f'''
+        CREATE TRIGGER IF NOT EXISTS fare_summary_after_update
+        AFTER UPDATE OF departure_location, arrival_location, departure_date, price, seats_available
+        ON flight_info
+        WHEN NEW.price IS NOT OLD.price
+            OR (NEW.seats_available > 0) IS NOT (OLD.seats_available > 0)
+            OR NEW.departure_location IS NOT OLD.departure_location
+            OR NEW.arrival_location IS NOT OLD.arrival_location
+            OR NEW.departure_date IS NOT OLD.departure_date
+        BEGIN
+            {_refresh_fare_summary("OLD")};
+            {_refresh_fare_summary("NEW")};
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS fare_summary_after_delete
+        AFTER DELETE ON flight_info
+        BEGIN
+            {_refresh_fare_summary("OLD")};
+        END
+        ''',
+    ]),
+    (4, "flight change log for incremental in-memory indexes", [
+        '''
+        CREATE TABLE IF NOT EXISTS flight_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            flight_id INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS flight_changes_after_insert
+        AFTER INSERT ON flight_info
+        BEGIN
+            INSERT INTO flight_changes (flight_id) VALUES (NEW.id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS flight_changes_after_update
+        AFTER UPDATE ON flight_info
+        BEGIN
+            INSERT INTO flight_changes (flight_id) VALUES (NEW.id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS flight_changes_after_delete
+        AFTER DELETE ON flight_info
+        BEGIN
+            INSERT INTO flight_changes (flight_id) VALUES (OLD.id);
+        END
+        ''',
+        # The log only needs to cover the gap between two refreshes of an
+        # in-memory index; readers that fall further behind rebuild from
+        # flight_info, so older entries are pruned as new ones arrive.
+        f'''
+        CREATE TRIGGER IF NOT EXISTS flight_changes_prune
+        AFTER INSERT ON flight_changes
+        WHEN NEW.seq % 1000 = 0
+        BEGIN
+            DELETE FROM flight_changes WHERE seq <= NEW.seq - {CHANGE_LOG_RETAIN};
+        END
+        ''',
+    ]),
+    (5, "order the search index by (price, id) for keyset pagination", [
+        # id breaks price ties so a (price, id) cursor names exactly one
+        # position and the index still delivers rows pre-sorted.
+        '''
+        CREATE INDEX IF NOT EXISTS idx_flight_route_date_price_id ON flight_info (
+            departure_location, arrival_location, departure_date, price, id,
+            seats_available, flight_number, airline, departure_time, arrival_time
+        )
+        ''',
+        "DROP INDEX IF EXISTS idx_flight_route_date_price",
+    ]),
+    (6, "invoice job state for asynchronous rendering", [
+        # Rows written before this migration were rendered synchronously
+        "ALTER TABLE invoices ADD COLUMN status TEXT NOT NULL DEFAULT 'completed'",
+        "ALTER TABLE invoices ADD COLUMN error TEXT",
+        # Everything needed to render the invoice again after a restart
+        "ALTER TABLE invoices ADD COLUMN payload TEXT",
+        "ALTER TABLE invoices ADD COLUMN updated_at TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_invoices_number ON invoices (invoice_number)",
+        '''
+        CREATE INDEX IF NOT EXISTS idx_invoices_pending ON invoices (id)
+        WHERE status IN ('queued', 'rendering')
+        ''',
+    ]),
+    (7, "index invoices by booking for idempotent generation", [
+        "CREATE INDEX IF NOT EXISTS idx_invoices_booking ON invoices (booking_id)",
+    ]),
+    (8, "index bookings by customer for list_bookings", [
+        # Every index entry ends with the rowid, so (booking_date, rowid)
+        # keyset pages are read straight from the index in order.
+        "CREATE INDEX IF NOT EXISTS idx_bookings_customer_date ON bookings (customer_id, booking_date)",
+    ]),
+    (9, "location aliases for resolve_location", [
+        # Extra names for the locations in flight_info, on top of the
+        # built-in airport codes in flight_locations.py
+        '''
+        CREATE TABLE IF NOT EXISTS location_aliases (
+            alias TEXT PRIMARY KEY,
+            location TEXT NOT NULL
+        )
+        ''',
+    ]),
+    (10, "at most one live invoice per booking", [
+        # Earlier versions could invoice a booking twice (batch runs, two
+        # processes); keep the first invoice and retire the others
+        '''
+        UPDATE invoices SET status = 'failed', error = 'Superseded by an earlier invoice of the same booking'
+        WHERE status != 'failed' AND id NOT IN (
+            SELECT MIN(id) FROM invoices WHERE status != 'failed' GROUP BY booking_id
+        )
+        ''',
+        # Failed invoices may be retried, so they are left out of the index.
+        # It also serves INVOICE_FOR_BOOKING_SQL, replacing the plain index.
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_invoices_booking_issued ON invoices (booking_id)
+        WHERE status != 'failed'
+        ''',
+        "DROP INDEX IF EXISTS idx_invoices_booking",
+    ]),
+    (11, "record the route of every flight change", [
+        # A cached search is keyed by route and date. An update that moves a
+        # flight logs the route it left as well as the one it joined, so the
+        # log alone names every stale search.
+        "ALTER TABLE flight_changes ADD COLUMN departure_location TEXT",
+        "ALTER TABLE flight_changes ADD COLUMN arrival_location TEXT",
+        "ALTER TABLE flight_changes ADD COLUMN departure_date TEXT",
+        "DROP TRIGGER IF EXISTS flight_changes_after_insert",
+        "DROP TRIGGER IF EXISTS flight_changes_after_update",
+        "DROP TRIGGER IF EXISTS flight_changes_after_delete",
+        '''
+        CREATE TRIGGER flight_changes_after_insert
+        AFTER INSERT ON flight_info
+        BEGIN
+            INSERT INTO flight_changes (flight_id, departure_location, arrival_location, departure_date)
+            VALUES (NEW.id, NEW.departure_location, NEW.arrival_location, NEW.departure_date);
+        END
+        ''',
+        '''
+        CREATE TRIGGER flight_changes_after_update
+        AFTER UPDATE ON flight_info
+        BEGIN
+            INSERT INTO flight_changes (flight_id, departure_location, arrival_location, departure_date)
+            VALUES (OLD.id, OLD.departure_location, OLD.arrival_location, OLD.departure_date);
+        END
+        ''',
+        '''
+        CREATE TRIGGER flight_changes_after_move
+        AFTER UPDATE OF id, departure_location, arrival_location, departure_date ON flight_info
+        WHEN NEW.id != OLD.id
+            OR NEW.departure_location != OLD.departure_location
+            OR NEW.arrival_location != OLD.arrival_location
+            OR NEW.departure_date != OLD.departure_date
+        BEGIN
+            INSERT INTO flight_changes (flight_id, departure_location, arrival_location, departure_date)
+            VALUES (NEW.id, NEW.departure_location, NEW.arrival_location, NEW.departure_date);
+        END
+        ''',
+        '''
+        CREATE TRIGGER flight_changes_after_delete
+        AFTER DELETE ON flight_info
+        BEGIN
+            INSERT INTO flight_changes (flight_id, departure_location, arrival_location, departure_date)
+            VALUES (OLD.id, OLD.departure_location, OLD.arrival_location, OLD.departure_date);
+        END
+        ''',
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+SEARCH_FLIGHTS_SQL = '''
+SELECT * FROM flight_info
+WHERE departure_location = ?
+AND arrival_location = ?
+AND departure_date = ?
+AND seats_available > 0
+ORDER BY price ASC, id ASC
+'''
+
+SEARCH_FLIGHTS_FIRST_PAGE_SQL = '''
+SELECT * FROM flight_info
+WHERE departure_location = ?
+AND arrival_location = ?
+AND departure_date = ?
+AND seats_available > 0
+ORDER BY price ASC, id ASC
+LIMIT ?
+'''
+
+# One page of search results after a (price, id) keyset cursor
+SEARCH_FLIGHTS_PAGE_SQL = '''
+SELECT * FROM flight_info
+WHERE departure_location = ?
+AND arrival_location = ?
+AND departure_date = ?
+AND seats_available > 0
+AND (price, id) > (?, ?)
+ORDER BY price ASC, id ASC
+LIMIT ?
+'''
+
+COUNT_FLIGHTS_AFTER_SQL = '''
+SELECT COUNT(*) FROM flight_info
+WHERE departure_location = ?
+AND arrival_location = ?
+AND departure_date = ?
+AND seats_available > 0
+AND (price, id) > (?, ?)
+'''
+
+FLIGHT_BY_ID_SQL = '''
+SELECT * FROM flight_info
+WHERE id = ?
+'''
+
+# Conditional decrement: only succeeds while a seat is left, so checking
+# availability and reserving the seat is a single atomic statement.
+RESERVE_SEAT_SQL = '''
+UPDATE flight_info
+SET seats_available = seats_available - 1
+WHERE id = ? AND seats_available > 0
+'''
+
+FARE_CALENDAR_SQL = '''
+SELECT departure_date, min_price, flights_available FROM fare_summary
+WHERE departure_location = ?
+AND arrival_location = ?
+AND departure_date BETWEEN ? AND ?
+ORDER BY departure_date
+'''
+
+RECORD_INVOICE_SQL = '''
+INSERT INTO invoices (booking_id, invoice_number, invoice_date, filename, status, payload, updated_at)
+VALUES (?, ?, ?, ?, 'completed', ?, ?)
+'''
+
+# book_and_invoice records its invoice as rendering in the booking
+# transaction and finishes it once the PDF is written after the commit
+START_INVOICE_SQL = '''
+INSERT INTO invoices (booking_id, invoice_number, invoice_date, filename, status, payload, updated_at)
+VALUES (?, ?, ?, ?, 'rendering', ?, ?)
+'''
+
+SET_INVOICE_STATUS_SQL = '''
+UPDATE invoices SET status = ?, error = ?, updated_at = ? WHERE id = ?
+'''
+
+# Undo a booking whose invoice could not be rendered
+RELEASE_SEAT_SQL = '''
+UPDATE flight_info
+SET seats_available = seats_available + 1
+WHERE id = ?
+'''
+
+# The booking's invoice; failed jobs may be retried, so they do not count
+INVOICE_FOR_BOOKING_SQL = '''
+SELECT invoice_number, invoice_date, filename, status FROM invoices
+WHERE booking_id = ? AND status != 'failed'
+'''
+
+# Bookings joined with their flights, for invoicing. rowid is used because
+# older databases name the bookings key booking_id rather than id. The flight
+# columns are NULL for flights moved to the archive (see flight_archive.py).
+BOOKINGS_FOR_INVOICE_SQL = '''
+SELECT b.rowid AS booking_id, b.customer_id, b.flight_id, b.payment_amount,
+       b.payment_status, b.card_last_four,
+       f.flight_number, f.airline, f.departure_location, f.arrival_location,
+       f.departure_date, f.departure_time
+FROM bookings b
+LEFT JOIN flight_info f ON f.id = b.flight_id
+WHERE b.rowid BETWEEN ? AND ?
+ORDER BY b.rowid
+'''
+
+BOOKING_FOR_INVOICE_SQL = '''
+SELECT b.rowid AS booking_id, b.customer_id, b.flight_id, b.payment_amount,
+       b.payment_status, b.card_last_four,
+       f.flight_number, f.airline, f.departure_location, f.arrival_location,
+       f.departure_date, f.departure_time
+FROM bookings b
+LEFT JOIN flight_info f ON f.id = b.flight_id
+WHERE b.rowid = ?
+'''
+
+# A customer's bookings, newest first, with their flights. The page after a
+# (booking_date, rowid) keyset cursor uses LIST_BOOKINGS_PAGE_SQL.
+LIST_BOOKINGS_SQL = '''
+SELECT b.rowid AS booking_id, b.booking_date, b.flight_id, b.payment_amount, b.payment_status,
+       b.card_last_four, f.flight_number, f.airline, f.departure_location, f.arrival_location,
+       f.departure_date, f.departure_time, f.arrival_time
+FROM bookings b
+LEFT JOIN flight_info f ON f.id = b.flight_id
+WHERE b.customer_id = ?
+ORDER BY b.booking_date DESC, b.rowid DESC
+LIMIT ?
+'''
+
+LIST_BOOKINGS_PAGE_SQL = '''
+SELECT b.rowid AS booking_id, b.booking_date, b.flight_id, b.payment_amount, b.payment_status,
+       b.card_last_four, f.flight_number, f.airline, f.departure_location, f.arrival_location,
+       f.departure_date, f.departure_time, f.arrival_time
+FROM bookings b
+LEFT JOIN flight_info f ON f.id = b.flight_id
+WHERE b.customer_id = ?
+AND (b.booking_date, b.rowid) < (?, ?)
+ORDER BY b.booking_date DESC, b.rowid DESC
+LIMIT ?
+'''
+
+INSERT_BOOKING_SQL = '''
+INSERT INTO bookings
+(customer_id, flight_id, booking_date, payment_amount, payment_status, card_last_four)
+VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+# Hot queries and the plan SQLite is expected to pick for each of them.
+# book_flight looks flights up by id, which is the rowid alias, so the
+# table b-tree itself is the index for that lookup.
+EXPECTED_PLANS = [
+    ("search_flights", SEARCH_FLIGHTS_SQL, ("", "", ""),
+     "USING COVERING INDEX idx_flight_route_date_price_id"),
+    ("search_flights first page", SEARCH_FLIGHTS_FIRST_PAGE_SQL, ("", "", "", 1),
+     "USING COVERING INDEX idx_flight_route_date_price_id"),
+    ("search_flights page", SEARCH_FLIGHTS_PAGE_SQL, ("", "", "", 0, 0, 1),
+     "USING COVERING INDEX idx_flight_route_date_price_id"),
+    ("search_flights remaining", COUNT_FLIGHTS_AFTER_SQL, ("", "", "", 0, 0),
+     "USING COVERING INDEX idx_flight_route_date_price_id"),
+    ("book_flight", RESERVE_SEAT_SQL, (0,),
+     "USING INTEGER PRIMARY KEY"),
+    ("flight lookup", FLIGHT_BY_ID_SQL, (0,),
+     "USING INTEGER PRIMARY KEY"),
+    ("fare_calendar", FARE_CALENDAR_SQL, ("", "", "", ""),
+     "USING PRIMARY KEY"),
+    ("generate_invoice", INVOICE_FOR_BOOKING_SQL, (0,),
+     "USING INDEX idx_invoices_booking_issued"),
+    ("invoice booking lookup", BOOKING_FOR_INVOICE_SQL, (0,),
+     "USING INTEGER PRIMARY KEY"),
+    ("list_bookings", LIST_BOOKINGS_SQL, ("", 1),
+     "USING INDEX idx_bookings_customer_date"),
+    ("list_bookings page", LIST_BOOKINGS_PAGE_SQL, ("", "", 0, 1),
+     "USING INDEX idx_bookings_customer_date"),
+]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Return the schema version recorded in the database."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply_migrations(conn: sqlite3.Connection, target: int = SCHEMA_VERSION) -> int:
+    """
+    Upgrade the database schema to the target version.
+
+    Each migration runs in its own transaction together with the version
+    bump, so an interrupted upgrade leaves the database at the last fully
+    applied version.
+
+    Args:
+        conn: An open connection to the flight database
+        target: The schema version to migrate to (defaults to the latest)
+
+    Returns:
+        The schema version of the database after migrating
+    """
+    current = get_schema_version(conn)
+    applied = False
+    for version, _description, statements in MIGRATIONS:
+        if version <= current or version > target:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        current = version
+        applied = True
+    if applied:
+        # Refresh planner statistics so the new indexes are costed correctly
+        conn.execute("ANALYZE")
+        conn.commit()
+    return current
+
+
+def explain(conn: sqlite3.Connection, sql: str, params: tuple = ()) -> List[str]:
+    """Return the EXPLAIN QUERY PLAN detail lines for a statement."""
+    return [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+def check_query_plans(conn: sqlite3.Connection) -> None:
+    """
+    Verify that the hot queries are served by their indexes.
+
+    Raises:
+        RuntimeError: If a query falls back to a table scan or does not use
+            its expected index
+    """
+    for name, sql, params, expected in EXPECTED_PLANS:
+        plan = explain(conn, sql, params)
+        # A temporary b-tree for ORDER BY is not flagged: on sparse schedules
+        # ANALYZE reports about one flight per route and day, and sorting that
+        # is cheaper than walking the index in order.
+        problems = [step for step in plan if step.startswith("SCAN")]
+        if problems or not any(expected in step for step in plan):
+            raise RuntimeError(
+                f"Query plan check failed for {name}: expected '{expected}', "
+                f"got {plan}. Run the schema migrations (setup_flight_db.py or "
+                f"server startup) to create the missing indexes."
+            )
+
+
+class FlightDatabase:
+    """
+    Long-lived connections to the flight database.
+
+    The database runs in WAL mode so readers never block the writer. Reads go
+    through a small pool of read-only connections and all writes share a
+    single writer connection guarded by a lock, which matches SQLite's one
+    writer at a time model. Connections are kept open for the life of the
+    process, so each one keeps its compiled statements in the sqlite3
+    statement cache and repeated tool calls skip connect and prepare costs.
+    Safe to use from concurrently running tool handlers.
+    """
+
+    # Writers wait briefly inside SQLite and then back off in Python, so a
+    # lock held by another process costs bounded time instead of stalling
+    # every queued booking for the full busy_timeout.
+    WRITER_BUSY_TIMEOUT_MS = 100
+    WRITE_RETRIES = 6
+    WRITE_BACKOFF_BASE = 0.02
+    WRITE_BACKOFF_MAX = 0.5
+
+    PRAGMAS = [
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA cache_size = -65536",
+        "PRAGMA mmap_size = 268435456",
+        "PRAGMA busy_timeout = 5000",
+        "PRAGMA temp_store = MEMORY",
+    ]
+
+    def __init__(self, path: str, max_readers: int = 8, cached_statements: int = 256):
+        self.path = path
+        self.max_readers = max_readers
+        self.cached_statements = cached_statements
+        self._writer: Optional[sqlite3.Connection] = None
+        self._write_lock = threading.Lock()
+        self._watcher: Optional[sqlite3.Connection] = None
+        self._watch_lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._reader_slots = threading.BoundedSemaphore(max_readers)
+        self._all_readers: List[sqlite3.Connection] = []
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    def open(self) -> None:
+        """
+        Check the database path, open the writer connection and migrate.
+
+        Raises:
+            FileNotFoundError: If the database file does not exist
+            RuntimeError: If the query plan check fails after migrating
+        """
+        with self._open_lock:
+            if self._writer is not None:
+                return
+            if not os.path.exists(self.path):
+                raise FileNotFoundError(self.path)
+            conn = self._connect(self.path)
+            conn.execute("PRAGMA journal_mode = WAL")
+            apply_migrations(conn)
+            check_query_plans(conn)
+            conn.execute(f"PRAGMA busy_timeout = {self.WRITER_BUSY_TIMEOUT_MS}")
+            self._writer = conn
+
+    def close(self) -> None:
+        """Close every pooled connection."""
+        with self._open_lock, self._write_lock:
+            for conn in self._all_readers:
+                conn.close()
+            self._all_readers.clear()
+            self._readers = queue.LifoQueue()
+            self._watcher = None
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    def _connect(self, target: str, uri: bool = False) -> sqlite3.Connection:
+        with metrics.timer("phase", "db.connect"):
+            conn = sqlite3.connect(
+                target,
+                uri=uri,
+                check_same_thread=False,
+                cached_statements=self.cached_statements,
+                factory=metrics.connection_factory(),
+            )
+        conn.row_factory = sqlite3.Row
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _new_reader(self) -> sqlite3.Connection:
+        uri = f"file:{pathname2url(os.path.abspath(self.path))}?mode=ro"
+        conn = self._connect(uri, uri=True)
+        conn.execute("PRAGMA query_only = ON")
+        with self._open_lock:
+            self._all_readers.append(conn)
+        return conn
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a read-only connection from the pool."""
+        self.open()
+        self._reader_slots.acquire()
+        try:
+            try:
+                conn = self._readers.get_nowait()
+            except queue.Empty:
+                conn = self._new_reader()
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._readers.put(conn)
+        finally:
+            self._reader_slots.release()
+
+    def data_version(self) -> int:
+        """
+        Return PRAGMA data_version as seen by a dedicated read-only connection.
+
+        The value changes whenever any other connection commits, this
+        process's writer included. The connection has its own lock, so the
+        check never waits behind a write transaction.
+        """
+        self.open()
+        with self._watch_lock:
+            if self._watcher is None:
+                self._watcher = self._new_reader()
+            return self._watcher.execute("PRAGMA data_version").fetchone()[0]
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """Hold the writer connection exclusively for the duration of the block."""
+        self.open()
+        with self._write_lock:
+            yield self._writer
+
+    def transaction(self, work: Callable[[sqlite3.Connection], T]) -> T:
+        """
+        Run work inside an immediate write transaction and commit it.
+
+        BEGIN IMMEDIATE takes SQLite's write lock up front, so everything
+        work reads is still true when it writes. If the lock is held by
+        another process the transaction is retried with jittered
+        exponential backoff, a bounded number of times. Any other exception
+        rolls the transaction back and is re-raised.
+
+        Args:
+            work: Callable receiving the writer connection inside the
+                transaction; its return value is returned
+
+        Raises:
+            sqlite3.OperationalError: If the database stays locked after
+                all retries
+        """
+        delay = self.WRITE_BACKOFF_BASE
+        for attempt in range(self.WRITE_RETRIES + 1):
+            with self.writer() as conn:
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    result = work(conn)
+                    conn.commit()
+                    return result
+                except sqlite3.OperationalError as e:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    if not _is_busy(e) or attempt == self.WRITE_RETRIES:
+                        raise
+                except BaseException:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    raise
+            # Back off without holding the writer so other handlers can queue
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, self.WRITE_BACKOFF_MAX)
+        raise AssertionError("unreachable")
+
+
+_shared: Dict[str, FlightDatabase] = {}
+_shared_lock = threading.Lock()
+
+
+def shared_database(path: str) -> FlightDatabase:
+    """
+    Return the process-wide FlightDatabase for a path, creating it on first use.
+
+    Services loaded into the same process (see mcp_host.py) get the same
+    instance, so they share one writer, one reader pool and its statement
+    caches instead of each opening their own.
+    """
+    key = os.path.abspath(path)
+    with _shared_lock:
+        db = _shared.get(key)
+        if db is None:
+            db = _shared[key] = FlightDatabase(path)
+        return db
+
+
+def _is_busy(error: sqlite3.OperationalError) -> bool:
+    """Whether an OperationalError is SQLITE_BUSY/SQLITE_LOCKED."""
+    message = str(error).lower()
+    return "locked" in message or "busy" in message
+
+
+def change_log_position(conn: sqlite3.Connection) -> int:
+    """Return the current change log position."""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'flight_changes'").fetchone()
+    return row[0] if row else 0
+
+
+def read_flight_changes(conn: sqlite3.Connection, since: int) -> Tuple[int, Optional[List[int]]]:
+    """
+    Read the ids of flights changed after a given change log position.
+
+    Args:
+        conn: Connection to read from, ideally inside a read transaction
+            shared with any follow-up queries
+        since: Last change log position the caller has applied
+
+    Returns:
+        The current change log position and the changed flight ids, or None
+        instead of the ids if entries after since were already pruned and
+        the caller must rebuild from flight_info
+    """
+    head = change_log_position(conn)
+    if head <= since:
+        return head, []
+    oldest = conn.execute("SELECT MIN(seq) FROM flight_changes").fetchone()[0]
+    if oldest is None or oldest > since + 1:
+        return head, None
+    flight_ids = {
+        row[0] for row in conn.execute(
+            "SELECT flight_id FROM flight_changes WHERE seq > ? AND seq <= ?", (since, head)
+        )
+    }
+    return head, sorted(flight_ids)
+
+
+def read_changed_routes(conn: sqlite3.Connection, since: int) -> Tuple[int, Optional[Set[Tuple[str, str, str]]]]:
+    """
+    Read the (departure, arrival, date) routes touched by flight changes
+    after a given change log position, including the route a moved or
+    deleted flight left.
+
+    Args:
+        conn: Connection to read from, ideally inside a read transaction
+        since: Last change log position the caller has applied
+
+    Returns:
+        The current change log position and the changed routes, or None
+        instead of the routes if entries after since were already pruned or
+        were logged before routes were recorded
+    """
+    head = change_log_position(conn)
+    if head <= since:
+        return head, set()
+    oldest = conn.execute("SELECT MIN(seq) FROM flight_changes").fetchone()[0]
+    if oldest is None or oldest > since + 1:
+        return head, None
+    routes = set()
+    for row in conn.execute(
+        "SELECT departure_location, arrival_location, departure_date FROM flight_changes WHERE seq > ? AND seq <= ?",
+        (since, head)
+    ):
+        if row[0] is None:
+            return head, None
+        routes.add(tuple(row))
+    return head, routes
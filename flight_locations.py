@@ -0,0 +1,325 @@
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from typing import Dict, List, Optional, Set, Tuple
+
+from flight_db import FlightDatabase, read_flight_changes, change_log_position
+
+# Built-in aliases: airport and metro codes, abbreviations and local names.
+# Operators add more in the location_aliases table. An alias is only used
+# when the location it points to has flights.
+LOCATION_ALIASES = {
+    "New York": ["NYC", "JFK", "LGA", "EWR", "NY", "New York City", "Newark", "Manhattan", "Big Apple"],
+    "Los Angeles": ["LAX", "LA", "L.A.", "Los Angeles International"],
+    "Chicago": ["CHI", "ORD", "MDW", "O'Hare", "Midway"],
+    "Miami": ["MIA", "FLL", "Fort Lauderdale"],
+    "San Francisco": ["SFO", "SF", "San Fran", "Frisco", "Bay Area", "OAK", "Oakland", "SJC"],
+    "Seattle": ["SEA", "Seattle-Tacoma", "Sea-Tac"],
+    "Dallas": ["DFW", "DAL", "Dallas Fort Worth", "Fort Worth"],
+    "Denver": ["DEN"],
+    "Boston": ["BOS", "Logan"],
+    "Atlanta": ["ATL", "Hartsfield-Jackson"],
+    "London": ["LON", "LHR", "LGW", "STN", "LCY", "Heathrow", "Gatwick"],
+    "Paris": ["PAR", "CDG", "ORY", "Charles de Gaulle", "Orly"],
+    "Tokyo": ["TYO", "HND", "NRT", "Haneda", "Narita"],
+    "Dubai": ["DXB", "DWC"],
+    "Sydney": ["SYD"],
+}
+
+ALIASES_SQL = "SELECT alias, location FROM location_aliases"
+
+LOCATIONS_SQL = '''
+SELECT DISTINCT departure_location FROM flight_info
+UNION
+SELECT DISTINCT arrival_location FROM flight_info
+'''
+
+# Seconds between background checks of the flight change log and the
+# alias table; lookups never wait on the database
+REFRESH_INTERVAL_SECONDS = 10.0
+
+# Recent fuzzy lookups, so a repeated typo is answered from memory
+FUZZY_CACHE_SIZE = 4096
+
+_NON_WORD = re.compile(r"[^a-z0-9]+")
+
+
+def normalize(name: str) -> str:
+    """Lowercase, strip accents and punctuation and collapse whitespace."""
+    decomposed = unicodedata.normalize("NFKD", name)
+    ascii_name = decomposed.encode("ascii", "ignore").decode().lower()
+    return _NON_WORD.sub(" ", ascii_name).strip()
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """
+    Optimal string alignment distance between a and b (insertions,
+    deletions, substitutions and adjacent transpositions), or limit + 1 as
+    soon as it is certain to exceed limit.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2: Optional[List[int]] = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if previous2 is not None and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                value = min(value, previous2[j - 2] + 1)
+            current[j] = value
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def bigrams(text: str) -> frozenset:
+    """Adjacent character pairs of text."""
+    return frozenset(text[i:i + 2] for i in range(len(text) - 1))
+
+
+def max_typos(query: str) -> int:
+    """Edits tolerated in a query of this length: none for codes, more for long names."""
+    if len(query) <= 3:
+        return 0
+    if len(query) <= 6:
+        return 1
+    return 2
+
+
+class LocationIndex:
+    """
+    Resolves free-form city and airport names to the locations in flight_info.
+
+    Every location and alias is stored under its normalized form ("NYC",
+    "nyc" and "N.Y.C." are one key). A lookup tries, in order: an exact
+    normalized match, a prefix of a name or of any word in it ("San Fran",
+    "york"), then the closest names within a small edit distance
+    ("Chicgo"). Exact and prefix matches are a dict lookup and a bisect.
+    The fuzzy pass only runs the edit distance against names sharing
+    enough character pairs with the query, and remembers its recent
+    answers.
+
+    The index is built from the distinct locations in flight_info and the
+    location_aliases table on first use. Once started, a background thread
+    keeps it current: new locations are read from the flights in the
+    flight_changes log, so the full scan of flight_info only runs again
+    after flights are deleted. Thread-safe.
+    """
+
+    def __init__(self, db: FlightDatabase):
+        self.db = db
+        self._lock = threading.Lock()
+        self.locations: frozenset = frozenset()
+        self._exact: Dict[str, Tuple[str, str]] = {}
+        self._prefixes: List[Tuple[str, str, str]] = []
+        self._bigrams: List[Tuple[str, str, frozenset]] = []
+        self._fuzzy: Dict[str, List[Dict]] = {}
+        self._aliases: Dict[str, str] = {}
+        self._position: Optional[int] = None
+        # Held while reading the database, so concurrent refreshes do not
+        # repeat the same work
+        self._refresh_lock = threading.Lock()
+        self._refresher: Optional[threading.Thread] = None
+        self.rebuilds = 0
+        self.lookups = 0
+
+    def start(self, interval: float = REFRESH_INTERVAL_SECONDS) -> None:
+        """Build the index if needed and keep it current from a background thread."""
+        self._ensure_built()
+        with self._refresh_lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(
+                target=self._refresh_forever, args=(interval,), name="location-refresh", daemon=True
+            )
+            self._refresher.start()
+
+    def _refresh_forever(self, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except sqlite3.Error:
+                # Retried on the next interval
+                pass
+
+    def refresh(self) -> None:
+        """
+        Bring the index up to date with the database.
+
+        Locations are taken from the flights changed since the last refresh.
+        All of flight_info is only read again on the first refresh, after
+        flights were deleted, or when the change log no longer reaches back
+        far enough. The alias table is small and read in full. The lookup
+        structures are only rebuilt if a location or alias changed.
+        """
+        with self._refresh_lock:
+            self._refresh()
+
+    def _ensure_built(self) -> None:
+        if self._position is None:
+            with self._refresh_lock:
+                # Another caller may have built it while this one waited
+                if self._position is None:
+                    self._refresh()
+
+    def _refresh(self) -> None:
+        with self.db.reader() as conn:
+            # One read transaction so the change log position and the
+            # locations read match the same snapshot.
+            conn.execute("BEGIN")
+            if self._position is None:
+                position, changed = change_log_position(conn), None
+            else:
+                position, changed = read_flight_changes(conn, self._position)
+            locations = set(self.locations)
+            if changed:
+                rows = []
+                # Stay well below SQLite's bound parameter limit
+                for start in range(0, len(changed), 500):
+                    chunk = changed[start:start + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    rows += conn.execute(
+                        "SELECT departure_location, arrival_location FROM flight_info "
+                        f"WHERE id IN ({placeholders})", chunk
+                    ).fetchall()
+                if len(rows) < len(changed):
+                    # Deleted flights may have been the last ones at a location
+                    changed = None
+                else:
+                    for row in rows:
+                        locations.update((row[0], row[1]))
+            if changed is None:
+                locations = {row[0] for row in conn.execute(LOCATIONS_SQL)}
+            aliases = {row[0]: row[1] for row in conn.execute(ALIASES_SQL)}
+
+        unchanged = locations == self.locations and aliases == self._aliases
+        if self._position is not None and unchanged:
+            self._position = position
+            return
+        self._build(locations, aliases)
+        self._position = position
+
+    def _build(self, locations: Set[str], aliases: Dict[str, str]) -> None:
+        exact: Dict[str, Tuple[str, str]] = {}
+        for location in locations:
+            exact[normalize(location)] = (location, "exact")
+        known = set(locations)
+        builtin = [(alias, location) for location, names in LOCATION_ALIASES.items() for alias in names]
+        # Table entries come last so they override the built-in aliases
+        for alias, location in builtin + list(aliases.items()):
+            key = normalize(alias)
+            if location in known and key and exact.get(key, ("", ""))[1] != "exact":
+                exact[key] = (location, "alias")
+
+        prefixes = []
+        for key, (location, kind) in exact.items():
+            words = key.split(" ")
+            for start in range(len(words)):
+                prefixes.append((" ".join(words[start:]), location, kind))
+        prefixes.sort()
+
+        with self._lock:
+            self.locations = frozenset(locations)
+            self._aliases = aliases
+            self._exact = exact
+            self._prefixes = prefixes
+            self._bigrams = [(key, location, bigrams(key)) for key, (location, _) in exact.items()]
+            self._fuzzy = {}
+            self.rebuilds += 1
+
+    def lookup(self, query: str, limit: int = 5) -> List[Dict]:
+        """
+        Find the locations a name may refer to, best first.
+
+        Args:
+            query: A city or airport name, code or alias in any case
+            limit: Maximum number of candidates
+
+        Returns:
+            Candidates with the location, how it matched ("exact", "alias",
+            "prefix" or "fuzzy") and, for fuzzy matches, the edit distance
+        """
+        self._ensure_built()
+        return self._lookup(normalize(query), limit)
+
+    def _lookup(self, key: str, limit: int) -> List[Dict]:
+        if not key:
+            return []
+        with self._lock:
+            self.lookups += 1
+            exact, prefixes, pairs, fuzzy = self._exact, self._prefixes, self._bigrams, self._fuzzy
+        found = exact.get(key)
+        if found is not None:
+            return [{"location": found[0], "match": found[1]}]
+
+        matches: Dict[str, Dict] = {}
+        start = bisect_left(prefixes, (key,))
+        for entry, location, _ in prefixes[start:]:
+            if not entry.startswith(key):
+                break
+            matches.setdefault(location, {"location": location, "match": "prefix"})
+        if matches:
+            return sorted(matches.values(), key=lambda match: match["location"])[:limit]
+
+        allowed = max_typos(key)
+        if allowed == 0:
+            return []
+        cached = fuzzy.get(key)
+        if cached is None:
+            # Each edit changes at most three character pairs, so names
+            # sharing fewer pairs with the query cannot be close enough.
+            query_pairs = bigrams(key)
+            needed = len(query_pairs) - 3 * allowed
+            scored: Dict[str, int] = {}
+            for name, location, name_pairs in pairs:
+                if abs(len(name) - len(key)) > allowed or len(query_pairs & name_pairs) < needed:
+                    continue
+                distance = edit_distance(key, name, allowed)
+                if distance <= allowed and distance < scored.get(location, allowed + 1):
+                    scored[location] = distance
+            ranked = sorted(scored.items(), key=lambda item: (item[1], item[0]))
+            cached = [{"location": location, "match": "fuzzy", "distance": distance} for location, distance in ranked]
+            with self._lock:
+                if len(fuzzy) >= FUZZY_CACHE_SIZE:
+                    fuzzy.clear()
+                fuzzy[key] = cached
+        return [dict(match) for match in cached[:limit]]
+
+    def resolve(self, query: str) -> Optional[str]:
+        """
+        Return the one location a name clearly refers to, or None.
+
+        A name that is already a known location is returned unchanged
+        without a lookup. Otherwise an exact or alias match wins; a prefix
+        or fuzzy lookup must single out one location, with a fuzzy runner-up
+        further away than the best match.
+        """
+        self._ensure_built()
+        if query in self.locations:
+            return query
+        matches = self.lookup(query, limit=2)
+        if not matches:
+            return None
+        if len(matches) == 1 or matches[0]["match"] in ("exact", "alias"):
+            return matches[0]["location"]
+        if matches[0]["match"] == "fuzzy" and matches[0]["distance"] < matches[1]["distance"]:
+            return matches[0]["location"]
+        return None
+
+    def stats(self) -> Dict:
+        """Return index size and counters."""
+        with self._lock:
+            return {
+                "locations": len(self.locations),
+                "keys": len(self._exact),
+                "change_log_position": self._position,
+                "rebuilds": self.rebuilds,
+                "lookups": self.lookups,
+            }
@@ -1,26 +1,241 @@
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 import sys
+import argparse
 from mcp.server.fastmcp import FastMCP
-from typing import Dict, List, Union, Optional
+from typing import Dict, List, Union, Optional, Tuple
 import re
+import base64
+import json
+from bisect import bisect_right
+from flight_cache import SearchCache
+from metrics import metrics
+from tool_executor import tool_executor, write_executor, add_transport_arguments, serve, SingleFlight
+from flight_routes import RouteGraph
+from flight_columns import FlightColumns
+from flight_archive import shared_archive
+from flight_locations import LocationIndex
+from flight_db import (
+    shared_database, SEARCH_FLIGHTS_SQL, SEARCH_FLIGHTS_FIRST_PAGE_SQL, SEARCH_FLIGHTS_PAGE_SQL,
+    COUNT_FLIGHTS_AFTER_SQL, FARE_CALENDAR_SQL, FLIGHT_BY_ID_SQL, RESERVE_SEAT_SQL, INSERT_BOOKING_SQL,
+    BOOKING_FOR_INVOICE_SQL, START_INVOICE_SQL, SET_INVOICE_STATUS_SQL, RELEASE_SEAT_SQL, LIST_BOOKINGS_SQL,
+    LIST_BOOKINGS_PAGE_SQL, SORT_KEYS,
+    read_changed_routes, change_log_position
+)
+from invoice_renderer import (
+    booking_invoice_values, invoice_filename, invoice_path, invoice_uri, new_invoice_number, shared_renderer
+)
 
 # Initialize FastMCP
 mcp = FastMCP("FlightSearch")
 
+DB_PATH = os.path.join('data', 'flights.db')
+DB_NOT_FOUND = "Flight database not found. Please run setup_flight_db.py first."
+
+# Shared, long-lived connections used by every tool handler
+db = shared_database(DB_PATH)
+
+# Flights of past months, moved out of flight_info by flight_archive.py
+archive = shared_archive(DB_PATH)
+
+# Static invoice layout for book_and_invoice, built on first use
+renderer = shared_renderer()
+
+# Recent search results, keyed on (departure, arrival, date)
+SEARCH_CACHE_SIZE = 1024
+SEARCH_CACHE_TTL = 120.0
+search_cache = SearchCache(max_entries=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+
+# Identical searches running at the same time share one query
+searches = SingleFlight()
+
+# Schedule graph for connecting itineraries, built on first use
+route_graph = RouteGraph(db)
+
+# Columnar snapshot of the schedule for filter_flights, built on first use
+flight_columns = FlightColumns(db)
+
+# City and airport names, codes and aliases, built at startup and kept
+# current in the background
+locations = LocationIndex(db)
+
+
+def init_database() -> None:
+    """
+    Open the flight database, bring its schema up to date and verify the
+    query plans.
+
+    Runs once at server startup. Raises if the hot queries would not be
+    served by their indexes, so a missing index is caught before the first
+    search instead of showing up as slow tool calls.
+    """
+    try:
+        db.open()
+        locations.start()
+    except FileNotFoundError:
+        print(f"Flight database not found at {DB_PATH}. Please run setup_flight_db.py first.", file=sys.stderr)
+
+FLIGHT_FIELDS = (
+    "flight_number", "airline", "departure_location", "arrival_location", "departure_date",
+    "departure_time", "arrival_time", "price", "seats_available", "flight_id"
+)
+MAX_PAGE_SIZE = 100
+
+
+def flight_to_dict(row: sqlite3.Row) -> Dict:
+    """Convert a flight_info row to the dictionary returned by the search tools."""
+    return {
+        "flight_number": row['flight_number'],
+        "airline": row['airline'],
+        "departure_location": row['departure_location'],
+        "arrival_location": row['arrival_location'],
+        "departure_date": row['departure_date'],
+        "departure_time": row['departure_time'],
+        "arrival_time": row['arrival_time'],
+        "price": row['price'],
+        "seats_available": row['seats_available'],
+        "flight_id": row['id']
+    }
+
+
+def resolve_route(departure_location: str, arrival_location: str) -> Tuple[str, str, Dict[str, str]]:
+    """
+    Map the names a user typed ("NYC", "san fran") to the locations in flight_info.
+    
+    Returns:
+        The departure and arrival locations to query, and the names that
+        were rewritten mapped to their location. Names that do not resolve
+        to exactly one location are kept as typed.
+    """
+    resolved = {}
+    route = []
+    for name in (departure_location, arrival_location):
+        location = locations.resolve(name) or name
+        if location != name:
+            resolved[name] = location
+        route.append(location)
+    return route[0], route[1], resolved
+
+
+def annotate_locations(result: Dict, resolved: Dict[str, str], names: Tuple[str, ...]) -> Dict:
+    """
+    Report rewritten location names with a result and, when nothing was
+    found, suggest known locations for the names that are not.
+    """
+    extra = {}
+    if resolved:
+        extra["resolved_locations"] = resolved
+    if "message" in result:
+        suggestions = {}
+        for name in names:
+            if name not in locations.locations:
+                candidates = [match["location"] for match in locations.lookup(name)]
+                if candidates:
+                    suggestions[name] = candidates
+        if suggestions:
+            extra["location_suggestions"] = suggestions
+    return {**result, **extra} if extra else result
+
+
+def sync_search_cache() -> None:
+    """
+    Drop cached searches for routes whose flights another connection changed.
+
+    A cheap PRAGMA data_version check skips the work when nothing was
+    committed. Otherwise the flight change log names the routes changed
+    since the last check, including the route a moved or deleted flight
+    left, so writes that leave flight_info alone, such as invoices, keep the
+    cache. Changes the log cannot attribute to a route clear it. The new
+    data_version is only recorded once the changes are applied, so a failed
+    sync is retried on the next call.
+    """
+    version = db.data_version()
+    if not search_cache.data_version_changed(version):
+        return
+    with db.reader() as conn:
+        conn.execute("BEGIN")
+        if search_cache.log_position is None:
+            position, routes = change_log_position(conn), set()
+        else:
+            position, routes = read_changed_routes(conn, search_cache.log_position)
+    search_cache.apply_changes(position, routes, version)
+
+
+def load_search(key: Tuple[str, str, str], generation: int) -> Dict:
+    """Query every flight on a route and date and cache the result."""
+    with db.reader() as conn:
+        rows = conn.execute(SEARCH_FLIGHTS_SQL, key).fetchall()
+    
+    with metrics.timer("phase", "search_flights.to_dict"):
+        flights = [flight_to_dict(row) for row in rows]
+    if not flights:
+        result = {"message": "No flights found matching your criteria."}
+    else:
+        result = {"flights": flights}
+    
+    search_cache.put(key, result, generation)
+    return result
+
+
+def seek_page(key: Tuple[str, str, str], after: Optional[Tuple[float, int]],
+              limit: Optional[int]) -> Tuple[List[Dict], int]:
+    """Read one page of a route and date and the number of flights after it."""
+    # Seek straight to the page in the (route, date, price, id) index
+    with db.reader() as conn:
+        conn.execute("BEGIN")
+        if after is None:
+            rows = conn.execute(SEARCH_FLIGHTS_FIRST_PAGE_SQL, key + (limit,)).fetchall()
+        else:
+            rows = conn.execute(SEARCH_FLIGHTS_PAGE_SQL, key + after + (limit if limit else -1,)).fetchall()
+        remaining = 0
+        if rows and limit and len(rows) == limit:
+            last = rows[-1]
+            remaining = conn.execute(COUNT_FLIGHTS_AFTER_SQL, key + (last['price'], last['id'])).fetchone()[0]
+    with metrics.timer("phase", "search_flights.to_dict"):
+        page = [flight_to_dict(row) for row in rows]
+    return page, remaining
+
+
+def encode_cursor(price: float, flight_id: int) -> str:
+    """Opaque keyset cursor pointing just after the given (price, id) position."""
+    return base64.urlsafe_b64encode(json.dumps([price, flight_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    """Inverse of encode_cursor. Raises ValueError for malformed cursors."""
+    try:
+        price, flight_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(price), int(flight_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
 @mcp.tool()
-def search_flights(departure_location: str, arrival_location: str, departure_date: str) -> Dict:
+@metrics.instrument_tool
+@tool_executor.offload
+def search_flights(departure_location: str, arrival_location: str, departure_date: str,
+                   limit: Optional[int] = None, cursor: Optional[str] = None,
+                   fields: Optional[List[str]] = None) -> Dict:
     """
     Search for available flights based on departure location, arrival location, and date.
     
+    Results are sorted by price. By default every matching flight is returned
+    with all fields; pass limit (and then next_cursor) to page through busy
+    routes and fields to return only the columns you need.
+    
     Args:
         departure_location: The city of departure
         arrival_location: The destination city
         departure_date: The departure date in YYYY-MM-DD format (e.g., 2024-05-20)
+        limit: Optional maximum number of flights to return (1-100)
+        cursor: Optional next_cursor value from a previous page
+        fields: Optional list of fields to include, e.g. ["flight_id", "price", "departure_time"]
     
     Returns:
-        Dictionary containing either a list of matching flights or an error message
+        Dictionary containing either a list of matching flights or an error message.
+        Paged responses also include "truncated" (matching flights not yet
+        returned) and "next_cursor" (null on the last page).
     """
     # Input validation
     if not all([departure_location, arrival_location, departure_date]):
@@ -32,52 +247,378 @@ def search_flights(departure_location: str, arrival_location: str, departure_dat
     except ValueError:
         return {"error": "Invalid date format. Please use YYYY-MM-DD format."}
     
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        return {"error": f"limit must be between 1 and {MAX_PAGE_SIZE}."}
+    
+    if fields:
+        unknown = [field for field in fields if field not in FLIGHT_FIELDS]
+        if unknown:
+            return {"error": f"Unknown fields: {', '.join(unknown)}. Valid fields: {', '.join(FLIGHT_FIELDS)}."}
+    
     try:
-        # Check if database exists
-        if not os.path.exists('data/flights.db'):
-            return {"error": "Flight database not found. Please run setup_flight_db.py first."}
-        
-        # Connect to the database
-        conn = sqlite3.connect('data/flights.db')
-        conn.row_factory = sqlite3.Row  # This enables column access by name
-        cursor = conn.cursor()
-        
-        # Query for matching flights
-        cursor.execute('''
-        SELECT * FROM flight_info
-        WHERE departure_location = ? 
-        AND arrival_location = ?
-        AND departure_date = ?
-        AND seats_available > 0
-        ORDER BY price ASC
-        ''', (departure_location, arrival_location, departure_date))
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        return {"error": "Invalid cursor. Use the next_cursor value from a previous search."}
+    
+    paged = limit is not None or after is not None
+    
+    try:
+        departure_location, arrival_location, resolved = resolve_route(departure_location, arrival_location)
+        key = (departure_location, arrival_location, departure_date)
         
-        flights = []
-        for row in cursor.fetchall():
-            flights.append({
-                "flight_number": row['flight_number'],
-                "airline": row['airline'],
-                "departure_location": row['departure_location'],
-                "arrival_location": row['arrival_location'],
-                "departure_date": row['departure_date'],
-                "departure_time": row['departure_time'],
-                "arrival_time": row['arrival_time'],
-                "price": row['price'],
-                "seats_available": row['seats_available'],
-                "flight_id": row['id']
-            })
+        # Drop cached results for flights changed by another process
+        sync_search_cache()
+        cached, generation = search_cache.get(key)
         
-        conn.close()
+        if cached is None and not paged:
+            # Concurrent misses for the same route and date share one query
+            cached = searches.do((key, generation), lambda: load_search(key, generation))
         
-        if not flights:
-            return {"message": "No flights found matching your criteria."}
+        if not paged:
+            if not fields or "flights" not in cached:
+                return annotate_locations(cached, resolved, key[:2])
+            return annotate_locations(
+                {"flights": [{field: flight[field] for field in fields} for flight in cached["flights"]]},
+                resolved, key[:2]
+            )
         
-        return {"flights": flights}
+        if cached is not None:
+            # Page through the cached, already price-ordered result
+            flights = cached.get("flights", [])
+            start = bisect_right(flights, after, key=lambda flight: (flight["price"], flight["flight_id"])) if after else 0
+            page = flights[start:start + limit] if limit else flights[start:]
+            remaining = len(flights) - start - len(page)
+        else:
+            page, remaining = searches.do(("page", key, after, limit, generation),
+                                          lambda: seek_page(key, after, limit))
     
+    except FileNotFoundError:
+        return {"error": DB_NOT_FOUND}
     except Exception as e:
         return {"error": f"Database error: {str(e)}"}
+    
+    if not page and after is None:
+        return annotate_locations({"message": "No flights found matching your criteria."}, resolved, key[:2])
+    
+    next_cursor = encode_cursor(page[-1]["price"], page[-1]["flight_id"]) if page and remaining else None
+    if fields:
+        page = [{field: flight[field] for field in fields} for flight in page]
+    
+    return annotate_locations({
+        "flights": page,
+        "returned": len(page),
+        "truncated": remaining,
+        "next_cursor": next_cursor
+    }, resolved, key[:2])
+
+MAX_CALENDAR_DAYS = 62
+
+
+@mcp.tool()
+@metrics.instrument_tool
+@tool_executor.offload
+def fare_calendar(departure_location: str, arrival_location: str, start_date: str, end_date: str) -> Dict:
+    """
+    Show the lowest fare and number of available flights for each day in a date range.
+    
+    Use this to find the cheapest day to fly instead of searching day by day.
+    
+    Args:
+        departure_location: The city of departure
+        arrival_location: The destination city
+        start_date: First day of the range in YYYY-MM-DD format
+        end_date: Last day of the range (inclusive) in YYYY-MM-DD format, at most 62 days after start_date
+    
+    Returns:
+        Dictionary containing one entry per day and the cheapest day, or an error message
+    """
+    # Input validation
+    if not all([departure_location, arrival_location, start_date, end_date]):
+        return {"error": "Missing required parameters"}
+    
+    try:
+        first_day = datetime.strptime(start_date, '%Y-%m-%d')
+        last_day = datetime.strptime(end_date, '%Y-%m-%d')
+    except ValueError:
+        return {"error": "Invalid date format. Please use YYYY-MM-DD format."}
+    
+    days = (last_day - first_day).days + 1
+    if days < 1:
+        return {"error": "end_date must not be before start_date."}
+    if days > MAX_CALENDAR_DAYS:
+        return {"error": f"Date range too long. Maximum is {MAX_CALENDAR_DAYS} days."}
+    
+    try:
+        departure_location, arrival_location, resolved = resolve_route(departure_location, arrival_location)
+        # Served from the trigger-maintained fare_summary table
+        with db.reader() as conn:
+            rows = conn.execute(FARE_CALENDAR_SQL, (departure_location, arrival_location, start_date, end_date)).fetchall()
+    except FileNotFoundError:
+        return {"error": DB_NOT_FOUND}
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}"}
+    
+    summary = {row['departure_date']: row for row in rows}
+    calendar = []
+    for offset in range(days):
+        day = (first_day + timedelta(days=offset)).strftime('%Y-%m-%d')
+        row = summary.get(day)
+        flights_available = row['flights_available'] if row else 0
+        calendar.append({
+            "date": day,
+            "lowest_price": row['min_price'] if flights_available else None,
+            "flights_available": flights_available
+        })
+    
+    priced = [entry for entry in calendar if entry["lowest_price"] is not None]
+    route = (departure_location, arrival_location)
+    if not priced:
+        return annotate_locations({"message": "No flights found matching your criteria.", "calendar": calendar},
+                                  resolved, route)
+    
+    return annotate_locations({
+        "calendar": calendar,
+        "cheapest": min(priced, key=lambda entry: entry["lowest_price"])
+    }, resolved, route)
+
+MAX_ITINERARIES = 20
+
+
+@mcp.tool()
+@metrics.instrument_tool
+@tool_executor.offload
+def search_itineraries(departure_location: str, arrival_location: str, departure_date: str,
+                       max_stops: int = 2, sort_by: str = "price", limit: int = 5) -> Dict:
+    """
+    Search for direct and connecting itineraries (up to 2 stops) when no direct flight fits.
+    
+    Connections respect minimum connection times (45 minutes on the same
+    airline, 90 minutes between airlines) and layovers of at most 12 hours.
+    
+    Args:
+        departure_location: The city of departure
+        arrival_location: The destination city
+        departure_date: The departure date of the first flight in YYYY-MM-DD format
+        max_stops: Maximum number of connections, 0 to 2 (default 2)
+        sort_by: "price" for the cheapest or "duration" for the fastest itineraries
+        limit: Maximum number of itineraries to return (default 5, at most 20)
+    
+    Returns:
+        Dictionary containing a list of itineraries with their legs and layovers, or an error message
+    """
+    # Input validation
+    if not all([departure_location, arrival_location, departure_date]):
+        return {"error": "Missing required parameters"}
+    
+    try:
+        datetime.strptime(departure_date, '%Y-%m-%d')
+    except ValueError:
+        return {"error": "Invalid date format. Please use YYYY-MM-DD format."}
+    
+    if max_stops not in (0, 1, 2):
+        return {"error": "max_stops must be 0, 1 or 2."}
+    if sort_by not in ("price", "duration"):
+        return {"error": "sort_by must be 'price' or 'duration'."}
+    if not 1 <= limit <= MAX_ITINERARIES:
+        return {"error": f"limit must be between 1 and {MAX_ITINERARIES}."}
+    
+    try:
+        departure_location, arrival_location, resolved = resolve_route(departure_location, arrival_location)
+        route_graph.refresh()
+        itineraries = route_graph.search(
+            departure_location, arrival_location, departure_date,
+            max_stops=max_stops, sort_by=sort_by, limit=limit
+        )
+    except FileNotFoundError:
+        return {"error": DB_NOT_FOUND}
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}"}
+    
+    route = (departure_location, arrival_location)
+    if not itineraries:
+        return annotate_locations({"message": "No itineraries found matching your criteria."}, resolved, route)
+    
+    return annotate_locations({"itineraries": itineraries}, resolved, route)
+
+
+def parse_clock(value: str) -> int:
+    """
+    Convert an HH:MM time to minutes after midnight.
+
+    Raises:
+        ValueError: If the time is not a valid HH:MM clock time
+    """
+    parsed = datetime.strptime(value, '%H:%M')
+    return parsed.hour * 60 + parsed.minute
+
+
+@mcp.tool()
+@metrics.instrument_tool
+@tool_executor.offload
+def filter_flights(departure_locations: Optional[List[str]] = None, arrival_locations: Optional[List[str]] = None,
+                   start_date: Optional[str] = None, end_date: Optional[str] = None,
+                   min_price: Optional[float] = None, max_price: Optional[float] = None,
+                   departure_after: Optional[str] = None, departure_before: Optional[str] = None,
+                   max_duration_minutes: Optional[int] = None, airlines: Optional[List[str]] = None,
+                   exclude_airlines: Optional[List[str]] = None, min_seats: int = 1,
+                   sort_by: str = "price", limit: int = 20) -> Dict:
+    """
+    Find direct flights matching any combination of filters across all routes and dates.
+    
+    Use this for open-ended requests such as "under $500, departing after
+    18:00, not on Emirates, from any of these cities". Every filter is
+    optional; list filters match any of their values.
+    
+    Args:
+        departure_locations: Cities to depart from, e.g. ["New York", "Newark"]
+        arrival_locations: Destination cities
+        start_date: Earliest departure date in YYYY-MM-DD format
+        end_date: Latest departure date in YYYY-MM-DD format
+        min_price: Lowest fare
+        max_price: Highest fare
+        departure_after: Earliest departure time in HH:MM format
+        departure_before: Latest departure time in HH:MM format; a window ending
+            before it starts (e.g. 22:00 to 02:00) spans midnight
+        max_duration_minutes: Longest flight time in minutes
+        airlines: Only these airlines
+        exclude_airlines: Never these airlines
+        min_seats: Fewest seats that must be available (default 1)
+        sort_by: "price" for the cheapest, "duration" for the fastest or "departure" for the earliest flights
+        limit: Maximum number of flights to return (default 20, at most 100)
+    
+    Returns:
+        Dictionary containing the best matching flights and the total number of
+        matches, or an error message
+    """
+    try:
+        first_day = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None
+        last_day = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else None
+    except ValueError:
+        return {"error": "Invalid date format. Please use YYYY-MM-DD format."}
+    
+    try:
+        departs_after = parse_clock(departure_after) if departure_after else None
+        departs_before = parse_clock(departure_before) if departure_before else None
+    except ValueError:
+        return {"error": "Invalid time format. Please use HH:MM format."}
+    
+    if sort_by not in SORT_KEYS:
+        return {"error": f"sort_by must be one of: {', '.join(SORT_KEYS)}."}
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return {"error": f"limit must be between 1 and {MAX_PAGE_SIZE}."}
+    if min_seats < 1:
+        return {"error": "min_seats must be at least 1."}
+    
+    try:
+        if departure_locations:
+            departure_locations = [locations.resolve(name) or name for name in departure_locations]
+        if arrival_locations:
+            arrival_locations = [locations.resolve(name) or name for name in arrival_locations]
+        flight_columns.refresh()
+        matched, flights = flight_columns.filter(
+            origins=departure_locations, destinations=arrival_locations,
+            first_day=first_day, last_day=last_day, min_price=min_price, max_price=max_price,
+            departs_after=departs_after, departs_before=departs_before, max_duration=max_duration_minutes,
+            airlines=airlines, exclude_airlines=exclude_airlines, min_seats=min_seats,
+            sort_by=sort_by, limit=limit
+        )
+    except ValueError as e:
+        return {"error": str(e)}
+    except FileNotFoundError:
+        return {"error": DB_NOT_FOUND}
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}"}
+    
+    if not flights:
+        return {"message": "No flights found matching your criteria."}
+    
+    return {"flights": flights, "matched": matched}
+
+
+@mcp.tool()
+@metrics.instrument_tool
+@tool_executor.offload
+def resolve_location(query: str, limit: int = 5) -> Dict:
+    """
+    Find the city names the flight tools accept for a city, airport code or alias.
+    
+    The search tools already resolve unambiguous names such as "NYC", "JFK",
+    "new york" or "San Fran" themselves; use this to check a name or to pick
+    between several candidates.
+    
+    Args:
+        query: A city or airport name, code or alias, in any case and possibly misspelled
+        limit: Maximum number of candidates to return (default 5, at most 20)
+    
+    Returns:
+        Dictionary containing the candidate locations, best first, and the
+        resolved location if exactly one fits, or an error message
+    """
+    if not query:
+        return {"error": "Missing required parameters"}
+    if not 1 <= limit <= 20:
+        return {"error": "limit must be between 1 and 20."}
+    
+    try:
+        matches = locations.lookup(query, limit)
+        resolved = locations.resolve(query)
+    except FileNotFoundError:
+        return {"error": DB_NOT_FOUND}
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}"}
+    
+    if not matches:
+        return {"message": f"No location matches '{query}'.", "matches": []}
+    
+    return {"query": query, "resolved": resolved, "matches": matches}
+
+MAX_BATCH_BOOKINGS = 100
+
+
+def validate_payment(credit_card_number: str, credit_card_expiry: str, credit_card_cvv: str) -> Optional[str]:
+    """Return an error message if the card details are malformed, else None."""
+    # Validate credit card number (basic check - should be 16 digits)
+    if not re.match(r'^\d{16}$', credit_card_number):
+        return "Invalid credit card number. Must be 16 digits."
+    
+    # Validate expiry date (MM/YY format)
+    if not re.match(r'^(0[1-9]|1[0-2])/\d{2}$', credit_card_expiry):
+        return "Invalid expiry date. Must be in MM/YY format."
+    
+    # Validate CVV (3 digits)
+    if not re.match(r'^\d{3}$', credit_card_cvv):
+        return "Invalid CVV. Must be 3 digits."
+    
+    return None
+
+
+def reserve_seat(conn: sqlite3.Connection, customer_id: str, flight_id: int, card_last_four: str,
+                 booking_date: str, payment_status: str = "Completed") -> Optional[Dict]:
+    """
+    Reserve one seat and record the booking. Must run inside a write transaction.
+    
+    Returns:
+        Dictionary with the booking ID and the flight row, or None if the
+        flight does not exist or is sold out
+    """
+    if conn.execute(RESERVE_SEAT_SQL, (flight_id,)).rowcount != 1:
+        return None
+    
+    flight = conn.execute(FLIGHT_BY_ID_SQL, (flight_id,)).fetchone()
+    cursor = conn.execute(INSERT_BOOKING_SQL, (
+        customer_id, flight_id, booking_date, flight['price'], payment_status, card_last_four
+    ))
+    return {"booking_id": cursor.lastrowid, "flight": flight}
+
+
+def route_key(flight: sqlite3.Row) -> tuple:
+    """Search cache key a flight's results are stored under."""
+    return (flight['departure_location'], flight['arrival_location'], flight['departure_date'])
+
 
 @mcp.tool()
+@metrics.instrument_tool
+@write_executor.offload
 def book_flight(customer_id: str, flight_id: int, credit_card_number: str, credit_card_expiry: str, credit_card_cvv: str) -> Dict:
     """
     Book a flight for a customer using their provided credit card information.
@@ -96,92 +637,431 @@ def book_flight(customer_id: str, flight_id: int, credit_card_number: str, credi
     if not all([customer_id, flight_id, credit_card_number, credit_card_expiry, credit_card_cvv]):
         return {"error": "Missing required parameters"}
     
-    # Validate credit card number (basic check - should be 16 digits)
-    if not re.match(r'^\d{16}$', credit_card_number):
-        return {"error": "Invalid credit card number. Must be 16 digits."}
-    
-    # Validate expiry date (MM/YY format)
-    if not re.match(r'^(0[1-9]|1[0-2])/\d{2}$', credit_card_expiry):
-        return {"error": "Invalid expiry date. Must be in MM/YY format."}
+    payment_error = validate_payment(credit_card_number, credit_card_expiry, credit_card_cvv)
+    if payment_error:
+        return {"error": payment_error}
     
-    # Validate CVV (3 digits)
-    if not re.match(r'^\d{3}$', credit_card_cvv):
-        return {"error": "Invalid CVV. Must be 3 digits."}
+    booking_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    payment_status = "Completed"  # In a real system, this would depend on payment gateway response
+    card_last_four = credit_card_number[-4:]  # Store only last 4 digits for security
     
     try:
-        # Check if database exists
-        if not os.path.exists('data/flights.db'):
-            return {"error": "Flight database not found. Please run setup_flight_db.py first."}
-        
-        # Connect to the database
-        conn = sqlite3.connect('data/flights.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # Check if flight exists and has available seats
-        cursor.execute('''
-        SELECT * FROM flight_info
-        WHERE id = ? AND seats_available > 0
-        ''', (flight_id,))
-        
-        flight = cursor.fetchone()
-        if not flight:
-            conn.close()
-            return {"error": "Flight not found or no seats available."}
-        
-        # Get the flight price for payment
-        flight_price = flight['price']
-        
-        # Start transaction
-        conn.execute("BEGIN TRANSACTION")
-        
-        # Update seats available
-        cursor.execute('''
-        UPDATE flight_info
-        SET seats_available = seats_available - 1
-        WHERE id = ?
-        ''', (flight_id,))
-        
-        # Record booking
-        booking_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        payment_status = "Completed"  # In a real system, this would depend on payment gateway response
-        card_last_four = credit_card_number[-4:]  # Store only last 4 digits for security
-        
-        cursor.execute('''
-        INSERT INTO bookings 
-        (customer_id, flight_id, booking_date, payment_amount, payment_status, card_last_four)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ''', (customer_id, flight_id, booking_date, flight_price, payment_status, card_last_four))
-        
-        # Get the booking ID
-        booking_id = cursor.lastrowid
-        
-        # Commit transaction
-        conn.commit()
-        conn.close()
-        
-        return {
-            "success": True,
-            "booking_id": booking_id,
-            "message": f"Flight booked successfully! Booking ID: {booking_id}",
-            "details": {
-                "flight_number": flight['flight_number'],
-                "airline": flight['airline'],
-                "departure": flight['departure_location'],
-                "destination": flight['arrival_location'],
-                "date": flight['departure_date'],
-                "departure_time": flight['departure_time'],
-                "payment_amount": flight_price,
-                "payment_status": payment_status
-            }
+        # Check availability, take the seat and record the booking atomically
+        booking = db.transaction(
+            lambda conn: reserve_seat(conn, customer_id, flight_id, card_last_four, booking_date, payment_status)
+        )
+    except FileNotFoundError:
+        return {"error": DB_NOT_FOUND}
+    except Exception as e:
+        return {"error": f"Booking failed: {str(e)}"}
+    
+    if booking is None:
+        return {"error": "Flight not found or no seats available."}
+    
+    booking_id = booking["booking_id"]
+    flight = booking["flight"]
+    
+    # The seat count shown in cached searches for this route and day is now stale
+    search_cache.invalidate(route_key(flight))
+    return {
+        "success": True,
+        "booking_id": booking_id,
+        "message": f"Flight booked successfully! Booking ID: {booking_id}",
+        "details": booking_details(flight, payment_status)
+    }
+
+
+def booking_details(flight: sqlite3.Row, payment_status: str) -> Dict:
+    """Flight and payment summary returned with a booking confirmation."""
+    return {
+        "flight_number": flight['flight_number'],
+        "airline": flight['airline'],
+        "departure": flight['departure_location'],
+        "destination": flight['arrival_location'],
+        "date": flight['departure_date'],
+        "departure_time": flight['departure_time'],
+        "payment_amount": flight['price'],
+        "payment_status": payment_status
+    }
+
+INVOICE_FAILURE_MODES = ("rollback", "keep_booking")
+
+
+def start_invoice(conn: sqlite3.Connection, booking_id: int) -> Dict:
+    """
+    Record a booking's invoice as rendering. Must run inside a write transaction.
+    
+    The invoice is built from the booking and flight rows as stored, so it
+    can only show what was actually booked. The row carries everything
+    needed to render the PDF, so if this process dies before finishing it
+    the invoice server's job queue renders it on its next start.
+    
+    Returns:
+        The invoice row id, its display values and the invoice details
+    """
+    booking = conn.execute(BOOKING_FOR_INVOICE_SQL, (booking_id,)).fetchone()
+    invoice_number = new_invoice_number()
+    invoice_date = datetime.now().strftime('%Y-%m-%d')
+    filename = invoice_filename(booking_id, invoice_number)
+    values = booking_invoice_values(booking, invoice_number, invoice_date)
+    
+    cursor = conn.execute(START_INVOICE_SQL, (
+        booking_id, invoice_number, invoice_date, filename, json.dumps(values),
+        datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    ))
+    return {
+        "id": cursor.lastrowid,
+        "values": values,
+        "invoice": {
+            "status": "completed",
+            "invoice_number": invoice_number,
+            "invoice_date": invoice_date,
+            "filename": filename,
+            "path": invoice_path(filename),
+            "resource_uri": invoice_uri(invoice_number)
         }
+    }
+
+
+def set_invoice_status(invoice_id: int, status: str, error: Optional[str] = None) -> None:
+    """Record the outcome of rendering an invoice started by start_invoice."""
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    db.transaction(lambda conn: conn.execute(SET_INVOICE_STATUS_SQL, (status, error, now, invoice_id)))
+
+
+def cancel_booking(conn: sqlite3.Connection, booking_id: int, flight_id: int, invoice_id: int) -> None:
+    """Delete a booking and its invoice and give the seat back. Must run inside a write transaction."""
+    conn.execute("DELETE FROM invoices WHERE id = ?", (invoice_id,))
+    conn.execute("DELETE FROM bookings WHERE rowid = ?", (booking_id,))
+    conn.execute(RELEASE_SEAT_SQL, (flight_id,))
+
+
+def remove_files(paths: List[str]) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+@mcp.tool()
+@metrics.instrument_tool
+@write_executor.offload
+def book_and_invoice(customer_id: str, flight_id: int, credit_card_number: str, credit_card_expiry: str,
+                     credit_card_cvv: str, on_invoice_failure: str = "rollback") -> Dict:
+    """
+    Book a flight and generate its invoice in a single call.
+    
+    Use this instead of book_flight followed by generate_invoice. The seat,
+    the booking and the invoice record are written in one database
+    transaction. The invoice PDF is then rendered from the stored booking
+    and flight rows, outside the transaction so searches and other bookings
+    are not held up, and the invoice is marked completed. The invoice lives
+    in the shared flight database, so the invoice server sees it
+    (generate_invoice returns it and get_invoice_status reports it) whether
+    it runs in this process or another.
     
+    Args:
+        customer_id: The unique identifier for the customer
+        flight_id: The ID of the flight to book
+        credit_card_number: The customer's credit card number
+        credit_card_expiry: The expiry date of the credit card in MM/YY format
+        credit_card_cvv: The CVV security code of the credit card
+        on_invoice_failure: "rollback" (default) cancels the booking if the invoice
+            cannot be generated; "keep_booking" keeps the booking and reports the
+            invoice error with "partial": true
+    
+    Returns:
+        Dictionary with the booking confirmation and the invoice, or an error message
+    """
+    # Input validation
+    if not all([customer_id, flight_id, credit_card_number, credit_card_expiry, credit_card_cvv]):
+        return {"error": "Missing required parameters"}
+    
+    if on_invoice_failure not in INVOICE_FAILURE_MODES:
+        return {"error": f"on_invoice_failure must be one of: {', '.join(INVOICE_FAILURE_MODES)}."}
+    
+    payment_error = validate_payment(credit_card_number, credit_card_expiry, credit_card_cvv)
+    if payment_error:
+        return {"error": payment_error}
+    
+    booking_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    payment_status = "Completed"  # In a real system, this would depend on payment gateway response
+    card_last_four = credit_card_number[-4:]  # Store only last 4 digits for security
+    
+    def book(conn: sqlite3.Connection) -> Optional[Tuple[Dict, Dict]]:
+        booking = reserve_seat(conn, customer_id, flight_id, card_last_four, booking_date, payment_status)
+        if booking is None:
+            return None
+        return booking, start_invoice(conn, booking["booking_id"])
+    
+    try:
+        outcome = db.transaction(book)
+    except FileNotFoundError:
+        return {"error": DB_NOT_FOUND}
     except Exception as e:
-        # Rollback in case of error
-        if 'conn' in locals() and conn:
-            conn.rollback()
-            conn.close()
         return {"error": f"Booking failed: {str(e)}"}
+    
+    if outcome is None:
+        return {"error": "Flight not found or no seats available."}
+    
+    booking, started = outcome
+    booking_id = booking["booking_id"]
+    flight = booking["flight"]
+    invoice = started["invoice"]
+    try:
+        # The write lock is free again while the PDF is rendered
+        renderer.render_to_file(started["values"], invoice["path"])
+        set_invoice_status(started["id"], "completed")
+    except Exception as e:
+        remove_files([invoice["path"]])
+        try:
+            if on_invoice_failure == "rollback":
+                db.transaction(lambda conn: cancel_booking(conn, booking_id, flight["id"], started["id"]))
+                search_cache.invalidate(route_key(flight))
+                return {"error": f"Invoice generation failed, booking rolled back: {str(e)}", "rolled_back": True}
+            set_invoice_status(started["id"], "failed", str(e))
+        except Exception as cleanup_error:
+            # The invoice stays rendering; the invoice server retries it on its next start
+            return {"error": f"Invoice generation failed: {str(e)}; booking {booking_id} kept: {str(cleanup_error)}",
+                    "booking_id": booking_id, "partial": True}
+        invoice = {"error": f"Invoice generation failed: {str(e)}"}
+    
+    search_cache.invalidate(route_key(flight))
+    
+    result = {
+        "success": True,
+        "booking_id": booking_id,
+        "message": f"Flight booked successfully! Booking ID: {booking_id}",
+        "details": booking_details(flight, payment_status),
+        "invoice": invoice
+    }
+    if "error" in invoice:
+        result["partial"] = True
+    else:
+        result["message"] += f" Invoice generated: {invoice['invoice_number']}"
+    return result
+
+
+@mcp.tool()
+@metrics.instrument_tool
+@write_executor.offload
+def book_flights_batch(bookings: List[Dict], credit_card_number: str, credit_card_expiry: str, credit_card_cvv: str) -> Dict:
+    """
+    Book several flights in one transaction, e.g. for a group or corporate booking.
+    
+    Each booking is attempted independently: a sold-out or unknown flight
+    fails only its own entry and the rest are still booked.
+    
+    Args:
+        bookings: List of {"customer_id": str, "flight_id": int} entries (at most 100)
+        credit_card_number: The credit card number paying for all bookings
+        credit_card_expiry: The expiry date of the credit card in MM/YY format
+        credit_card_cvv: The CVV security code of the credit card
+    
+    Returns:
+        Dictionary with per-booking results in request order, plus counts of
+        booked and failed entries, or an error message
+    """
+    # Input validation
+    if not all([bookings, credit_card_number, credit_card_expiry, credit_card_cvv]):
+        return {"error": "Missing required parameters"}
+    
+    if len(bookings) > MAX_BATCH_BOOKINGS:
+        return {"error": f"Too many bookings in one batch. Maximum is {MAX_BATCH_BOOKINGS}."}
+    
+    payment_error = validate_payment(credit_card_number, credit_card_expiry, credit_card_cvv)
+    if payment_error:
+        return {"error": payment_error}
+    
+    booking_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    payment_status = "Completed"
+    card_last_four = credit_card_number[-4:]
+    
+    booked_routes = set()
+    
+    def book_all(conn: sqlite3.Connection) -> List[Dict]:
+        results = []
+        for index, item in enumerate(bookings):
+            customer_id = item.get("customer_id") if isinstance(item, dict) else None
+            flight_id = item.get("flight_id") if isinstance(item, dict) else None
+            result = {"index": index, "customer_id": customer_id, "flight_id": flight_id}
+            if not customer_id or not flight_id:
+                result.update(success=False, error="Missing customer_id or flight_id")
+                results.append(result)
+                continue
+            
+            # A savepoint per entry keeps one failing insert from undoing the others
+            conn.execute("SAVEPOINT batch_item")
+            try:
+                booking = reserve_seat(conn, str(customer_id), int(flight_id), card_last_four, booking_date, payment_status)
+                conn.execute("RELEASE batch_item")
+            except (sqlite3.IntegrityError, ValueError, TypeError) as e:
+                conn.execute("ROLLBACK TO batch_item")
+                conn.execute("RELEASE batch_item")
+                result.update(success=False, error=f"Booking failed: {str(e)}")
+                results.append(result)
+                continue
+            
+            if booking is None:
+                result.update(success=False, error="Flight not found or no seats available.")
+            else:
+                booked_routes.add(route_key(booking["flight"]))
+                result.update(
+                    success=True,
+                    booking_id=booking["booking_id"],
+                    payment_amount=booking["flight"]["price"],
+                    flight_number=booking["flight"]["flight_number"],
+                    departure_date=booking["flight"]["departure_date"]
+                )
+            results.append(result)
+        return results
+    
+    try:
+        results = db.transaction(book_all)
+    except FileNotFoundError:
+        return {"error": DB_NOT_FOUND}
+    except Exception as e:
+        return {"error": f"Batch booking failed: {str(e)}"}
+    
+    search_cache.invalidate(*booked_routes)
+    
+    booked = sum(1 for result in results if result["success"])
+    return {
+        "success": booked == len(results),
+        "booked": booked,
+        "failed": len(results) - booked,
+        "payment_status": payment_status,
+        "results": results
+    }
+
+
+def encode_booking_cursor(booking_date: str, booking_id: int) -> str:
+    """Opaque keyset cursor pointing just after the given (booking_date, booking_id) position."""
+    return base64.urlsafe_b64encode(json.dumps([booking_date, booking_id]).encode()).decode()
+
+
+def decode_booking_cursor(cursor: str) -> Tuple[str, int]:
+    """Inverse of encode_booking_cursor. Raises ValueError for malformed cursors."""
+    try:
+        booking_date, booking_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(booking_date), int(booking_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def booking_to_dict(row: Dict) -> Dict:
+    """Convert a LIST_BOOKINGS_SQL row to the dictionary returned by list_bookings."""
+    return {
+        "booking_id": row['booking_id'],
+        "booking_date": row['booking_date'],
+        "payment_amount": row['payment_amount'],
+        "payment_status": row['payment_status'],
+        "card_last_four": row['card_last_four'],
+        "flight_id": row['flight_id'],
+        "flight_number": row['flight_number'],
+        "airline": row['airline'],
+        "departure_location": row['departure_location'],
+        "arrival_location": row['arrival_location'],
+        "departure_date": row['departure_date'],
+        "departure_time": row['departure_time'],
+        "arrival_time": row['arrival_time']
+    }
+
+
+@mcp.tool()
+@metrics.instrument_tool
+@tool_executor.offload
+def list_bookings(customer_id: str, cursor: Optional[str] = None, limit: int = 20) -> Dict:
+    """
+    List a customer's bookings with their flight details, newest first.
+    
+    Args:
+        customer_id: The ID of the customer
+        cursor: Optional next_cursor value from a previous page
+        limit: Maximum number of bookings to return (default 20, at most 100)
+    
+    Returns:
+        Dictionary containing a page of bookings and next_cursor (null on the
+        last page), or an error message
+    """
+    if not customer_id:
+        return {"error": "Missing required parameters"}
+    
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return {"error": f"limit must be between 1 and {MAX_PAGE_SIZE}."}
+    
+    try:
+        after = decode_booking_cursor(cursor) if cursor else None
+    except ValueError:
+        return {"error": "Invalid cursor. Use the next_cursor value from a previous list_bookings call."}
+    
+    try:
+        # One extra row tells whether another page follows
+        with db.reader() as conn:
+            if after is None:
+                rows = conn.execute(LIST_BOOKINGS_SQL, (customer_id, limit + 1)).fetchall()
+            else:
+                rows = conn.execute(LIST_BOOKINGS_PAGE_SQL, (customer_id,) + after + (limit + 1,)).fetchall()
+    except FileNotFoundError:
+        return {"error": DB_NOT_FOUND}
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}"}
+    
+    if not rows and after is None:
+        return {"message": f"No bookings found for customer {customer_id}."}
+    
+    page = [booking_to_dict(row) for row in archive.with_flights(rows[:limit])]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_booking_cursor(page[-1]["booking_date"], page[-1]["booking_id"])
+    
+    return {
+        "bookings": page,
+        "returned": len(page),
+        "next_cursor": next_cursor
+    }
+
+
+@mcp.tool()
+@tool_executor.offload
+def get_server_metrics(format: str = "json") -> Union[Dict, str]:
+    """
+    Report latency metrics for this server's tools and SQL statements.
+    
+    Args:
+        format: "json" for per-tool, per-statement and per-phase summaries with the
+            slow-query log, or "prometheus" for the Prometheus text exposition format
+    
+    Returns:
+        Dictionary of metrics and cache statistics, or the Prometheus text
+    """
+    if format == "prometheus":
+        return metrics.prometheus_text()
+    if format != "json":
+        return {"error": "format must be 'json' or 'prometheus'."}
+    
+    result = metrics.snapshot()
+    result["search_cache"] = search_cache.stats()
+    result["route_graph"] = route_graph.stats()
+    result["flight_columns"] = flight_columns.stats()
+    result["flight_archive"] = archive.stats()
+    result["locations"] = locations.stats()
+    result["single_flight"] = searches.stats()
+    result["tool_executor"] = tool_executor.stats()
+    result["write_executor"] = write_executor.stats()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Flight search MCP server")
+    add_transport_arguments(parser)
+    args = parser.parse_args()
+    
+    init_database()
+    serve(mcp, args)
+
 
 if __name__ == "__main__":
-    mcp.run(transport="stdio") 
\ No newline at end of file
+    main()
+ 
\ No newline at end of file
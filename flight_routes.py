@@ -0,0 +1,293 @@
+import heapq
+import threading
+from bisect import bisect_left, insort
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
+
+from flight_db import FlightDatabase, read_flight_changes, change_log_position
+
+MINUTES_PER_DAY = 24 * 60
+
+# Minimum connection times in minutes. Connections on the same airline can
+# be tighter than interline ones, which need a bag transfer and re-check-in.
+MIN_CONNECTION_SAME_AIRLINE = 45
+MIN_CONNECTION_INTERLINE = 90
+MAX_CONNECTION_MINUTES = 12 * 60
+
+
+def minutes_since_epoch(day: str, hhmm: str) -> int:
+    """Convert a YYYY-MM-DD date and HH:MM time to minutes since 0001-01-01."""
+    hours, minutes = hhmm.split(":")
+    return date.fromisoformat(day).toordinal() * MINUTES_PER_DAY + int(hours) * 60 + int(minutes)
+
+
+def format_minutes(value: int) -> Tuple[str, str]:
+    """Inverse of minutes_since_epoch, as (YYYY-MM-DD, HH:MM)."""
+    day, minute = divmod(value, MINUTES_PER_DAY)
+    return date.fromordinal(day).isoformat(), f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+class Leg:
+    """A single scheduled flight with its times resolved to absolute minutes."""
+
+    __slots__ = (
+        "flight_id", "flight_number", "airline", "origin", "destination",
+        "departure_date", "departure_time", "arrival_time",
+        "departs", "arrives", "price", "seats_available",
+    )
+
+    def __init__(self, row):
+        self.flight_id = row["id"]
+        self.flight_number = row["flight_number"]
+        self.airline = row["airline"]
+        self.origin = row["departure_location"]
+        self.destination = row["arrival_location"]
+        self.departure_date = row["departure_date"]
+        self.departure_time = row["departure_time"]
+        self.arrival_time = row["arrival_time"]
+        self.departs = minutes_since_epoch(self.departure_date, self.departure_time)
+        # The schedule only stores clock times; an arrival earlier than the
+        # departure lands the next day.
+        self.arrives = minutes_since_epoch(self.departure_date, self.arrival_time)
+        if self.arrives <= self.departs:
+            self.arrives += MINUTES_PER_DAY
+        self.price = row["price"]
+        self.seats_available = row["seats_available"]
+
+    def sort_key(self) -> Tuple[int, int]:
+        return (self.departs, self.flight_id)
+
+    def to_dict(self) -> Dict:
+        arrival_date, _ = format_minutes(self.arrives)
+        return {
+            "flight_id": self.flight_id,
+            "flight_number": self.flight_number,
+            "airline": self.airline,
+            "departure_location": self.origin,
+            "arrival_location": self.destination,
+            "departure_date": self.departure_date,
+            "departure_time": self.departure_time,
+            "arrival_date": arrival_date,
+            "arrival_time": self.arrival_time,
+            "price": self.price,
+            "seats_available": self.seats_available,
+        }
+
+
+def min_connection_minutes(arriving: Leg, departing: Leg) -> int:
+    """Minimum connection time between two legs."""
+    if arriving.airline == departing.airline:
+        return MIN_CONNECTION_SAME_AIRLINE
+    return MIN_CONNECTION_INTERLINE
+
+
+class RouteGraph:
+    """
+    In-memory adjacency index of the flight schedule.
+
+    Legs are grouped by (departure day, origin) and kept sorted by departure
+    time, so the onward flights that fit a connection window are found with
+    a bisect instead of a SQL self-join. The index is built from flight_info
+    on first use and afterwards kept current from the flight_changes log,
+    re-reading only the flights that changed since the last refresh.
+    """
+
+    def __init__(self, db: FlightDatabase):
+        self.db = db
+        self._lock = threading.Lock()
+        self._legs: Dict[int, Leg] = {}
+        self._by_day_origin: Dict[Tuple[int, str], List[Tuple[Tuple[int, int], Leg]]] = {}
+        self._position: Optional[int] = None
+        self.rebuilds = 0
+        self.incremental_refreshes = 0
+
+    def refresh(self) -> None:
+        """Bring the index up to date with the database."""
+        with self._lock:
+            with self.db.reader() as conn:
+                # One read transaction so the change log position and the
+                # flights read match the same snapshot.
+                conn.execute("BEGIN")
+                if self._position is None:
+                    self._rebuild(conn)
+                    return
+                position, changed = read_flight_changes(conn, self._position)
+                if changed is None:
+                    self._rebuild(conn)
+                    return
+                if changed:
+                    self._apply_changes(conn, changed)
+                    self.incremental_refreshes += 1
+                self._position = position
+
+    def _rebuild(self, conn) -> None:
+        self._position = change_log_position(conn)
+        self._legs = {}
+        self._by_day_origin = {}
+        for row in conn.execute("SELECT * FROM flight_info"):
+            self._add(Leg(row))
+        for legs in self._by_day_origin.values():
+            legs.sort(key=lambda entry: entry[0])
+        self.rebuilds += 1
+
+    def _apply_changes(self, conn, flight_ids: List[int]) -> None:
+        rows = {}
+        # Stay well below SQLite's bound parameter limit
+        for start in range(0, len(flight_ids), 500):
+            chunk = flight_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for row in conn.execute(f"SELECT * FROM flight_info WHERE id IN ({placeholders})", chunk):
+                rows[row["id"]] = row
+        for flight_id in flight_ids:
+            old = self._legs.get(flight_id)
+            row = rows.get(flight_id)
+            if old is not None and row is not None and self._same_slot(old, row):
+                # Seat or price change: update in place
+                old.seats_available = row["seats_available"]
+                old.price = row["price"]
+                continue
+            if old is not None:
+                self._remove(old)
+            if row is not None:
+                leg = Leg(row)
+                self._add(leg, keep_sorted=True)
+
+    @staticmethod
+    def _same_slot(leg: Leg, row) -> bool:
+        return (leg.origin == row["departure_location"]
+                and leg.destination == row["arrival_location"]
+                and leg.departure_date == row["departure_date"]
+                and leg.departure_time == row["departure_time"]
+                and leg.arrival_time == row["arrival_time"]
+                and leg.flight_number == row["flight_number"]
+                and leg.airline == row["airline"])
+
+    def _add(self, leg: Leg, keep_sorted: bool = False) -> None:
+        self._legs[leg.flight_id] = leg
+        bucket = self._by_day_origin.setdefault((leg.departs // MINUTES_PER_DAY, leg.origin), [])
+        if keep_sorted:
+            insort(bucket, (leg.sort_key(), leg), key=lambda entry: entry[0])
+        else:
+            bucket.append((leg.sort_key(), leg))
+
+    def _remove(self, leg: Leg) -> None:
+        del self._legs[leg.flight_id]
+        key = (leg.departs // MINUTES_PER_DAY, leg.origin)
+        bucket = self._by_day_origin[key]
+        index = bisect_left(bucket, leg.sort_key(), key=lambda entry: entry[0])
+        if index < len(bucket) and bucket[index][1] is leg:
+            del bucket[index]
+        if not bucket:
+            del self._by_day_origin[key]
+
+    def _departures(self, origin: str, earliest: int, latest: int):
+        """Yield legs leaving origin with departure minute in [earliest, latest]."""
+        for day in range(earliest // MINUTES_PER_DAY, latest // MINUTES_PER_DAY + 1):
+            bucket = self._by_day_origin.get((day, origin))
+            if not bucket:
+                continue
+            start = bisect_left(bucket, (earliest, -1), key=lambda entry: entry[0])
+            for key, leg in bucket[start:]:
+                if key[0] > latest:
+                    break
+                yield leg
+
+    def search(self, origin: str, destination: str, departure_date: str, max_stops: int = 2,
+               sort_by: str = "price", limit: int = 5,
+               max_connection_minutes: int = MAX_CONNECTION_MINUTES) -> List[Dict]:
+        """
+        Find the best itineraries from origin to destination leaving on a day.
+
+        Args:
+            origin: The city of departure
+            destination: The destination city
+            departure_date: Day the first leg departs, YYYY-MM-DD
+            max_stops: Maximum number of connections (0-2)
+            sort_by: "price" for cheapest total fare or "duration" for
+                shortest door-to-door time
+            limit: Number of itineraries to return
+            max_connection_minutes: Longest acceptable layover
+
+        Returns:
+            Itineraries ordered best first
+        """
+        day = datetime.strptime(departure_date, "%Y-%m-%d").date().toordinal()
+        day_start = day * MINUTES_PER_DAY
+
+        def cost(path: List[Leg]) -> float:
+            if sort_by == "duration":
+                return path[-1].arrives - path[0].departs
+            return sum(leg.price for leg in path)
+
+        # Max-heap (negated cost) of the best `limit` itineraries found so far
+        best: List[Tuple[float, int, List[Leg]]] = []
+        counter = 0
+
+        def worst() -> float:
+            return -best[0][0] if len(best) >= limit else float("inf")
+
+        def extend(path: List[Leg], visited: set) -> None:
+            nonlocal counter
+            last = path[-1]
+            if last.destination == destination:
+                counter += 1
+                entry = (-cost(path), counter, list(path))
+                if len(best) < limit:
+                    heapq.heappush(best, entry)
+                else:
+                    heapq.heappushpop(best, entry)
+                return
+            if len(path) > max_stops:
+                return
+            earliest = last.arrives + MIN_CONNECTION_SAME_AIRLINE
+            for leg in self._departures(last.destination, earliest, last.arrives + max_connection_minutes):
+                if leg.seats_available <= 0 or leg.destination in visited:
+                    continue
+                if leg.departs - last.arrives < min_connection_minutes(last, leg):
+                    continue
+                path.append(leg)
+                # Both costs only grow as legs are added, so a partial
+                # itinerary already worse than the current worst is dropped.
+                if cost(path) < worst():
+                    visited.add(leg.destination)
+                    extend(path, visited)
+                    visited.discard(leg.destination)
+                path.pop()
+
+        with self._lock:
+            for leg in self._departures(origin, day_start, day_start + MINUTES_PER_DAY - 1):
+                if leg.seats_available <= 0 or leg.destination == origin:
+                    continue
+                extend([leg], {origin, leg.destination})
+
+        itineraries = []
+        for negated_cost, _, path in sorted(best, key=lambda entry: (-entry[0], entry[1])):
+            legs = [leg.to_dict() for leg in path]
+            layovers = [
+                {"city": arriving.destination, "minutes": departing.departs - arriving.arrives}
+                for arriving, departing in zip(path, path[1:])
+            ]
+            arrival_date, arrival_time = format_minutes(path[-1].arrives)
+            itineraries.append({
+                "stops": len(path) - 1,
+                "total_price": round(sum(leg.price for leg in path), 2),
+                "total_duration_minutes": path[-1].arrives - path[0].departs,
+                "departure_date": path[0].departure_date,
+                "departure_time": path[0].departure_time,
+                "arrival_date": arrival_date,
+                "arrival_time": arrival_time,
+                "legs": legs,
+                "layovers": layovers,
+            })
+        return itineraries
+
+    def stats(self) -> Dict:
+        """Return index size and refresh counters."""
+        with self._lock:
+            return {
+                "flights": len(self._legs),
+                "buckets": len(self._by_day_origin),
+                "change_log_position": self._position,
+                "rebuilds": self.rebuilds,
+                "incremental_refreshes": self.incremental_refreshes,
+            }
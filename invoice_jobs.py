@@ -0,0 +1,171 @@
+import json
+import queue
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from flight_db import FlightDatabase
+from invoice_renderer import InvoiceRenderer, invoice_filename, invoice_path
+
+RESERVE_INVOICE_SQL = '''
+INSERT INTO invoices (booking_id, invoice_number, invoice_date, filename, status, payload, updated_at)
+VALUES (?, ?, ?, ?, 'queued', ?, ?)
+'''
+
+INVOICE_STATUS_SQL = '''
+SELECT id, booking_id, invoice_number, invoice_date, filename, status, error, updated_at
+FROM invoices WHERE invoice_number = ?
+'''
+
+PENDING_INVOICES_SQL = '''
+SELECT id, filename, payload FROM invoices
+WHERE status IN ('queued', 'rendering') AND id > ? AND id <= ?
+ORDER BY id
+LIMIT ?
+'''
+
+UPDATE_INVOICE_STATUS_SQL = '''
+UPDATE invoices SET status = ?, error = ?, updated_at = ? WHERE id = ?
+'''
+
+
+class QueueFullError(Exception):
+    """Raised when the invoice queue has no room for another job."""
+
+
+class InvoiceJobQueue:
+    """
+    Background invoice rendering with job state kept in the invoices table.
+
+    submit() reserves the invoice number by inserting a 'queued' row that
+    carries everything needed to render it, then hands the row to a bounded
+    in-memory queue drained by worker threads. Rows move through 'queued',
+    'rendering' and 'completed' or 'failed'. On start(), rows left queued or
+    rendering by a previous process are picked up again, so accepted jobs
+    survive restarts. When the queue is full, submit() refuses new jobs
+    instead of letting them pile up.
+    """
+
+    def __init__(self, db: FlightDatabase, renderer: InvoiceRenderer, out_dir: str,
+                 maxsize: int = 256, workers: int = 2):
+        self.db = db
+        self.renderer = renderer
+        self.out_dir = out_dir
+        self.workers = workers
+        self._queue: "queue.Queue[tuple]" = queue.Queue(maxsize=maxsize)
+        self._threads: List[threading.Thread] = []
+        self._start_lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self) -> None:
+        """Start the workers and re-queue jobs left unfinished by a previous run."""
+        with self._start_lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"invoice-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            # Jobs reserved from now on are queued by submit() itself
+            with self.db.reader() as conn:
+                boundary = conn.execute("SELECT MAX(id) FROM invoices").fetchone()[0] or 0
+            recovery = threading.Thread(target=self._recover, args=(boundary,), name="invoice-recovery", daemon=True)
+            recovery.start()
+            self._threads.append(recovery)
+
+    def _recover(self, boundary: int) -> None:
+        # Blocking puts: recovered jobs wait for room rather than being dropped
+        last_id = 0
+        while True:
+            with self.db.reader() as conn:
+                rows = conn.execute(PENDING_INVOICES_SQL, (last_id, boundary, 500)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                self._queue.put((row["id"], row["filename"], json.loads(row["payload"])))
+                last_id = row["id"]
+
+    def submit(self, booking_id: int, values: Dict[str, str]) -> Dict:
+        """
+        Reserve an invoice number and queue the invoice for rendering.
+
+        Args:
+            booking_id: The booking being invoiced
+            values: Display strings for the invoice (see format_invoice_values)
+
+        Returns:
+            The reserved invoice number, date and file name
+
+        Raises:
+            QueueFullError: If the queue is at capacity
+        """
+        self.start()
+        if self._queue.full():
+            self.rejected += 1
+            raise QueueFullError()
+
+        invoice_number = values["invoice_number"]
+        filename = invoice_filename(booking_id, invoice_number)
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        payload = json.dumps(values)
+        job_id = self.db.transaction(lambda conn: conn.execute(RESERVE_INVOICE_SQL, (
+            booking_id, invoice_number, values["invoice_date"], filename, payload, now
+        )).lastrowid)
+
+        try:
+            self._queue.put_nowait((job_id, filename, values))
+        except queue.Full:
+            # Lost the race for the last slot; release the reservation
+            self.db.transaction(lambda conn: conn.execute("DELETE FROM invoices WHERE id = ?", (job_id,)))
+            self.rejected += 1
+            raise QueueFullError()
+
+        return {"invoice_number": invoice_number, "invoice_date": values["invoice_date"], "filename": filename}
+
+    def _set_status(self, job_id: int, status: str, error: Optional[str] = None) -> None:
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.db.transaction(lambda conn: conn.execute(UPDATE_INVOICE_STATUS_SQL, (status, error, now, job_id)))
+
+    def _work(self) -> None:
+        while True:
+            job_id, filename, values = self._queue.get()
+            try:
+                self._set_status(job_id, "rendering")
+                self.renderer.render_to_file(values, invoice_path(filename, self.out_dir))
+                self._set_status(job_id, "completed")
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                try:
+                    self._set_status(job_id, "failed", f"Invoice generation failed: {str(e)}")
+                except sqlite3.Error:
+                    # Left as 'rendering'; picked up again after a restart
+                    pass
+            finally:
+                self._queue.task_done()
+
+    def status(self, invoice_number: str) -> Optional[Dict]:
+        """Return the job state of an invoice, or None if it is unknown."""
+        with self.db.reader() as conn:
+            row = conn.execute(INVOICE_STATUS_SQL, (invoice_number,)).fetchone()
+        if row is None:
+            return None
+        return dict(row)
+
+    def stats(self) -> Dict:
+        """Return queue depth and job counters."""
+        return {
+            "queued": self._queue.qsize(),
+            "capacity": self._queue.maxsize,
+            "workers": self.workers,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+    def join(self) -> None:
+        """Block until every queued job has been processed."""
+        self._queue.join()
@@ -0,0 +1,434 @@
+import hashlib
+import os
+import re
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+from io import BytesIO
+from typing import TYPE_CHECKING, Any, Dict, Hashable, List, Mapping, Optional, Tuple
+
+from metrics import metrics
+
+if TYPE_CHECKING:
+    from fpdf import FPDF
+
+# Invoice PDFs are written here by every service sharing the database
+INVOICE_DIR = os.path.join("data", "invoices")
+
+# Variable fields of an invoice, in the order they appear on the page
+INVOICE_FIELDS = (
+    "invoice_number", "invoice_date", "booking_id", "customer_id",
+    "flight_number", "airline", "departure_city", "arrival_city",
+    "departure_date", "departure_time",
+    "payment_amount", "card_last_four", "payment_status",
+)
+
+_PLACEHOLDER = "@@{}@@"
+_PLACEHOLDER_RE = re.compile(r"@@(\w+)@@")
+_CREATION_DATE_RE = re.compile(r"/CreationDate \(D:(\d{14})\)")
+
+
+def draw_invoice(pdf: "FPDF", values: Dict[str, str]) -> None:
+    """
+    Lay out an invoice on a new page of pdf.
+
+    Args:
+        pdf: The document to draw on
+        values: Display strings for every name in INVOICE_FIELDS
+    """
+    pdf.add_page()
+
+    # Header
+    pdf.set_font("Arial", "B", 16)
+    pdf.cell(190, 10, "FLIGHT BOOKING INVOICE", 0, 1, "C")
+    pdf.ln(10)
+
+    def row(label: str, value: str) -> None:
+        pdf.set_font("Arial", "B", 12)
+        pdf.cell(50, 10, label, 0, 0)
+        pdf.set_font("Arial", "", 12)
+        pdf.cell(140, 10, value, 0, 1)
+
+    # Invoice details
+    row("Invoice Number:", values["invoice_number"])
+    row("Invoice Date:", values["invoice_date"])
+    row("Booking ID:", values["booking_id"])
+    row("Customer ID:", values["customer_id"])
+
+    pdf.ln(10)
+
+    # Flight details
+    pdf.set_font("Arial", "B", 14)
+    pdf.cell(190, 10, "Flight Details", 0, 1)
+
+    row("Flight Number:", values["flight_number"])
+    row("Airline:", values["airline"])
+    row("From:", values["departure_city"])
+    row("To:", values["arrival_city"])
+    row("Date:", values["departure_date"])
+    row("Departure Time:", values["departure_time"])
+
+    pdf.ln(10)
+
+    # Payment details
+    pdf.set_font("Arial", "B", 14)
+    pdf.cell(190, 10, "Payment Details", 0, 1)
+
+    row("Payment Amount:", values["payment_amount"])
+    row("Payment Method:", values["card_last_four"])
+    row("Payment Status:", values["payment_status"])
+
+    # Footer
+    pdf.ln(20)
+    pdf.set_font("Arial", "I", 10)
+    pdf.cell(190, 10, "Thank you for your booking!", 0, 1, "C")
+
+
+def format_invoice_values(invoice_number: str, invoice_date: str, booking_id: int, customer_id: str,
+                          flight_number: str, airline: str, departure_city: str, arrival_city: str,
+                          departure_date: str, departure_time: str, payment_amount: float,
+                          card_last_four: str, payment_status: str = "Completed") -> Dict[str, str]:
+    """Turn raw invoice data into the display strings drawn on the page."""
+    return {
+        "invoice_number": invoice_number,
+        "invoice_date": invoice_date,
+        "booking_id": str(booking_id),
+        "customer_id": str(customer_id),
+        "flight_number": flight_number,
+        "airline": airline,
+        "departure_city": departure_city,
+        "arrival_city": arrival_city,
+        "departure_date": departure_date,
+        "departure_time": departure_time,
+        "payment_amount": f"${payment_amount:.2f}",
+        "card_last_four": f"Credit Card (ending in {card_last_four})",
+        "payment_status": payment_status,
+    }
+
+
+def booking_invoice_values(booking: Mapping, invoice_number: str, invoice_date: str) -> Dict[str, str]:
+    """
+    Display strings for a booking joined with its flight.
+
+    Args:
+        booking: Row or dict with booking_id, customer_id, payment_amount,
+            card_last_four, payment_status, flight_number, airline,
+            departure_location, arrival_location, departure_date and
+            departure_time
+        invoice_number: Invoice number printed on the invoice
+        invoice_date: Invoice date, YYYY-MM-DD
+    """
+    return format_invoice_values(
+        invoice_number, invoice_date, booking["booking_id"], booking["customer_id"],
+        booking["flight_number"], booking["airline"],
+        booking["departure_location"], booking["arrival_location"],
+        booking["departure_date"], booking["departure_time"],
+        float(booking["payment_amount"]), booking["card_last_four"],
+        booking["payment_status"] or "Completed",
+    )
+
+
+def render_invoice_direct(values: Dict[str, str]) -> bytes:
+    """Render an invoice by drawing the whole page with FPDF (the uncached path)."""
+    from fpdf import FPDF
+    pdf = FPDF()
+    draw_invoice(pdf, values)
+    return pdf.output(dest="S").encode("latin1")
+
+
+class InvoiceRenderer:
+    """
+    Renders invoice PDFs from a layout built once and cached.
+
+    The first render lays out the page with FPDF using placeholder values
+    and keeps the resulting document split into fixed byte ranges: every
+    object except the page content stream, plus the content stream itself
+    cut at the placeholders. Later renders only splice the escaped field
+    values into the content stream, compress it and patch the cross
+    reference table, so no FPDF calls are made per invoice. Left-aligned
+    cells are positioned independently of their text, which is what makes
+    the splice exact. Thread-safe.
+    """
+
+    def __init__(self, compress: bool = True):
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._template: Optional[Tuple] = None
+
+    def _build_template(self) -> Tuple:
+        # fpdf is only needed to lay out the template, so it is imported on
+        # first use rather than when a server starts
+        from fpdf import FPDF
+        pdf = FPDF()
+        pdf.set_compression(False)
+        draw_invoice(pdf, {field: _PLACEHOLDER.format(field) for field in INVOICE_FIELDS})
+        content = pdf.pages[1]
+        document = pdf.output(dest="S")
+
+        # Split the content stream into static chunks and field names
+        parts = _PLACEHOLDER_RE.split(content)
+        static_chunks = [chunk.encode("latin1") for chunk in parts[0::2]]
+        field_order = parts[1::2]
+
+        # Locate the content stream object (always object 4 for a one-page
+        # FPDF document) and the cross reference table
+        stream_start = document.index(content)
+        object_start = document.rindex("4 0 obj\n", 0, stream_start)
+        object_end = document.index("endobj\n", stream_start) + len("endobj\n")
+        xref_start = document.rindex("\nxref\n") + 1
+        xref_lines = document[xref_start:].split("\n")
+        object_count = int(xref_lines[1].split()[1])
+        offsets = [int(line[:10]) for line in xref_lines[3:3 + object_count - 1]]
+        trailer = "\n".join(xref_lines[3 + object_count - 1:])
+        trailer = trailer[:trailer.index("startxref")]
+
+        head = document[:object_start].encode("latin1")
+        tail = document[object_end:xref_start]
+        date_match = _CREATION_DATE_RE.search(tail)
+        tail_bytes = tail.encode("latin1")
+        date_span = (date_match.start(1), date_match.end(1)) if date_match else None
+
+        return (head, static_chunks, field_order, object_start, object_end,
+                offsets, tail_bytes, date_span, trailer.encode("latin1"))
+
+    def _get_template(self) -> Tuple:
+        if self._template is None:
+            with self._lock:
+                if self._template is None:
+                    self._template = self._build_template()
+        return self._template
+
+    def render(self, values: Dict[str, str]) -> bytes:
+        """
+        Render one invoice to PDF bytes.
+
+        Args:
+            values: Display strings for every name in INVOICE_FIELDS, as
+                returned by format_invoice_values
+
+        Returns:
+            The complete PDF document
+        """
+        (head, static_chunks, field_order, object_start, object_end,
+         offsets, tail, date_span, trailer) = self._get_template()
+
+        pieces: List[bytes] = [static_chunks[0]]
+        for field, chunk in zip(field_order, static_chunks[1:]):
+            pieces.append(_escape(values[field]))
+            pieces.append(chunk)
+        stream = b"".join(pieces)
+        if self.compress:
+            stream = zlib.compress(stream)
+            header = b"4 0 obj\n<</Filter /FlateDecode /Length %d>>\nstream\n" % len(stream)
+        else:
+            header = b"4 0 obj\n<</Length %d>>\nstream\n" % len(stream)
+        content_object = header + stream + b"\nendstream\nendobj\n"
+
+        if date_span is not None:
+            now = datetime.now().strftime("%Y%m%d%H%M%S").encode()
+            tail = tail[:date_span[0]] + now + tail[date_span[1]:]
+
+        # Objects written after the content stream move by its size change
+        shift = len(content_object) - (object_end - object_start)
+        xref_position = len(head) + len(content_object) + len(tail)
+        xref = [b"xref\n0 %d\n0000000000 65535 f \n" % (len(offsets) + 1)]
+        for offset in offsets:
+            if offset > object_start:
+                offset += shift
+            xref.append(b"%010d 00000 n \n" % offset)
+
+        return b"".join((
+            head, content_object, tail, *xref,
+            trailer, b"startxref\n%d\n%%%%EOF\n" % xref_position,
+        ))
+
+    def render_to_buffer(self, values: Dict[str, str]) -> BytesIO:
+        """Render one invoice into an in-memory buffer positioned at the start."""
+        return BytesIO(self.render(values))
+
+    def render_to_file(self, values: Dict[str, str], path: str) -> int:
+        """
+        Render one invoice and write it to path, creating its directory if needed.
+
+        Returns:
+            The number of bytes written
+        """
+        with metrics.timer("phase", "invoice.render"):
+            data = self.render(values)
+        with metrics.timer("phase", "invoice.write"):
+            try:
+                f = open(path, "wb")
+            except FileNotFoundError:
+                # First invoice in this shard directory
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                f = open(path, "wb")
+            with f:
+                f.write(data)
+        return len(data)
+
+
+_shared_renderer: Optional[InvoiceRenderer] = None
+
+
+def shared_renderer() -> InvoiceRenderer:
+    """Return the process-wide renderer, so services in one process share its template."""
+    global _shared_renderer
+    if _shared_renderer is None:
+        _shared_renderer = InvoiceRenderer()
+    return _shared_renderer
+
+
+def _escape(value: str) -> bytes:
+    """Escape a value for a PDF string literal in the latin-1 core fonts."""
+    escaped = value.replace("\\", "\\\\").replace(")", "\\)").replace("(", "\\(").replace("\r", "\\r")
+    return escaped.encode("latin1", errors="replace")
+
+
+def new_invoice_number() -> str:
+    """Return a fresh, random invoice number."""
+    return f"INV-{uuid.uuid4().hex[:8].upper()}"
+
+
+def invoice_filename(booking_id: int, invoice_number: str) -> str:
+    """File name an invoice PDF is stored under."""
+    return f"invoice_{booking_id}_{invoice_number}.pdf"
+
+
+def invoice_path(filename: str, out_dir: str = INVOICE_DIR) -> str:
+    """
+    Path an invoice PDF is stored at.
+
+    Files are spread over 256 x 256 shard directories by a hash of the file
+    name, so a directory holds a few dozen files per million invoices.
+    """
+    digest = hashlib.md5(filename.encode(), usedforsecurity=False).hexdigest()
+    return os.path.join(out_dir, digest[:2], digest[2:4], filename)
+
+
+def find_invoice_file(filename: str, out_dir: str = INVOICE_DIR) -> str:
+    """
+    Path of an existing invoice PDF, falling back to the flat layout used
+    before invoices were sharded.
+
+    Raises:
+        FileNotFoundError: If the file is in neither place
+    """
+    for path in (invoice_path(filename, out_dir), os.path.join(out_dir, filename)):
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(filename)
+
+
+def invoice_uri(invoice_number: str) -> str:
+    """MCP resource URI an invoice PDF can be read from."""
+    return f"invoice://{invoice_number}"
+
+
+class FileCache:
+    """
+    Size-bounded LRU cache of immutable file contents, such as issued invoices.
+
+    Entries are bounded by their total size in bytes rather than their
+    count; files larger than max_file_bytes are read but never cached.
+    Thread-safe.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_file_bytes: int = 4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._entries: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        """Return the cached contents for key, or None on a miss."""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def load(self, key: Hashable, path: str) -> bytes:
+        """
+        Read a file from disk and cache its contents under key.
+
+        Raises:
+            OSError: If the file cannot be read
+        """
+        with metrics.timer("phase", "file_cache.read"):
+            with open(path, "rb") as f:
+                data = f.read()
+        if len(data) > self.max_file_bytes:
+            return data
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+        return data
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+# One renderer per worker process, built on the first chunk it receives
+_worker_renderer: Optional[InvoiceRenderer] = None
+
+
+def render_invoice_chunk(items: List[Dict], out_dir: str, invoice_date: str) -> List[Dict]:
+    """
+    Render a chunk of invoices. Runs inside a process pool worker.
+
+    Args:
+        items: Bookings joined with their flights; each needs booking_id,
+            customer_id, payment_amount, card_last_four, payment_status,
+            flight_number, airline, departure_location, arrival_location,
+            departure_date and departure_time
+        out_dir: Directory the PDFs are written to
+        invoice_date: Invoice date printed on every invoice, YYYY-MM-DD
+
+    Returns:
+        One result per item, in order: the invoice number, file name and
+        rendered values on success, or an error message
+    """
+    global _worker_renderer
+    if _worker_renderer is None:
+        _worker_renderer = InvoiceRenderer()
+
+    results = []
+    for item in items:
+        booking_id = item.get("booking_id")
+        try:
+            invoice_number = new_invoice_number()
+            filename = invoice_filename(booking_id, invoice_number)
+            values = booking_invoice_values({"payment_status": None, **item}, invoice_number, invoice_date)
+            _worker_renderer.render_to_file(values, invoice_path(filename, out_dir))
+            results.append({"booking_id": booking_id, "invoice_number": invoice_number, "filename": filename,
+                            "values": values})
+        except Exception as e:
+            results.append({"booking_id": booking_id, "error": f"Invoice generation failed: {str(e)}"})
+    return results
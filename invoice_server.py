@@ -1,161 +1,641 @@
 import os
+import sqlite3
 import sys
 from mcp.server.fastmcp import FastMCP
-from typing import Dict
-import uuid
-from fpdf import FPDF
-from datetime import datetime, timedelta
-import random
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple, Union
+import threading
+import argparse
+import json
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from invoice_renderer import (
+    INVOICE_DIR, booking_invoice_values, format_invoice_values, find_invoice_file, invoice_filename, invoice_path,
+    invoice_uri, new_invoice_number, render_invoice_chunk, shared_renderer, FileCache
+)
+from flight_db import (
+    shared_database, BOOKINGS_FOR_INVOICE_SQL, BOOKING_FOR_INVOICE_SQL, FLIGHT_BY_ID_SQL, RECORD_INVOICE_SQL,
+    INVOICE_FOR_BOOKING_SQL
+)
+from flight_archive import shared_archive
+from flight_cache import SearchCache
+from metrics import metrics
+from tool_executor import tool_executor, write_executor, add_transport_arguments, serve
+from invoice_jobs import InvoiceJobQueue, QueueFullError
+from datetime import datetime
 
 # Initialize FastMCP
 mcp = FastMCP("InvoiceGenerator")
 
+DB_PATH = os.path.join('data', 'flights.db')
+DB_NOT_FOUND = "Flight database not found. Please run setup_flight_db.py first."
+
+# Static invoice layout is built on first use and reused for every invoice
+renderer = shared_renderer()
+
+# Shared, long-lived connections for reading bookings and recording invoices
+db = shared_database(DB_PATH)
+
+# Flights of past months, moved out of flight_info by flight_archive.py
+archive = shared_archive(DB_PATH)
+
+# Background rendering for generate_invoice(async_mode=True)
+INVOICE_QUEUE_SIZE = 256
+INVOICE_QUEUE_WORKERS = 2
+QUEUE_RETRY_AFTER_SECONDS = 2
+invoice_jobs = InvoiceJobQueue(db, renderer, INVOICE_DIR, maxsize=INVOICE_QUEUE_SIZE, workers=INVOICE_QUEUE_WORKERS)
+
+# booking_id -> completed invoice, in front of the invoices table lookup
+ISSUED_INVOICE_CACHE_SIZE = 4096
+ISSUED_INVOICE_CACHE_TTL = 3600.0
+issued_invoices = SearchCache(max_entries=ISSUED_INVOICE_CACHE_SIZE, ttl=ISSUED_INVOICE_CACHE_TTL)
+
+# invoice_number -> PDF bytes served by the invoice:// resource
+INVOICE_FILE_CACHE_BYTES = 64 * 1024 * 1024
+invoice_files = FileCache(max_bytes=INVOICE_FILE_CACHE_BYTES)
+
+# booking_id -> result of the generate_invoice call currently working on it
+_inflight: Dict[int, Future] = {}
+_inflight_lock = threading.Lock()
+
+MAX_BATCH_INVOICES = 10000
+DEFAULT_CHUNK_SIZE = 250
+
+
 @mcp.tool()
-def generate_invoice(customer_id: str, flight_id: int, booking_id: int, payment_amount: float, card_last_four: str) -> Dict:
+@metrics.instrument_tool
+@write_executor.offload
+def generate_invoice(customer_id: str, flight_id: int, booking_id: int, payment_amount: float, card_last_four: str,
+                     async_mode: bool = False) -> Dict:
     """
     Generate a simple invoice PDF for a flight booking.
     
+    The invoice shows the booked flight's real airline, route and times. For
+    a booking recorded in the database the stored customer and payment
+    details are used; otherwise the details passed in are invoiced against
+    flight_id.
+    
+    Safe to retry: a booking is only ever invoiced once, and repeated calls
+    return the existing invoice.
+    
     Args:
         customer_id: The unique identifier for the customer
         flight_id: The ID of the flight booked
         booking_id: The ID of the booking
         payment_amount: The amount paid for the booking
         card_last_four: The last four digits of the credit card used
+        async_mode: If true, reserve the invoice number and return immediately while
+            the PDF is rendered in the background; poll get_invoice_status for completion
     
     Returns:
-        Dictionary containing invoice information or error message
+        Dictionary containing invoice information, including the resource_uri
+        the PDF can be read from (invoice://{invoice_number}), or error message
     """
     try:
-        # Create directory for invoices if it doesn't exist
-        pdf_path = os.path.join("data", "invoices")
-        os.makedirs(pdf_path, exist_ok=True)
-        
-        # Generate invoice number and date
-        invoice_number = f"INV-{uuid.uuid4().hex[:8].upper()}"
-        invoice_date = datetime.now().strftime('%Y-%m-%d')
-        
-        # Generate random flight details
-        flight_number = f"FL{random.randint(1000, 9999)}"
-        airlines = ["American Airlines", "Delta Air Lines", "United Airlines", "British Airways"]
-        airline = random.choice(airlines)
-        
-        cities = ["New York", "Los Angeles", "Chicago", "Miami", "London", "Paris", "Tokyo"]
-        departure_city = random.choice(cities)
-        arrival_city = random.choice([city for city in cities if city != departure_city])
-        
-        departure_date = (datetime.now() + timedelta(days=random.randint(1, 30))).strftime('%Y-%m-%d')
-        departure_time = f"{random.randint(6, 22):02d}:{random.randint(0, 59):02d}"
-        
-        # Create the invoice PDF
-        invoice_filename = f"invoice_{booking_id}_{invoice_number}.pdf"
-        full_path = os.path.join(pdf_path, invoice_filename)
-        
-        # Generate PDF
-        pdf = FPDF()
-        pdf.add_page()
-        
-        # Header
-        pdf.set_font("Arial", "B", 16)
-        pdf.cell(190, 10, "FLIGHT BOOKING INVOICE", 0, 1, "C")
-        pdf.ln(10)
-        
-        # Invoice details
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(50, 10, "Invoice Number:", 0, 0)
-        pdf.set_font("Arial", "", 12)
-        pdf.cell(140, 10, invoice_number, 0, 1)
-        
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(50, 10, "Invoice Date:", 0, 0)
-        pdf.set_font("Arial", "", 12)
-        pdf.cell(140, 10, invoice_date, 0, 1)
-        
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(50, 10, "Booking ID:", 0, 0)
-        pdf.set_font("Arial", "", 12)
-        pdf.cell(140, 10, str(booking_id), 0, 1)
-        
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(50, 10, "Customer ID:", 0, 0)
-        pdf.set_font("Arial", "", 12)
-        pdf.cell(140, 10, customer_id, 0, 1)
-        
-        pdf.ln(10)
-        
-        # Flight details
-        pdf.set_font("Arial", "B", 14)
-        pdf.cell(190, 10, "Flight Details", 0, 1)
-        
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(50, 10, "Flight Number:", 0, 0)
-        pdf.set_font("Arial", "", 12)
-        pdf.cell(140, 10, flight_number, 0, 1)
-        
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(50, 10, "Airline:", 0, 0)
-        pdf.set_font("Arial", "", 12)
-        pdf.cell(140, 10, airline, 0, 1)
-        
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(50, 10, "From:", 0, 0)
-        pdf.set_font("Arial", "", 12)
-        pdf.cell(140, 10, departure_city, 0, 1)
-        
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(50, 10, "To:", 0, 0)
-        pdf.set_font("Arial", "", 12)
-        pdf.cell(140, 10, arrival_city, 0, 1)
-        
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(50, 10, "Date:", 0, 0)
-        pdf.set_font("Arial", "", 12)
-        pdf.cell(140, 10, departure_date, 0, 1)
-        
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(50, 10, "Departure Time:", 0, 0)
-        pdf.set_font("Arial", "", 12)
-        pdf.cell(140, 10, departure_time, 0, 1)
-        
-        pdf.ln(10)
-        
-        # Payment details
-        pdf.set_font("Arial", "B", 14)
-        pdf.cell(190, 10, "Payment Details", 0, 1)
-        
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(50, 10, "Payment Amount:", 0, 0)
-        pdf.set_font("Arial", "", 12)
-        pdf.cell(140, 10, f"${payment_amount:.2f}", 0, 1)
-        
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(50, 10, "Payment Method:", 0, 0)
-        pdf.set_font("Arial", "", 12)
-        pdf.cell(140, 10, f"Credit Card (ending in {card_last_four})", 0, 1)
-        
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(50, 10, "Payment Status:", 0, 0)
-        pdf.set_font("Arial", "", 12)
-        pdf.cell(140, 10, "Completed", 0, 1)
-        
-        # Footer
-        pdf.ln(20)
-        pdf.set_font("Arial", "I", 10)
-        pdf.cell(190, 10, "Thank you for your booking!", 0, 1, "C")
-        
-        # Save PDF
-        pdf.output(full_path)
-        
+        return invoice_once(
+            booking_id,
+            lambda: create_invoice(customer_id, flight_id, booking_id, payment_amount, card_last_four, async_mode)
+        )
+    except FileNotFoundError:
+        return {"error": DB_NOT_FOUND}
+    except Exception as e:
+        return {"error": f"Invoice generation failed: {str(e)}"}
+
+
+def find_invoice(booking_id: int) -> Optional[Dict]:
+    """Return the existing invoice of a booking from the cache or the invoices table."""
+    cached, generation = issued_invoices.get(booking_id)
+    if cached is not None:
+        return cached
+    
+    with db.reader() as conn:
+        row = conn.execute(INVOICE_FOR_BOOKING_SQL, (booking_id,)).fetchone()
+    if row is None:
+        return None
+    
+    invoice = {
+        "success": True,
+        "status": row["status"],
+        "invoice_number": row["invoice_number"],
+        "invoice_date": row["invoice_date"],
+        "filename": row["filename"],
+        "path": invoice_path(row["filename"]),
+        "resource_uri": invoice_uri(row["invoice_number"]),
+        "existing": True,
+        "message": f"Invoice already generated for booking {booking_id}: {row['invoice_number']}"
+    }
+    # Queued jobs can still fail, so only finished invoices are cached
+    if row["status"] == "completed":
+        issued_invoices.put(booking_id, invoice, generation)
+    return invoice
+
+
+def invoice_once(booking_id: int, create: Callable[[], Dict]) -> Dict:
+    """
+    Return the booking's existing invoice, or create it exactly once.
+    
+    Concurrent calls for the same booking share a single lookup and render:
+    the first caller does the work and the others wait for its result.
+    """
+    with _inflight_lock:
+        future = _inflight.get(booking_id)
+        leader = future is None
+        if leader:
+            future = _inflight[booking_id] = Future()
+    if not leader:
+        return future.result()
+    
+    try:
+        result = find_invoice(booking_id) or create()
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[booking_id]
+
+
+def create_invoice(customer_id: str, flight_id: int, booking_id: int, payment_amount: float, card_last_four: str,
+                   async_mode: bool = False) -> Dict:
+    """Render (or queue) a new invoice and record it in the invoices table."""
+    # Generate invoice number and date
+    invoice_number = new_invoice_number()
+    invoice_date = datetime.now().strftime('%Y-%m-%d')
+    
+    # Invoice the booking and flight as recorded in the database
+    with db.reader() as conn:
+        booking = conn.execute(BOOKING_FOR_INVOICE_SQL, (booking_id,)).fetchone()
+        flight = conn.execute(FLIGHT_BY_ID_SQL, (flight_id,)).fetchone() if booking is None else None
+    if booking is not None and booking['flight_number'] is None:
+        booking = archive.with_flights([booking])[0]
+    if booking is None and flight is None:
+        flight = archive.find_flights([flight_id]).get(flight_id)
+    if booking is not None and booking['flight_number'] is not None:
+        values = booking_invoice_values(booking, invoice_number, invoice_date)
+    elif flight is not None:
+        values = format_invoice_values(
+            invoice_number, invoice_date, booking_id, customer_id,
+            flight['flight_number'], flight['airline'], flight['departure_location'], flight['arrival_location'],
+            flight['departure_date'], flight['departure_time'], payment_amount, card_last_four
+        )
+    else:
+        return {"error": f"Booking {booking_id} and flight {flight_id} not found."}
+    
+    # Create the invoice PDF
+    filename = invoice_filename(booking_id, invoice_number)
+    full_path = invoice_path(filename)
+    
+    if async_mode:
+        try:
+            invoice_jobs.submit(booking_id, values)
+        except QueueFullError:
+            return {
+                "error": "Invoice queue is full. Please retry shortly.",
+                "retry_after_seconds": QUEUE_RETRY_AFTER_SECONDS
+            }
+        except sqlite3.IntegrityError:
+            # Another process invoiced the booking first
+            return find_invoice(booking_id)
         return {
             "success": True,
+            "status": "queued",
             "invoice_number": invoice_number,
             "invoice_date": invoice_date,
-            "filename": invoice_filename,
+            "filename": filename,
             "path": full_path,
-            "message": f"Invoice generated successfully: {invoice_number}"
+            "resource_uri": invoice_uri(invoice_number),
+            "message": f"Invoice {invoice_number} queued. Use get_invoice_status to check when it is ready."
         }
+    
+    # Fill the cached invoice layout, save the PDF and record it
+    renderer.render_to_file(values, full_path)
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        db.transaction(lambda conn: conn.execute(RECORD_INVOICE_SQL, (
+            booking_id, invoice_number, invoice_date, filename, json.dumps(values), now
+        )))
+    except sqlite3.IntegrityError:
+        # Another process invoiced the booking first; keep its invoice
+        remove_file(full_path)
+        return find_invoice(booking_id)
+    
+    return {
+        "success": True,
+        "status": "completed",
+        "invoice_number": invoice_number,
+        "invoice_date": invoice_date,
+        "filename": filename,
+        "path": full_path,
+        "resource_uri": invoice_uri(invoice_number),
+        "message": f"Invoice generated successfully: {invoice_number}"
+    }
+
+
+@mcp.tool()
+@metrics.instrument_tool
+@tool_executor.offload
+def get_invoice_status(invoice_number: str) -> Dict:
+    """
+    Check the status of an invoice, e.g. one generated with async_mode.
+    
+    Args:
+        invoice_number: The invoice number returned by generate_invoice
+    
+    Returns:
+        Dictionary with the status (queued, rendering, completed or failed) and file details, or an error message
+    """
+    if not invoice_number:
+        return {"error": "Missing required parameters"}
+    
+    try:
+        job = invoice_jobs.status(invoice_number)
+    except FileNotFoundError:
+        return {"error": DB_NOT_FOUND}
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}"}
+    
+    if job is None:
+        return {"error": f"Invoice {invoice_number} not found."}
+    
+    result = {
+        "invoice_number": job["invoice_number"],
+        "booking_id": job["booking_id"],
+        "invoice_date": job["invoice_date"],
+        "status": job["status"],
+        "filename": job["filename"],
+        "updated_at": job["updated_at"]
+    }
+    if job["status"] == "completed":
+        result["path"] = invoice_path(job["filename"])
+        result["resource_uri"] = invoice_uri(job["invoice_number"])
+    if job["error"]:
+        result["error"] = job["error"]
+    return result
+
+
+def remove_file(path: str) -> None:
+    """Delete a rendered invoice that was not recorded, ignoring missing files."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def load_bookings(booking_id_start: int, booking_id_end: int) -> List[Dict]:
+    """Read a range of bookings joined with their flights."""
+    with db.reader() as conn:
+        rows = conn.execute(BOOKINGS_FOR_INVOICE_SQL, (booking_id_start, booking_id_end)).fetchall()
+    return archive.with_flights(rows)
+
+
+def attach_flights(bookings: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Add the flight details of each caller-supplied booking from flight_info or the archive.
+    
+    Returns:
+        The bookings with their flights, and an error for each entry that is
+        not an object with an integer booking_id and flight_id
+    """
+    valid, errors = [], []
+    for booking in bookings:
+        if not isinstance(booking, dict):
+            errors.append({"booking_id": None, "error": "Booking must be an object."})
+            continue
+        try:
+            booking_id, flight_id = int(booking["booking_id"]), int(booking["flight_id"])
+        except (KeyError, TypeError, ValueError):
+            errors.append({"booking_id": booking.get("booking_id"),
+                           "error": "booking_id and flight_id must be integers."})
+            continue
+        valid.append({**booking, "booking_id": booking_id, "flight_id": flight_id})
+    
+    flight_ids = sorted({booking["flight_id"] for booking in valid})
+    flights = {}
+    with db.reader() as conn:
+        for start in range(0, len(flight_ids), 500):
+            chunk = flight_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for row in conn.execute(f"SELECT * FROM flight_info WHERE id IN ({placeholders})", chunk):
+                flights[row["id"]] = row
+    flights.update(archive.find_flights(set(flight_ids) - set(flights)))
+
+    items = []
+    for item in valid:
+        flight = flights.get(item["flight_id"])
+        if flight is not None:
+            for column in ("flight_number", "airline", "departure_location", "arrival_location",
+                           "departure_date", "departure_time"):
+                item[column] = flight[column]
+        items.append(item)
+    return items, errors
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+# Held while the pool is replaced and while chunks are submitted to it, so a
+# batch never submits to a pool another batch has just shut down
+_pool_lock = threading.Lock()
+
+
+def get_invoice_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Return the process pool used for batch rendering, reusing it across calls.
+    
+    Spawned workers start clean instead of inheriting the parent's open
+    database connections and event loop threads; keeping the pool alive
+    pays their start-up cost once per server rather than once per batch.
+    A pool broken by a crashed, killed or failed worker is replaced. The
+    caller must hold _pool_lock.
+    """
+    global _pool, _pool_workers
+    if _pool is None or _pool._broken or _pool_workers != workers:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        _pool_workers = workers
+    return _pool
+
+
+def submit_chunks(chunks: List[List[Dict]], workers: int, invoice_date: str) -> Dict[Future, List[Dict]]:
+    """
+    Hand chunks to the batch pool, replacing the pool once if it is broken.
+    
+    Raises:
+        BrokenProcessPool: If the replacement pool is broken as well
+    """
+    with _pool_lock:
+        for attempt in range(2):
+            pool = get_invoice_pool(workers)
+            try:
+                return {pool.submit(render_invoice_chunk, chunk, INVOICE_DIR, invoice_date): chunk for chunk in chunks}
+            except BrokenProcessPool:
+                if attempt:
+                    raise
+
+
+def run_invoice_batch(items: List[Dict], workers: Optional[int] = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                      invalid: Sequence[Dict] = ()) -> Dict:
+    """
+    Render invoices for many bookings on a process pool and record them.
+    
+    Bookings that already have an invoice are returned as is, marked
+    existing, and not rendered again, so a retried batch only renders what
+    is still missing. The rest are split into chunks that are handed to the
+    workers as they free up. Each finished chunk is recorded in one write
+    transaction; an invoice recorded meanwhile by another call wins, and
+    the duplicate file is removed. If a worker dies, the pool is replaced
+    and the chunks lost with it are retried once.
+    
+    Args:
+        items: Bookings joined with their flights (see render_invoice_chunk)
+        workers: Number of worker processes (defaults to the CPU count)
+        chunk_size: Bookings per unit of work
+        invalid: Errors for bookings rejected before rendering, reported
+            with the rest
+    
+    Returns:
+        Dictionary with the generated invoices, per-booking errors and counts
+    """
+    invoice_date = datetime.now().strftime('%Y-%m-%d')
+    workers = workers or os.cpu_count() or 1
+    
+    invoices, errors = [], list(invalid)
+    ready = []
+    
+    def add_existing(booking_id: int, invoice: Dict) -> None:
+        invoices.append({"booking_id": booking_id, "invoice_number": invoice["invoice_number"],
+                         "filename": invoice["filename"], "existing": True})
+    
+    for item in items:
+        if item.get("booking_id") is None or item.get("flight_number") is None:
+            errors.append({"booking_id": item.get("booking_id"), "error": "Booking or flight not found."})
+            continue
+        existing = find_invoice(item["booking_id"])
+        if existing is not None:
+            add_existing(item["booking_id"], existing)
+        else:
+            ready.append(item)
+    chunks = [ready[start:start + chunk_size] for start in range(0, len(ready), chunk_size)]
+    
+    def record(results: List[Dict]) -> None:
+        rendered = [result for result in results if "error" not in result]
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        
+        def insert(conn: sqlite3.Connection) -> Set[int]:
+            duplicates = set()
+            for result in rendered:
+                try:
+                    conn.execute(RECORD_INVOICE_SQL, (
+                        result["booking_id"], result["invoice_number"], invoice_date, result["filename"],
+                        json.dumps(result["values"]), now
+                    ))
+                except sqlite3.IntegrityError:
+                    duplicates.add(result["booking_id"])
+            return duplicates
+        
+        duplicates = db.transaction(insert) if rendered else set()
+        for result in results:
+            result.pop("values", None)
+            if "error" in result:
+                errors.append(result)
+            elif result["booking_id"] in duplicates:
+                remove_file(invoice_path(result["filename"]))
+                add_existing(result["booking_id"], find_invoice(result["booking_id"]))
+            else:
+                invoices.append(result)
+    
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            record(render_invoice_chunk(chunk, INVOICE_DIR, invoice_date))
+    else:
+        def fail(chunk: List[Dict], e: Exception) -> None:
+            for item in chunk:
+                errors.append({"booking_id": item["booking_id"], "error": f"Invoice generation failed: {str(e)}"})
         
+        pending = chunks
+        for attempt in range(2):
+            try:
+                futures = submit_chunks(pending, workers, invoice_date)
+            except BrokenProcessPool as e:
+                for chunk in pending:
+                    fail(chunk, e)
+                break
+            # A dead worker breaks the pool and fails every chunk still on it
+            broken = []
+            for future in as_completed(futures):
+                try:
+                    record(future.result())
+                except BrokenProcessPool as e:
+                    if attempt:
+                        fail(futures[future], e)
+                    else:
+                        broken.append(futures[future])
+                except Exception as e:
+                    fail(futures[future], e)
+            if not broken:
+                break
+            pending = broken
+    
+    invoices.sort(key=lambda result: result["booking_id"])
+    existing = sum(1 for invoice in invoices if invoice.get("existing"))
+    return {
+        "success": not errors,
+        "generated": len(invoices) - existing,
+        "existing": existing,
+        "failed": len(errors),
+        "invoice_date": invoice_date,
+        "invoices": invoices,
+        "errors": errors
+    }
+
+
+@mcp.tool()
+@metrics.instrument_tool
+@tool_executor.offload
+def generate_invoices_batch(bookings: Optional[List[Dict]] = None, booking_id_start: Optional[int] = None,
+                            booking_id_end: Optional[int] = None, workers: Optional[int] = None,
+                            chunk_size: int = DEFAULT_CHUNK_SIZE) -> Dict:
+    """
+    Generate invoices for many bookings at once, e.g. for month-end reconciliation.
+    
+    Pass either a list of bookings or an inclusive booking ID range. Flight
+    details are read from the flight database. Safe to retry: bookings that
+    already have an invoice are returned with "existing": true instead of
+    being invoiced again.
+    
+    Args:
+        bookings: Optional list of {"booking_id", "customer_id", "flight_id", "payment_amount", "card_last_four"} entries
+        booking_id_start: First booking ID of the range to invoice
+        booking_id_end: Last booking ID of the range to invoice
+        workers: Optional number of worker processes (defaults to the CPU count)
+        chunk_size: Bookings handed to a worker at a time (default 250)
+    
+    Returns:
+        Dictionary containing the generated invoices, per-booking errors and counts, or an error message
+    """
+    if bookings and (booking_id_start is not None or booking_id_end is not None):
+        return {"error": "Pass either bookings or a booking ID range, not both."}
+    if not bookings and (booking_id_start is None or booking_id_end is None):
+        return {"error": "Missing required parameters"}
+    if booking_id_start is not None and booking_id_end < booking_id_start:
+        return {"error": "booking_id_end must not be smaller than booking_id_start."}
+    if bookings and len(bookings) > MAX_BATCH_INVOICES or \
+            booking_id_start is not None and booking_id_end - booking_id_start + 1 > MAX_BATCH_INVOICES:
+        return {"error": f"Too many invoices in one batch. Maximum is {MAX_BATCH_INVOICES}."}
+    if chunk_size < 1 or (workers is not None and workers < 1):
+        return {"error": "workers and chunk_size must be positive."}
+    
+    try:
+        if bookings:
+            items, invalid = attach_flights(bookings)
+        else:
+            items, invalid = load_bookings(booking_id_start, booking_id_end), []
+        return run_invoice_batch(items, workers, chunk_size, invalid)
+    except FileNotFoundError:
+        return {"error": DB_NOT_FOUND}
     except Exception as e:
-        return {"error": f"Invoice generation failed: {str(e)}"}
+        return {"error": f"Batch invoice generation failed: {str(e)}"}
+
+
+@mcp.resource("invoice://{invoice_number}", title="Invoice PDF", mime_type="application/pdf")
+@tool_executor.offload_resource
+def read_invoice(invoice_number: str) -> bytes:
+    """
+    The PDF of an issued invoice, by invoice number, e.g. invoice://INV-1A2B3C4D.
+    
+    Use the resource_uri returned by generate_invoice or get_invoice_status.
+    Invoices still queued or rendering are not readable yet.
+    """
+    data = invoice_files.get(invoice_number)
+    if data is not None:
+        return data
+    
+    job = invoice_jobs.status(invoice_number)
+    if job is None:
+        raise ValueError(f"Invoice {invoice_number} not found.")
+    if job["status"] != "completed":
+        raise ValueError(f"Invoice {invoice_number} is {job['status']}; check get_invoice_status and retry.")
+    return invoice_files.load(invoice_number, find_invoice_file(job["filename"]))
+
+
+@mcp.tool()
+@tool_executor.offload
+def get_server_metrics(format: str = "json") -> Union[Dict, str]:
+    """
+    Report latency metrics for this server's tools, SQL statements and PDF rendering.
+    
+    Args:
+        format: "json" for per-tool, per-statement and per-phase summaries with the
+            slow-query log, or "prometheus" for the Prometheus text exposition format
+    
+    Returns:
+        Dictionary of metrics, job queue and cache statistics, or the Prometheus text
+    """
+    if format == "prometheus":
+        return metrics.prometheus_text()
+    if format != "json":
+        return {"error": "format must be 'json' or 'prometheus'."}
+    
+    result = metrics.snapshot()
+    result["invoice_jobs"] = invoice_jobs.stats()
+    result["issued_invoices"] = issued_invoices.stats()
+    result["invoice_files"] = invoice_files.stats()
+    result["flight_archive"] = archive.stats()
+    result["tool_executor"] = tool_executor.stats()
+    result["write_executor"] = write_executor.stats()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Invoice generator MCP server")
+    add_transport_arguments(parser)
+    parser.add_argument("--invoice-workers", type=int, default=INVOICE_QUEUE_WORKERS,
+                        help="threads rendering async_mode invoices")
+    subparsers = parser.add_subparsers(dest="command")
+    batch = subparsers.add_parser("batch", help="generate invoices for many bookings and exit")
+    source = batch.add_mutually_exclusive_group(required=True)
+    source.add_argument("--range", nargs=2, type=int, metavar=("START", "END"),
+                        help="inclusive booking ID range to invoice")
+    source.add_argument("--bookings-file", help="JSON file with a list of bookings to invoice")
+    batch.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    batch.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="bookings per unit of work")
+    args = parser.parse_args()
+    
+    if args.command != "batch":
+        # Resume invoices queued before the last shutdown
+        invoice_jobs.workers = args.invoice_workers
+        try:
+            invoice_jobs.start()
+        except FileNotFoundError:
+            print(f"Flight database not found at {DB_PATH}. Please run setup_flight_db.py first.", file=sys.stderr)
+        serve(mcp, args)
+        return
+    
+    bookings = None
+    if args.bookings_file:
+        try:
+            with open(args.bookings_file) as f:
+                bookings = json.load(f)
+        except (OSError, ValueError) as e:
+            sys.exit(f"Cannot read bookings file {args.bookings_file}: {e}")
+        if not isinstance(bookings, list):
+            sys.exit(f"Bookings file {args.bookings_file} must hold a JSON list of bookings")
+    
+    # The CLI has no per-call limit; chunks keep memory bounded
+    try:
+        if args.range:
+            items, invalid = load_bookings(*args.range), []
+        else:
+            items, invalid = attach_flights(bookings)
+    except FileNotFoundError:
+        sys.exit(DB_NOT_FOUND)
+    result = run_invoice_batch(items, args.workers, args.chunk_size, invalid)
+    summary = {key: value for key, value in result.items() if key != "invoices"}
+    print(json.dumps(summary, indent=2))
+    sys.exit(0 if result["success"] else 1)
+
 
 if __name__ == "__main__":
-    mcp.run(transport="stdio") 
\ No newline at end of file
+    main()
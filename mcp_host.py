@@ -0,0 +1,120 @@
+import argparse
+import asyncio
+import sys
+from types import ModuleType
+from typing import Dict, Union
+
+from mcp.server.fastmcp import FastMCP
+
+import flight_mcp_server
+import invoice_server
+from metrics import metrics
+from tool_executor import tool_executor, write_executor, add_transport_arguments, serve
+
+# Both services in one process: one interpreter, one import of mcp and one
+# shared database pool, renderer, metrics registry and tool executor.
+mcp = FastMCP("TravelServices")
+
+# Tools every service defines for itself; the host serves a combined one
+HOST_TOOLS = ("get_server_metrics",)
+
+
+async def mount(host: FastMCP, service: ModuleType) -> None:
+    """
+    Register every tool and resource template of a service module on the
+    host under its original name.
+
+    Tools and templates are listed through FastMCP's public API (this
+    version has no mounting of its own); each handler is the module-level
+    function of the same name. Names are kept flat, without a service
+    prefix, so agents written against the separate servers call the host
+    unchanged. Tool names are unique across the services, which this
+    checks.
+
+    Raises:
+        ValueError: If two services define a tool or resource template with
+            the same name
+    """
+    existing = {tool.name for tool in await host.list_tools()}
+    for tool in await service.mcp.list_tools():
+        if tool.name in HOST_TOOLS:
+            continue
+        if tool.name in existing:
+            raise ValueError(f"Tool {tool.name} is defined by more than one service")
+        host.add_tool(getattr(service, tool.name), name=tool.name, title=tool.title,
+                      description=tool.description, annotations=tool.annotations)
+
+    templates = {template.uriTemplate for template in await host.list_resource_templates()}
+    for template in await service.mcp.list_resource_templates():
+        if template.uriTemplate in templates:
+            raise ValueError(f"Resource {template.uriTemplate} is defined by more than one service")
+        host.resource(template.uriTemplate, name=template.name, title=template.title,
+                      description=template.description, mime_type=template.mimeType)(getattr(service, template.name))
+
+
+async def mount_services() -> None:
+    """
+    Mount both services on the host.
+
+    main() does this before serving, so importing the module has no side
+    effects; an application embedding the host awaits it once on its own
+    event loop.
+    """
+    await mount(mcp, flight_mcp_server)
+    await mount(mcp, invoice_server)
+
+
+@mcp.tool()
+@tool_executor.offload
+def get_server_metrics(format: str = "json") -> Union[Dict, str]:
+    """
+    Report latency metrics for every tool, SQL statement and PDF render in this host.
+
+    Args:
+        format: "json" for per-tool, per-statement and per-phase summaries with the
+            slow-query log, or "prometheus" for the Prometheus text exposition format
+
+    Returns:
+        Dictionary of metrics with cache, route index and job queue statistics, or the Prometheus text
+    """
+    if format == "prometheus":
+        return metrics.prometheus_text()
+    if format != "json":
+        return {"error": "format must be 'json' or 'prometheus'."}
+
+    result = metrics.snapshot()
+    result["search_cache"] = flight_mcp_server.search_cache.stats()
+    result["route_graph"] = flight_mcp_server.route_graph.stats()
+    result["flight_columns"] = flight_mcp_server.flight_columns.stats()
+    result["locations"] = flight_mcp_server.locations.stats()
+    result["invoice_jobs"] = invoice_server.invoice_jobs.stats()
+    result["issued_invoices"] = invoice_server.issued_invoices.stats()
+    result["invoice_files"] = invoice_server.invoice_files.stats()
+    result["flight_archive"] = flight_mcp_server.archive.stats()
+    result["single_flight"] = flight_mcp_server.searches.stats()
+    result["tool_executor"] = tool_executor.stats()
+    result["write_executor"] = write_executor.stats()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Flight search and invoice MCP services in one process")
+    add_transport_arguments(parser)
+    parser.add_argument("--invoice-workers", type=int, default=invoice_server.INVOICE_QUEUE_WORKERS,
+                        help="threads rendering async_mode invoices")
+    args = parser.parse_args()
+
+    asyncio.run(mount_services())
+    flight_mcp_server.init_database()
+    # Resume invoices queued before the last shutdown
+    invoice_server.invoice_jobs.workers = args.invoice_workers
+    try:
+        invoice_server.invoice_jobs.start()
+    except FileNotFoundError:
+        print(f"Flight database not found at {invoice_server.DB_PATH}. Please run setup_flight_db.py first.",
+              file=sys.stderr)
+    serve(mcp, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+import functools
+import inspect
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds, from 100us to 10s
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# Distinct SQL statements tracked; anything beyond is counted as "other"
+MAX_STATEMENTS = 500
+SLOW_QUERY_LOG_SIZE = 100
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_PLACEHOLDER_LIST_RE = re.compile(r"\?(?:\s*,\s*\?)+")
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+# Statements timed but never entered in the slow-query log
+_NOT_LOGGED = ("PRAGMA", "EXPLAIN")
+
+
+class Histogram:
+    """Fixed-bucket latency histogram with count, sum, max and error count."""
+
+    __slots__ = ("counts", "count", "total", "max", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+    def observe(self, seconds: float, error: bool = False) -> None:
+        index = 0
+        while index < len(BUCKETS) and seconds > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if error:
+            self.errors += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by interpolating inside its bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = BUCKETS[index - 1] if index > 0 else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / bucket_count, self.max)
+            seen += bucket_count
+        return self.max
+
+    def summary(self) -> Dict:
+        ms = lambda seconds: round(seconds * 1000, 3)
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total_ms": ms(self.total),
+            "mean_ms": ms(self.total / self.count) if self.count else 0.0,
+            "p50_ms": ms(self.quantile(0.50)),
+            "p95_ms": ms(self.quantile(0.95)),
+            "p99_ms": ms(self.quantile(0.99)),
+            "max_ms": ms(self.max),
+        }
+
+
+class _Timer:
+    __slots__ = ("registry", "kind", "name", "started")
+
+    def __init__(self, registry: "Metrics", kind: str, name: str):
+        self.registry = registry
+        self.kind = kind
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.kind, self.name, time.perf_counter() - self.started, exc_type is not None)
+        return False
+
+
+_NULL_TIMER = nullcontext()
+
+
+class Metrics:
+    """
+    In-process latency metrics for tool handlers, SQL statements and phases.
+
+    Observations are grouped by kind ("tool", "sql", "phase") and name.
+    SQL statements slower than the slow-query threshold are also kept in a
+    bounded log together with their EXPLAIN QUERY PLAN output. When disabled
+    the decorators return the handler unchanged, connections are plain
+    sqlite3 connections and timer() returns a shared no-op context, so the
+    hot paths pay nothing. Thread-safe.
+    """
+
+    def __init__(self, enabled: bool = True, slow_query_ms: float = 50.0):
+        self.enabled = enabled
+        self.slow_query_seconds = slow_query_ms / 1000
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[str, Histogram]] = {"tool": {}, "sql": {}, "phase": {}}
+        self.slow_queries: "deque[Dict]" = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+    def observe(self, kind: str, name: str, seconds: float, error: bool = False) -> None:
+        """Record one timed operation."""
+        with self._lock:
+            histograms = self._histograms.setdefault(kind, {})
+            histogram = histograms.get(name)
+            if histogram is None:
+                if kind == "sql" and len(histograms) >= MAX_STATEMENTS:
+                    name = "other"
+                    histogram = histograms.get(name)
+                if histogram is None:
+                    histogram = histograms[name] = Histogram()
+            histogram.observe(seconds, error)
+
+    def timer(self, kind: str, name: str):
+        """Context manager timing the enclosed block; a no-op when disabled."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, kind, name)
+
+    def instrument_tool(self, fn: Callable) -> Callable:
+        """
+        Decorator timing an MCP tool handler.
+
+        A call counts as an error when it raises or returns a dictionary with
+        an "error" key. Apply it below @mcp.tool() so the registered function
+        keeps the handler's name, docstring and signature.
+        """
+        if not self.enabled:
+            return fn
+        name = fn.__name__
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                result = None
+                try:
+                    result = await fn(*args, **kwargs)
+                    return result
+                finally:
+                    self.observe("tool", name, time.perf_counter() - started, _is_error(result))
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            result = None
+            try:
+                result = fn(*args, **kwargs)
+                return result
+            finally:
+                self.observe("tool", name, time.perf_counter() - started, _is_error(result))
+        return wrapper
+
+    def connection_factory(self) -> type:
+        """Connection class to pass to sqlite3.connect(factory=...)."""
+        return InstrumentedConnection if self.enabled else sqlite3.Connection
+
+    def record_query(self, conn: sqlite3.Connection, sql: str, params: Any, seconds: float,
+                     error: bool, many: bool = False) -> None:
+        statement = normalize_sql(sql)
+        self.observe("sql", statement, seconds, error)
+        if seconds < self.slow_query_seconds:
+            return
+        verb = statement.split(" ", 1)[0].upper()
+        if verb in _NOT_LOGGED:
+            return
+        plan: List[str] = []
+        if not many and verb in _EXPLAINABLE:
+            try:
+                plan = [row[-1] for row in sqlite3.Connection.execute(
+                    conn, f"EXPLAIN QUERY PLAN {sql}", params if params is not None else ())]
+            except sqlite3.Error as e:
+                plan = [f"EXPLAIN failed: {e}"]
+        entry = {
+            "at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "ms": round(seconds * 1000, 3),
+            "statement": statement,
+            "executemany": many,
+            "plan": plan,
+        }
+        with self._lock:
+            self.slow_queries.append(entry)
+        logger.warning("Slow query (%.1f ms): %s | plan: %s", entry["ms"], statement, "; ".join(plan))
+
+    def reset(self) -> None:
+        """Drop every observation and the slow-query log."""
+        with self._lock:
+            self._histograms = {"tool": {}, "sql": {}, "phase": {}}
+            self.slow_queries.clear()
+            self.started_at = time.time()
+
+    def snapshot(self) -> Dict:
+        """Return every histogram summary and the slow-query log."""
+        with self._lock:
+            groups = {
+                kind: {name: histogram.summary() for name, histogram in sorted(histograms.items())}
+                for kind, histograms in self._histograms.items()
+            }
+            slow_queries = list(self.slow_queries)
+        return {
+            "enabled": self.enabled,
+            "uptime_seconds": round(time.time() - self.started_at, 1),
+            "process": {"pid": os.getpid(), "peak_rss_mb": peak_rss_mb()},
+            "tools": groups.get("tool", {}),
+            "sql": groups.get("sql", {}),
+            "phases": groups.get("phase", {}),
+            "slow_query_threshold_ms": round(self.slow_query_seconds * 1000, 3),
+            "slow_queries": slow_queries,
+        }
+
+    def prometheus_text(self, prefix: str = "mcp") -> str:
+        """Render every histogram in the Prometheus text exposition format."""
+        labels = {"tool": "tool", "sql": "statement", "phase": "phase"}
+        lines = []
+        with self._lock:
+            for kind, histograms in self._histograms.items():
+                metric = f"{prefix}_{kind}_duration_seconds"
+                label = labels.get(kind, "name")
+                lines.append(f"# HELP {metric} Latency of {kind} operations.")
+                lines.append(f"# TYPE {metric} histogram")
+                for name, histogram in sorted(histograms.items()):
+                    tag = f'{label}="{_escape_label(name)}"'
+                    cumulative = 0
+                    for bound, bucket_count in zip(BUCKETS, histogram.counts):
+                        cumulative += bucket_count
+                        lines.append(f'{metric}_bucket{{{tag},le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric}_bucket{{{tag},le="+Inf"}} {histogram.count}')
+                    lines.append(f"{metric}_sum{{{tag}}} {histogram.total:.6f}")
+                    lines.append(f"{metric}_count{{{tag}}} {histogram.count}")
+                errors = f"{prefix}_{kind}_errors_total"
+                lines.append(f"# HELP {errors} Failed {kind} operations.")
+                lines.append(f"# TYPE {errors} counter")
+                for name, histogram in sorted(histograms.items()):
+                    lines.append(f'{errors}{{{label}="{_escape_label(name)}"}} {histogram.errors}')
+            lines.append(f"# HELP {prefix}_slow_queries Entries in the slow-query log.")
+            lines.append(f"# TYPE {prefix}_slow_queries gauge")
+            lines.append(f"{prefix}_slow_queries {len(self.slow_queries)}")
+        return "\n".join(lines) + "\n"
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3 connection that times execute() and executemany() into `metrics`.
+
+    The time covers preparing the statement and stepping to its first row;
+    fetching further rows is part of the calling tool's time.
+    """
+
+    def execute(self, sql, parameters=(), /):
+        started = time.perf_counter()
+        try:
+            cursor = super().execute(sql, parameters)
+        except Exception:
+            metrics.record_query(self, sql, parameters, time.perf_counter() - started, True)
+            raise
+        metrics.record_query(self, sql, parameters, time.perf_counter() - started, False)
+        return cursor
+
+    def executemany(self, sql, parameters, /):
+        started = time.perf_counter()
+        try:
+            cursor = super().executemany(sql, parameters)
+        except Exception:
+            metrics.record_query(self, sql, None, time.perf_counter() - started, True, many=True)
+            raise
+        metrics.record_query(self, sql, None, time.perf_counter() - started, False, many=True)
+        return cursor
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process in MiB, where the platform reports it."""
+    if resource is None:
+        return None
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql: str) -> str:
+    """Collapse whitespace and IN (?, ?, ...) lists so equal statements share a name."""
+    statement = _PLACEHOLDER_LIST_RE.sub("?, ...", _WHITESPACE_RE.sub(" ", sql).strip())
+    return statement[:200]
+
+
+def _is_error(result: Any) -> bool:
+    return result is None or (isinstance(result, dict) and "error" in result)
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Process-wide registry. Set MCP_METRICS=0 to disable instrumentation and
+# MCP_SLOW_QUERY_MS to change the slow-query threshold.
+metrics = Metrics(
+    enabled=os.environ.get("MCP_METRICS", "1") != "0",
+    slow_query_ms=float(os.environ.get("MCP_SLOW_QUERY_MS", "50")),
+)
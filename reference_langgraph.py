@@ -2,20 +2,22 @@ from langchain_mcp_adapters.client import MultiServerMCPClient
 from langgraph.graph import StateGraph, MessagesState, START
 from langgraph.prebuilt import ToolNode, tools_condition
 from langchain.chat_models import init_chat_model
-from langchain.schema import HumanMessage, AIMessage, SystemMessage
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from chat_history import HistoryManager
 
 from dotenv import load_dotenv
 import asyncio
 import os
 
 
-async def chat_loop(graph, messages):
+async def chat_loop(graph, messages, history: HistoryManager):
     """
     Run an interactive chat loop with the user, maintaining conversation history.
     
     Args:
         graph: The compiled LangGraph to use for processing
         messages: Initial list of messages (typically including a system message)
+        history: Keeps the stored conversation within its token budget
     """
     print("Welcome to the Chat Assistant! Type 'exit' to quit.")
     
@@ -34,9 +36,8 @@ async def chat_loop(graph, messages):
         # Invoke graph with current conversation state
         response = await graph.ainvoke({"messages": messages})
         
-        # Update messages with the complete conversation history from response
-        messages = response["messages"]
-        print(messages)
+        # Keep the trimmed history so each turn costs the same however long the session runs
+        messages = history.prepare(response["messages"])
         
         # Display the assistant's response (last message)
         assistant_message = messages[-1]
@@ -52,30 +53,42 @@ async def main():
 
     model = init_chat_model("openai:gpt-4o-mini")
 
-    async with MultiServerMCPClient(
-            {
-                "twilio_sendgrid": {
-                    "url": os.getenv('TWILIO_ENDPOINT'),
-                    "transport": "sse",
-                },
-                "flight_search": {
-                    "command": "python",
-                    "args": [os.getenv('FLIGHT_SEARCH')],
-                    "transport": "stdio",
-                },
-                "invoice_generator": {
-                    "command": "python",
-                    "args": [os.getenv('INVOICE_GENERATOR')],
-                    "transport": "stdio",
-                }
-            }
-    ) as client:
+    servers = {
+        "twilio_sendgrid": {
+            "url": os.getenv('TWILIO_ENDPOINT'),
+            "transport": "sse",
+        }
+    }
+    if os.getenv('MCP_HOST'):
+        # Flight search and invoicing in one process (mcp_host.py)
+        servers["travel_services"] = {
+            "command": "python",
+            "args": [os.getenv('MCP_HOST')],
+            "transport": "stdio",
+        }
+    else:
+        servers["flight_search"] = {
+            "command": "python",
+            "args": [os.getenv('FLIGHT_SEARCH')],
+            "transport": "stdio",
+        }
+        servers["invoice_generator"] = {
+            "command": "python",
+            "args": [os.getenv('INVOICE_GENERATOR')],
+            "transport": "stdio",
+        }
+
+    async with MultiServerMCPClient(servers) as client:
 
         tools = client.get_tools()
+        
+        # Bind the tool schemas once rather than on every graph step
+        model_with_tools = model.bind_tools(tools)
+        history = HistoryManager(max_tokens=6000)
 
         def call_model(state: MessagesState):
-            response = model.bind_tools(tools).invoke(state["messages"])
-            return {"messages": state["messages"] + [response]}
+            response = model_with_tools.invoke(history.prepare(state["messages"]))
+            return {"messages": [response]}
 
         # Build the graph
         builder = StateGraph(MessagesState)
@@ -115,20 +128,15 @@ async def main():
                               - Credit card number (must be 16 digits)
                               - Expiry date (in MM/YY format)
                               - CVV (3 digits)
-                            Use the book_flight tool to complete the booking process.
-                            Once booking is successful, you must simultaneously:
-                              - Generate an invoice using the generate_invoice tool with the booking details
-                              - Send a booking confirmation email from giridhars1@gmail.com to giridhars1@gmail.com with booking details
-                            No of Tool Calls: 3
-                            Tool Calls Sequence: Sequential and Parallel
-                            Tool Call Order: 1. Book Flight, 2. [Generate Invoice and Send Email] in parallel
+                            Use the book_and_invoice tool to book the flight and generate its invoice in one call.
+                            If it returns an error, nothing was booked or charged; report the error to the user.
+                            Once booking is successful, send a booking confirmation email from giridhars1@gmail.com
+                            to giridhars1@gmail.com with the booking details and the invoice number from the response.
+                            No of Tool Calls: 2
+                            Tool Calls Sequence: Sequential
+                            Tool Call Order: 1. Book and Invoice, 2. Send Email
                             
-                            For invoice generation, you need to pass the following parameters:
-                              - customer_id from the user input
-                              - flight_id from the user input
-                              - booking_id from the book_flight response
-                              - payment_amount from the book_flight response
-                              - card_last_four: the last 4 digits of the credit card number
+                            Only use book_flight and generate_invoice separately if book_and_invoice is unavailable.
                         }
                         
                          
@@ -137,7 +145,7 @@ async def main():
         ]
 
         # Run the chat loop
-        await chat_loop(graph, messages)
+        await chat_loop(graph, messages, history)
 
 
 # Run the async function with asyncio
@@ -1,117 +1,267 @@
 import sqlite3
 import os
+import sys
+import time
+import argparse
 from datetime import datetime, timedelta
-import random
-
-# Ensure data directory exists
-os.makedirs('data', exist_ok=True)
-
-# Connect to SQLite database (creates it if it doesn't exist)
-conn = sqlite3.connect('data/flights.db')
-cursor = conn.cursor()
-
-# Create flight_info table
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS flight_info (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    flight_number TEXT NOT NULL,
-    airline TEXT NOT NULL,
-    departure_location TEXT NOT NULL,
-    arrival_location TEXT NOT NULL,
-    departure_date TEXT NOT NULL,
-    departure_time TEXT NOT NULL,
-    arrival_time TEXT NOT NULL,
-    price REAL NOT NULL,
-    seats_available INTEGER NOT NULL
-)
-''')
-
-# Create bookings table
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS bookings (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    customer_id TEXT NOT NULL,
-    flight_id INTEGER NOT NULL,
-    booking_date TEXT NOT NULL,
-    payment_amount REAL NOT NULL,
-    payment_status TEXT NOT NULL,
-    card_last_four TEXT NOT NULL,
-    FOREIGN KEY (flight_id) REFERENCES flight_info (id)
-)
-''')
-
-# Create invoices table
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS invoices (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    booking_id INTEGER NOT NULL,
-    invoice_number TEXT NOT NULL,
-    invoice_date TEXT NOT NULL,
-    filename TEXT NOT NULL,
-    FOREIGN KEY (booking_id) REFERENCES bookings (id)
-)
-''')
-
-# Sample data for flights
+from typing import Dict, List, Optional
+import numpy as np
+from flight_db import apply_migrations, check_query_plans, get_schema_version
+
+# Sample data for flights; larger schedules extend these with synthetic names
 cities = [
-    "New York", "Los Angeles", "Chicago", "Miami", "San Francisco", 
-    "Seattle", "Dallas", "Denver", "Boston", "Atlanta", 
+    "New York", "Los Angeles", "Chicago", "Miami", "San Francisco",
+    "Seattle", "Dallas", "Denver", "Boston", "Atlanta",
     "London", "Paris", "Tokyo", "Dubai", "Sydney"
 ]
 
 airlines = [
-    "American Airlines", "Delta Air Lines", "United Airlines", 
-    "Southwest Airlines", "British Airways", "Air France", 
+    "American Airlines", "Delta Air Lines", "United Airlines",
+    "Southwest Airlines", "British Airways", "Air France",
     "Lufthansa", "Emirates", "Qatar Airways", "Singapore Airlines"
 ]
 
-# Generate sample flight data for the next 30 days
-start_date = datetime.now()
-for day in range(30):
-    current_date = (start_date + timedelta(days=day)).strftime('%Y-%m-%d')
-    
-    # Generate flights between different city pairs
-    for i in range(len(cities)):
-        for j in range(len(cities)):
-            if i != j:  # Don't create flights from a city to itself
-                # Only create some flights, not all possible combinations
-                if random.random() < 0.1:  # 10% chance to create this flight
-                    departure_city = cities[i]
-                    arrival_city = cities[j]
-                    
-                    # Generate a flight number
-                    airline = random.choice(airlines)
-                    airline_code = ''.join([word[0] for word in airline.split()]).upper()
-                    flight_number = f"{airline_code}{random.randint(1000, 9999)}"
-                    
-                    # Generate times
-                    departure_hour = random.randint(6, 22)
-                    flight_duration = random.randint(1, 10)  # hours
-                    arrival_hour = (departure_hour + flight_duration) % 24
-                    
-                    departure_time = f"{departure_hour:02d}:{random.randint(0, 59):02d}"
-                    arrival_time = f"{arrival_hour:02d}:{random.randint(0, 59):02d}"
-                    
-                    # Generate price and seats
-                    price = round(random.uniform(150, 2000), 2)
-                    seats = random.randint(0, 200)
-                    
-                    # Insert the flight
-                    cursor.execute('''
-                    INSERT INTO flight_info (
-                        flight_number, airline, departure_location, arrival_location,
-                        departure_date, departure_time, arrival_time, price, seats_available
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        flight_number, airline, departure_city, arrival_city,
-                        current_date, departure_time, arrival_time, price, seats
-                    ))
-
-# Commit changes and close connection
-conn.commit()
-conn.close()
-
-print("Flight database setup complete with sample data!")
-print("Database location: data/flights.db")
-print(f"Sample cities: {', '.join(cities[:5])}...")
-print(f"Date range: {start_date.strftime('%Y-%m-%d')} to {(start_date + timedelta(days=29)).strftime('%Y-%m-%d')}") 
\ No newline at end of file
+# Loading runs in one transaction with journaling and fsyncs turned off;
+# a crash mid-load leaves a database that should simply be regenerated.
+BULK_LOAD_PRAGMAS = [
+    "PRAGMA journal_mode = MEMORY",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -262144",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA locking_mode = EXCLUSIVE",
+]
+
+INSERT_FLIGHT_SQL = '''
+INSERT INTO flight_info (
+    flight_number, airline, departure_location, arrival_location,
+    departure_date, departure_time, arrival_time, price, seats_available
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Payment amount is taken from the booked flight's price
+INSERT_BOOKING_HISTORY_SQL = '''
+INSERT INTO bookings
+(customer_id, flight_id, booking_date, payment_amount, payment_status, card_last_four)
+SELECT ?, id, ?, price, 'Completed', ? FROM flight_info WHERE id = ?
+'''
+
+
+def make_names(base: List[str], count: int, prefix: str) -> List[str]:
+    """Return count names, starting with base and padded with synthetic ones."""
+    names = list(base[:count])
+    names += [f"{prefix} {i + 1}" for i in range(len(names), count)]
+    return names
+
+
+def airline_code(airline: str) -> str:
+    """Flight number prefix of an airline, e.g. "Delta Air Lines" -> "DAL"."""
+    return ''.join([word[0] for word in airline.split()]).upper()
+
+
+# "HH:MM" for every minute of the day, indexed by hour * 60 + minute
+CLOCK = np.array([f"{minute // 60:02d}:{minute % 60:02d}" for minute in range(24 * 60)], dtype=object)
+FLIGHT_NUMBERS = np.array([str(number) for number in range(10000)], dtype=object)
+
+
+def generate_day(rng: np.random.Generator, day: str, city_names: np.ndarray, airline_names: np.ndarray,
+                 airline_codes: np.ndarray, density: float):
+    """
+    Generate one day of flights as columns.
+
+    Each ordered city pair gets a flight with probability density, with the
+    same distributions the original sample generator used for airline,
+    flight number, times, price and seats.
+
+    Returns:
+        Tuple of (number of flights, iterator of rows ready for executemany)
+    """
+    n = len(city_names)
+    origin, destination = np.nonzero(rng.random((n, n)) < density)
+    keep = origin != destination
+    origin, destination = origin[keep], destination[keep]
+    count = len(origin)
+    if count == 0:
+        return 0, iter(())
+
+    airline = rng.integers(0, len(airline_names), count)
+    number = rng.integers(1000, 10000, count)
+    departure_hour = rng.integers(6, 23, count)
+    duration = rng.integers(1, 11, count)
+    arrival_hour = (departure_hour + duration) % 24
+    departure_minute = departure_hour * 60 + rng.integers(0, 60, count)
+    arrival_minute = arrival_hour * 60 + rng.integers(0, 60, count)
+    price = np.round(rng.uniform(150, 2000, count), 2)
+    seats = rng.integers(0, 201, count)
+
+    return count, zip(
+        (airline_codes[airline] + FLIGHT_NUMBERS[number]).tolist(),
+        airline_names[airline].tolist(),
+        city_names[origin].tolist(),
+        city_names[destination].tolist(),
+        [day] * count,
+        CLOCK[departure_minute].tolist(),
+        CLOCK[arrival_minute].tolist(),
+        price.tolist(),
+        seats.tolist(),
+    )
+
+
+def generate_bookings(conn: sqlite3.Connection, rng: np.random.Generator, count: int, customers: int,
+                      start_date: datetime, batch_size: int) -> int:
+    """
+    Synthesize booking history against the flights already loaded.
+
+    Bookings pick flights uniformly and are dated within the 60 days before
+    start_date. They do not change seat counts.
+    """
+    low, high = conn.execute("SELECT MIN(id), MAX(id) FROM flight_info").fetchone()
+    if low is None or count <= 0:
+        return 0
+    customer_ids = np.array([f"CUST{i:07d}" for i in range(customers)], dtype=object)
+    first_second = int((start_date - timedelta(days=60)).timestamp())
+    inserted = 0
+    for offset in range(0, count, batch_size):
+        size = min(batch_size, count - offset)
+        flight_ids = rng.integers(low, high + 1, size)
+        booked_at = rng.integers(first_second, first_second + 60 * 86400, size)
+        card = rng.integers(0, 10000, size)
+        rows = zip(
+            customer_ids[rng.integers(0, customers, size)].tolist(),
+            [datetime.fromtimestamp(second).strftime('%Y-%m-%d %H:%M:%S') for second in booked_at.tolist()],
+            [f"{digits:04d}" for digits in card.tolist()],
+            flight_ids.tolist(),
+        )
+        conn.executemany(INSERT_BOOKING_HISTORY_SQL, rows)
+        inserted += size
+    return inserted
+
+
+def generate_database(db_path: str = os.path.join('data', 'flights.db'), num_cities: int = len(cities),
+                      num_airlines: int = len(airlines), days: int = 30, density: float = 0.1,
+                      seed: Optional[int] = None, start_date: Optional[datetime] = None,
+                      bookings: int = 0, customers: int = 10000, batch_size: int = 100000,
+                      fresh: bool = False, verbose: bool = True) -> Dict:
+    """
+    Generate a synthetic flight schedule (and optionally booking history).
+
+    Tables are created first, rows are loaded with executemany inside a
+    single transaction under bulk-load pragmas, and only then are the
+    indexes, summaries and triggers created by the remaining schema
+    migrations, so the load never maintains an index row by row. An
+    existing database that is already indexed is therefore refused unless
+    fresh is set.
+
+    Args:
+        db_path: Database file to create, or to extend while it only has
+            the base tables
+        num_cities: Number of cities in the network
+        num_airlines: Number of airlines flights are assigned to
+        days: Number of consecutive days to schedule, starting at start_date
+        density: Probability that a city pair has a flight on a given day
+        seed: Random seed for reproducible schedules
+        start_date: First scheduled day (defaults to today)
+        bookings: Number of historical bookings to synthesize
+        customers: Size of the customer pool bookings are drawn from
+        batch_size: Rows per executemany call when loading bookings
+        fresh: Delete any existing database at db_path first
+        verbose: Print progress
+
+    Returns:
+        Dictionary with row counts and timings
+
+    Raises:
+        FileExistsError: If db_path holds an indexed database and fresh is not set
+    """
+    directory = os.path.dirname(db_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if fresh:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+    rng = np.random.default_rng(seed)
+    start_date = start_date or datetime.now()
+    city_names = np.array(make_names(cities, num_cities, "City"), dtype=object)
+    airline_names = np.array(make_names(airlines, num_airlines, "Airline"), dtype=object)
+    airline_codes = np.array([airline_code(name) for name in airline_names], dtype=object)
+
+    conn = sqlite3.connect(db_path)
+    if get_schema_version(conn) > 1:
+        conn.close()
+        raise FileExistsError(f"{db_path} already holds an indexed flight database")
+    started = time.perf_counter()
+
+    # Tables only; indexes and triggers are created after the load
+    apply_migrations(conn, target=1)
+    for pragma in BULK_LOAD_PRAGMAS:
+        conn.execute(pragma)
+
+    flights = 0
+    conn.execute("BEGIN")
+    for day in range(days):
+        current_date = (start_date + timedelta(days=day)).strftime('%Y-%m-%d')
+        count, rows = generate_day(rng, current_date, city_names, airline_names, airline_codes, density)
+        conn.executemany(INSERT_FLIGHT_SQL, rows)
+        flights += count
+        if verbose and (day + 1) % max(1, days // 10) == 0:
+            print(f"  {current_date}: {flights:,} flights loaded", file=sys.stderr)
+    booked = generate_bookings(conn, rng, bookings, customers, start_date, batch_size)
+    conn.commit()
+    loaded = time.perf_counter()
+
+    # Indexes, fare summary, change log triggers and planner statistics
+    conn.execute("PRAGMA locking_mode = NORMAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    apply_migrations(conn)
+    check_query_plans(conn)
+    conn.close()
+    indexed = time.perf_counter()
+
+    return {
+        "db_path": db_path,
+        "flights": flights,
+        "bookings": booked,
+        "cities": num_cities,
+        "airlines": num_airlines,
+        "first_date": start_date.strftime('%Y-%m-%d'),
+        "last_date": (start_date + timedelta(days=days - 1)).strftime('%Y-%m-%d'),
+        "load_seconds": round(loaded - started, 2),
+        "index_seconds": round(indexed - loaded, 2),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Create the flight database with a synthetic schedule.")
+    parser.add_argument("--db-path", default=os.path.join('data', 'flights.db'), help="database file")
+    parser.add_argument("--cities", type=int, default=len(cities), help="number of cities")
+    parser.add_argument("--airlines", type=int, default=len(airlines), help="number of airlines")
+    parser.add_argument("--days", type=int, default=30, help="number of days to schedule")
+    parser.add_argument("--density", type=float, default=0.1,
+                        help="probability that a city pair has a flight on a given day")
+    parser.add_argument("--seed", type=int, default=None, help="random seed")
+    parser.add_argument("--start-date", default=None, help="first day, YYYY-MM-DD (default: today)")
+    parser.add_argument("--bookings", type=int, default=0, help="historical bookings to synthesize")
+    parser.add_argument("--customers", type=int, default=10000, help="customer pool for bookings")
+    parser.add_argument("--fresh", action="store_true", help="replace any existing database")
+    args = parser.parse_args()
+
+    start_date = datetime.strptime(args.start_date, '%Y-%m-%d') if args.start_date else None
+    try:
+        stats = generate_database(
+            args.db_path, args.cities, args.airlines, args.days, args.density, args.seed, start_date,
+            args.bookings, args.customers, fresh=args.fresh
+        )
+    except FileExistsError as e:
+        sys.exit(f"{e}. Pass --fresh to replace it.")
+
+    print("Flight database setup complete with sample data!")
+    print(f"Database location: {stats['db_path']}")
+    print(f"Sample cities: {', '.join(make_names(cities, args.cities, 'City')[:5])}...")
+    print(f"Date range: {stats['first_date']} to {stats['last_date']}")
+    print(f"Flights: {stats['flights']:,}  Bookings: {stats['bookings']:,}  "
+          f"(load {stats['load_seconds']}s, indexes {stats['index_seconds']}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+import argparse
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Optional
+
+# Threads available to blocking tool bodies; override with MCP_TOOL_WORKERS
+DEFAULT_TOOL_WORKERS = 8
+
+# Admission limits. Calls beyond MAX_QUEUED waiting ones, or still waiting
+# for a thread after MAX_WAIT seconds, are refused with a retry-later error.
+DEFAULT_MAX_QUEUED = 256
+DEFAULT_MAX_WAIT_SECONDS = 5.0
+
+# Bookings and invoices queue separately from searches. They serialize on
+# the single SQLite writer, so a few threads suffice and a short queue
+# keeps a burst from holding every tool thread. Batch invoice runs stay on
+# the tool executor: they spend minutes rendering in worker processes, and
+# two of them would otherwise hold every write thread and shed bookings.
+DEFAULT_WRITE_WORKERS = 2
+DEFAULT_MAX_QUEUED_WRITES = 64
+
+TRANSPORTS = ("stdio", "sse", "streamable-http")
+
+
+class Overloaded(Exception):
+    """Raised when a call is refused by admission control."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Server busy, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+def retry_later(error: Overloaded) -> Dict:
+    """Structured tool result telling the agent to retry a refused call."""
+    return {
+        "error": "Server is busy. Please retry shortly.",
+        "overloaded": True,
+        "retry_after_seconds": error.retry_after
+    }
+
+
+class ToolExecutor:
+    """
+    Bounded thread pool that runs blocking tool bodies off the event loop.
+
+    Tool handlers do SQLite queries and PDF rendering, which would stall
+    every other session if run on the event loop. offload() turns such a
+    function into a coroutine that runs it on this pool, so one server
+    process can serve many concurrent sessions while at most max_workers
+    handlers touch the database at a time. SQLite releases the GIL while
+    it works, so threads overlap queries; CPU-heavy batch rendering keeps
+    using its own process pool. The pool is created on first use so its
+    size can be configured from the command line.
+
+    Admission is bounded as well: a call arriving while max_queued calls
+    already wait, or still waiting for a thread after max_wait seconds, is
+    refused with Overloaded instead of queueing until the client times
+    out. Offloaded tools turn that into a retry_later() result carrying an
+    estimate of when capacity frees up. Thread-safe.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_TOOL_WORKERS, thread_name_prefix: str = "tool",
+                 max_queued: int = DEFAULT_MAX_QUEUED, max_wait: float = DEFAULT_MAX_WAIT_SECONDS):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.shed_queue_full = 0
+        self.shed_wait_expired = 0
+        # Moving average of call duration, for retry-after estimates
+        self._average_seconds = 0.0
+
+    def configure(self, max_workers: Optional[int] = None, max_queued: Optional[int] = None,
+                  max_wait: Optional[float] = None) -> None:
+        """
+        Set the number of worker threads and the admission limits.
+
+        Raises:
+            RuntimeError: If the worker count changes after the pool started
+        """
+        if max_workers is not None and max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        if max_queued is not None and max_queued < 0:
+            raise ValueError("max_queued must not be negative")
+        if max_wait is not None and max_wait <= 0:
+            raise ValueError("max_wait must be positive")
+        with self._lock:
+            if max_workers is not None and max_workers != self.max_workers:
+                if self._pool is not None:
+                    raise RuntimeError("Tool executor already started; configure it before serving")
+                self.max_workers = max_workers
+            if max_queued is not None:
+                self.max_queued = max_queued
+            if max_wait is not None:
+                self.max_wait = max_wait
+
+    def _retry_after(self) -> float:
+        """Seconds until the current backlog has likely drained. Call with the lock held."""
+        backlog = (self.queued + self.active) * max(self._average_seconds, 0.01) / self.max_workers
+        return round(min(max(backlog, 0.5), 30.0), 1)
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix=self.thread_name_prefix)
+        return self._pool
+
+    def _call(self, fn: Callable, submitted: float, args: tuple, kwargs: Dict) -> Any:
+        started = time.monotonic()
+        with self._lock:
+            self.queued -= 1
+            if started - submitted > self.max_wait:
+                # The caller has waited long enough; do not start stale work
+                self.shed_wait_expired += 1
+                raise Overloaded(self._retry_after())
+            self.active += 1
+        failed = True
+        try:
+            result = fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+                if failed:
+                    self.failed += 1
+                self._average_seconds += (elapsed - self._average_seconds) * 0.1
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Run fn(*args, **kwargs) on the pool and await its result.
+
+        Raises:
+            Overloaded: If the queue is full or the call waited longer than max_wait
+        """
+        pool = self._get_pool()
+        with self._lock:
+            if self.queued >= self.max_queued:
+                self.shed_queue_full += 1
+                raise Overloaded(self._retry_after())
+            self.queued += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pool, self._call, fn, time.monotonic(), args, kwargs)
+
+    def offload(self, fn: Callable) -> Callable:
+        """
+        Decorator turning a blocking function into a coroutine run on the pool.
+
+        The wrapper keeps fn's name, docstring and signature, so it can be
+        registered with @mcp.tool() directly. Calls refused by admission
+        control return a retry_later() result.
+        """
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await self.run(fn, *args, **kwargs)
+            except Overloaded as e:
+                return retry_later(e)
+        return wrapper
+
+    def offload_resource(self, fn: Callable) -> Callable:
+        """
+        Like offload(), for resource handlers, which report errors by
+        raising: calls refused by admission control raise Overloaded.
+        """
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            return await self.run(fn, *args, **kwargs)
+        return wrapper
+
+    def stats(self) -> Dict:
+        """Return pool size, admission limits and call counters."""
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queued": self.max_queued,
+                "max_wait_seconds": self.max_wait,
+                "queued": self.queued,
+                "active": self.active,
+                "completed": self.completed,
+                "failed": self.failed,
+                "shed_queue_full": self.shed_queue_full,
+                "shed_wait_expired": self.shed_wait_expired,
+                "average_call_ms": round(self._average_seconds * 1000, 3),
+            }
+
+    def shutdown(self) -> None:
+        """Stop the pool after running calls finish."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+
+class SingleFlight:
+    """
+    Merges concurrent calls with the same key into one execution.
+
+    The first caller for a key runs the function; callers arriving while
+    it runs wait for and share its result or exception instead of
+    repeating the work. Nothing is cached once the call returns. Callers
+    must treat the shared result as read-only. Thread-safe.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.merged = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """Return fn(), or the result of the identical call already running."""
+        with self._lock:
+            self.calls += 1
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.merged += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self) -> Dict:
+        """Return call counters and the number of calls running now."""
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "merged": self.merged,
+                "in_flight": len(self._calls),
+            }
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+# Process-wide executors shared by every server module loaded in the process
+tool_executor = ToolExecutor(
+    int(os.environ.get("MCP_TOOL_WORKERS", DEFAULT_TOOL_WORKERS)),
+    max_queued=int(os.environ.get("MCP_MAX_QUEUED_TOOLS", DEFAULT_MAX_QUEUED)),
+    max_wait=_env_float("MCP_MAX_QUEUE_WAIT", DEFAULT_MAX_WAIT_SECONDS),
+)
+write_executor = ToolExecutor(
+    int(os.environ.get("MCP_WRITE_WORKERS", DEFAULT_WRITE_WORKERS)),
+    thread_name_prefix="write",
+    max_queued=int(os.environ.get("MCP_MAX_QUEUED_WRITES", DEFAULT_MAX_QUEUED_WRITES)),
+    max_wait=_env_float("MCP_MAX_QUEUE_WAIT", DEFAULT_MAX_WAIT_SECONDS),
+)
+
+
+def add_transport_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the transport, worker and admission limit options to a server CLI."""
+    parser.add_argument("--transport", choices=TRANSPORTS, default="stdio",
+                        help="stdio serves one client; sse and streamable-http serve many over HTTP")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on for HTTP transports")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on for HTTP transports")
+    parser.add_argument("--tool-workers", type=int, default=None,
+                        help=f"threads running blocking tool work (default: {tool_executor.max_workers})")
+    parser.add_argument("--max-queued-tools", type=int, default=None,
+                        help=f"tool calls allowed to wait for a thread before new ones are refused "
+                             f"(default: {tool_executor.max_queued})")
+    parser.add_argument("--write-workers", type=int, default=None,
+                        help=f"threads running bookings and invoices (default: {write_executor.max_workers})")
+    parser.add_argument("--max-queued-writes", type=int, default=None,
+                        help=f"bookings and invoices allowed to wait before new ones are refused "
+                             f"(default: {write_executor.max_queued})")
+    parser.add_argument("--max-queue-wait", type=float, default=None,
+                        help=f"seconds a call may wait for a thread before it is refused "
+                             f"(default: {tool_executor.max_wait})")
+
+
+def serve(mcp, args: argparse.Namespace) -> None:
+    """Run a FastMCP server with the transport, worker and admission limits chosen on the command line."""
+    tool_executor.configure(args.tool_workers, args.max_queued_tools, args.max_queue_wait)
+    write_executor.configure(args.write_workers, args.max_queued_writes, args.max_queue_wait)
+    mcp.settings.host = args.host
+    mcp.settings.port = args.port
+    try:
+        mcp.run(transport=args.transport)
+    finally:
+        tool_executor.shutdown()
+        write_executor.shutdown()